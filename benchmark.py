@@ -0,0 +1,230 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from main import (BUILDING_TYPES, City, audit_city, demolish, display_grid, load_game,
+                  save_game)
+from ensemble import percentile
+
+BENCHMARKS = ['update_city_stats', 'simulate_turn', 'grow_zones', 'display_grid', 'audit_city',
+              'save_game', 'load_game', 'build', 'demolish']
+INFRASTRUCTURE = ['POWER', 'ROAD', 'WATER']
+PERCENTILES = (50, 90, 99)
+
+
+def populate(grid_size: int, density: float, seed: int, weights: List[float] = None,
+             money: int = 10 ** 15) -> City:
+    """A city with about `density` of its cells built on and as many carrying each network.
+
+    `weights` favours some building types over others, in BUILDING_TYPES order.
+    """
+    if not 0 < density < 1:
+        raise ValueError("density must be between 0 and 1")
+    rng = random.Random(seed)
+    city = City('benchmark', grid_size, seed)
+    city.money = money
+    cells = grid_size * grid_size
+    for index in rng.sample(range(cells), int(cells * density)):
+        building_type = rng.choices(BUILDING_TYPES, weights)[0] if weights else rng.choice(BUILDING_TYPES)
+        city.place_building(index % grid_size, index // grid_size, building_type)
+    for infra_type in INFRASTRUCTURE:
+        for index in rng.sample(range(cells), int(cells * density)):
+            city.infrastructure.add_connection(index % grid_size, index // grid_size, infra_type)
+    city.stats_version += 1
+    city.update_city_stats()
+    return city
+
+
+def _operations(city: City, rng: random.Random) -> Dict[str, Tuple[Callable[[], object], Callable[[], object]]]:
+    """One call of each benchmarked operation on `city`, and an untimed undo (or None)."""
+    size = city.grid_size
+    changed = []
+
+    def build():
+        # Pick an empty cell so every call does a real build
+        while True:
+            x, y = rng.randrange(size), rng.randrange(size)
+            if city.building_at(x, y) is None:
+                changed.append((x, y, None))
+                return city.build(x, y, rng.choice(BUILDING_TYPES))
+
+    def demolish_one():
+        while True:
+            x, y = rng.randrange(size), rng.randrange(size)
+            building_type = city.building_at(x, y)
+            if building_type is not None:
+                changed.append((x, y, building_type))
+                return demolish(city, x, y)
+
+    def undo():
+        # Put the cell back so the density stays the same however many calls are made
+        x, y, building_type = changed.pop()
+        if building_type is None:
+            city.remove_building(x, y)
+        else:
+            city.place_building(x, y, building_type)
+        city.stats_version += 1
+
+    return {
+        'update_city_stats': (city.update_city_stats, None),
+        'simulate_turn': (city.simulate_turn, None),
+        'grow_zones': (lambda: city.grow_zones(force=True), None),
+        'display_grid': (lambda: display_grid(city), None),
+        'audit_city': (lambda: audit_city(city), None),
+        'save_game': (lambda: save_game(city, 'benchmark'), None),
+        'load_game': (lambda: load_game('benchmark'), None),
+        'build': (build, undo),
+        'demolish': (demolish_one, undo),
+    }
+
+
+def time_calls(operation: Callable[[], object], undo: Callable[[], object], min_time: float,
+               min_calls: int, max_calls: int) -> List[int]:
+    """Per-call latencies in nanoseconds, calling until both minimums are met."""
+    latencies = []
+    started = time.perf_counter_ns()
+    deadline = started + int(min_time * 1e9)
+    while len(latencies) < max_calls:
+        before = time.perf_counter_ns()
+        operation()
+        after = time.perf_counter_ns()
+        latencies.append(after - before)
+        if undo is not None:
+            undo()
+        if len(latencies) >= min_calls and after >= deadline:
+            break
+    return latencies
+
+
+def peak_memory(operation: Callable[[], object], undo: Callable[[], object], calls: int) -> int:
+    """Peak bytes allocated while making `calls` calls, traced separately from the timings."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for _ in range(calls):
+            operation()
+            if undo is not None:
+                undo()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(grid_sizes: List[int], densities: List[float], benchmarks: List[str] = BENCHMARKS,
+                   seed: int = 0, min_time: float = 0.5, min_calls: int = 5, max_calls: int = 10000,
+                   memory_calls: int = 3) -> dict:
+    results = []
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull:
+        previous_directory = os.getcwd()
+        # Saves go to a throwaway saves/ directory
+        os.chdir(directory)
+        try:
+            for grid_size in grid_sizes:
+                for density in densities:
+                    city = populate(grid_size, density, seed)
+                    operations = _operations(city, random.Random(seed))
+                    with contextlib.redirect_stdout(devnull):
+                        save_game(city, 'benchmark')
+                        for name in benchmarks:
+                            operation, undo = operations[name]
+                            latencies = sorted(time_calls(operation, undo, min_time, min_calls, max_calls))
+                            total = sum(latencies)
+                            results.append({
+                                'benchmark': name,
+                                'grid_size': grid_size,
+                                'density': density,
+                                'calls': len(latencies),
+                                'ops_per_sec': len(latencies) / (total / 1e9) if total else float('inf'),
+                                'latency_us': {f"p{percent}": percentile(latencies, percent) / 1000
+                                               for percent in PERCENTILES},
+                                'peak_bytes': peak_memory(operation, undo, memory_calls)
+                            })
+                    print(_format_result(results[-len(benchmarks):]), file=sys.stderr)
+        finally:
+            os.chdir(previous_directory)
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'results': results
+    }
+
+
+def _key(result: dict) -> Tuple[str, int, float]:
+    return (result['benchmark'], result['grid_size'], result['density'])
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1) -> List[dict]:
+    """Regressions of `current` against `baseline`: throughput, p99 latency or peak memory worse by more than `threshold`."""
+    previous = {_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        checks = [
+            ('ops_per_sec', old['ops_per_sec'], result['ops_per_sec'], old['ops_per_sec'] / max(result['ops_per_sec'], 1e-12)),
+            ('p99_us', old['latency_us']['p99'], result['latency_us']['p99'],
+             result['latency_us']['p99'] / max(old['latency_us']['p99'], 1e-12)),
+            ('peak_bytes', old['peak_bytes'], result['peak_bytes'],
+             result['peak_bytes'] / max(old['peak_bytes'], 1)),
+        ]
+        for metric, before, after, ratio in checks:
+            if ratio > 1 + threshold:
+                regressions.append({'benchmark': result['benchmark'], 'grid_size': result['grid_size'],
+                                    'density': result['density'], 'metric': metric,
+                                    'baseline': before, 'current': after, 'ratio': ratio})
+    return regressions
+
+
+def _format_result(results: List[dict]) -> str:
+    lines = []
+    for result in results:
+        latency = result['latency_us']
+        lines.append(f"{result['benchmark']:<18} size {result['grid_size']:>6} density {result['density']:<5} "
+                     f"{result['ops_per_sec']:>12,.1f} ops/s  p50 {latency['p50']:>10,.1f}us  "
+                     f"p99 {latency['p99']:>10,.1f}us  peak {result['peak_bytes'] / 1024:>10,.1f}KiB")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the simulation's hot paths across map sizes and densities.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.1, 0.5])
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds to spend on each benchmark")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE', help="flag regressions against a saved results file")
+    parser.add_argument('--threshold', type=float, default=0.1, help="allowed slowdown before flagging, e.g. 0.1 for 10%%")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.densities, args.benchmarks, args.seed, args.min_time)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['benchmark']} size {regression['grid_size']} "
+                  f"density {regression['density']}: {regression['metric']} "
+                  f"{regression['baseline']:,.1f} -> {regression['current']:,.1f} "
+                  f"({regression['ratio']:.2f}x worse)")
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+from typing import Dict, List
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is only needed for batched runs
+    np = None
+
+from main import SECTORS, Economy
+
+# Per building, as in Economy.update_economy
+JOBS_PER_BUILDING = {'R': 5, 'C': 20, 'I': 50}
+INCOME_PER_BUILDING = {'R': 1000, 'C': 2000, 'I': 5000}
+TAX_SHARES = {'R': 0.05, 'C': 0.08, 'I': 0.12}
+
+
+class EconomyBatch:
+    """The economies of many cities held in NumPy arrays, one entry per city."""
+
+    def __init__(self, count: int):
+        if np is None:
+            raise ImportError("EconomyBatch requires NumPy")
+        self.count = count
+        self.employment_rate = np.full(count, 0.95)
+        self.gdp = np.zeros(count)
+        self.inflation_rate = np.full(count, 0.02)
+        self.business_confidence = np.full(count, 0.75)
+        self.jobs = {sector: np.zeros(count, dtype=np.int64) for sector in SECTORS}
+        self.income = {sector: np.zeros(count) for sector in SECTORS}
+        # Whether each city's residential income is a float in the scalar Economy
+        self.residential_float = np.zeros(count, dtype=bool)
+        # Economy.trade: what each city trades per sector, and whether it trades in it at all
+        self.trade_jobs = {sector: np.zeros(count) for sector in SECTORS}
+        self.trade_income = {sector: np.zeros(count) for sector in SECTORS}
+        self.traded = {sector: np.zeros(count, dtype=bool) for sector in SECTORS}
+
+    @classmethod
+    def from_economies(cls, economies: List[Economy]):
+        batch = cls(len(economies))
+        for index, economy in enumerate(economies):
+            batch.load(index, economy)
+        return batch
+
+    def load(self, index: int, economy: Economy):
+        """Copy one city's economy into slot `index`."""
+        self.employment_rate[index] = economy.employment_rate
+        self.gdp[index] = economy.gdp
+        self.inflation_rate[index] = economy.inflation_rate
+        self.business_confidence[index] = economy.business_confidence
+        for sector in SECTORS:
+            self.jobs[sector][index] = economy.sectors[sector]['jobs']
+            self.income[sector][index] = economy.sectors[sector]['income']
+        self.residential_float[index] = isinstance(economy.sectors['R']['income'], float)
+        for sector in SECTORS:
+            self.trade_jobs[sector][index] = self.trade_income[sector][index] = 0.0
+            self.traded[sector][index] = False
+        for sector, jobs, income in economy.trade:
+            self.trade_jobs[sector][index] = jobs
+            self.trade_income[sector][index] = income
+            self.traded[sector][index] = True
+
+    def store(self, index: int, economy: Economy):
+        """Write slot `index` back into a scalar Economy."""
+        economy.employment_rate = float(self.employment_rate[index])
+        economy.gdp = float(self.gdp[index])
+        economy.inflation_rate = float(self.inflation_rate[index])
+        economy.business_confidence = float(self.business_confidence[index])
+        for sector in SECTORS:
+            jobs = self.jobs[sector][index]
+            # Traded jobs are floats, so a sector's jobs are too once it trades
+            economy.sectors[sector]['jobs'] = float(jobs) if self.traded[sector][index] else int(jobs)
+            income = self.income[sector][index]
+            # Residential income stays an int unless an event or trade added a float to it
+            economy.sectors[sector]['income'] = (int(income) if sector == 'R' and not self.residential_float[index]
+                                                 else float(income))
+        economy.trade = tuple((sector, float(self.trade_jobs[sector][index]), float(self.trade_income[sector][index]))
+                              for sector in SECTORS if self.traded[sector][index])
+
+    def to_economies(self) -> List[Economy]:
+        economies = []
+        for index in range(self.count):
+            economy = Economy()
+            self.store(index, economy)
+            economies.append(economy)
+        return economies
+
+    def update_economy(self, building_counts: Dict[str, 'np.ndarray'], population: 'np.ndarray',
+                       productivity: 'np.ndarray' = 1.0,
+                       sector_productivity: Dict[str, 'np.ndarray'] = None) -> 'np.ndarray':
+        """Vectorized Economy.update_economy; each argument holds one value per city.
+
+        `sector_productivity` holds the event factor of each sector per city,
+        1.0 where no event targets it.
+        """
+        # Every operation runs in the same order and at the same float64 precision
+        # as the scalar code, so the results match it bit for bit
+        for sector in SECTORS:
+            self.jobs[sector] = np.asarray(building_counts[sector], dtype=np.int64) * JOBS_PER_BUILDING[sector]
+
+        self.income['R'] = (np.asarray(building_counts['R'], dtype=np.int64) * INCOME_PER_BUILDING['R']).astype(float)
+        for sector in ['C', 'I']:
+            income = np.asarray(building_counts[sector], dtype=np.int64) * INCOME_PER_BUILDING[sector]
+            self.income[sector] = income * self.business_confidence * productivity
+        self.residential_float = np.zeros(self.count, dtype=bool)
+        for sector, factor in (sector_productivity or {}).items():
+            factor = np.asarray(factor, dtype=float)
+            # Multiplying by 1.0 changes nothing, like the sectors left out of the scalar tuple
+            self.income[sector] = self.income[sector] * factor
+            if sector == 'R':
+                self.residential_float = factor != 1.0
+        for sector in SECTORS:
+            if self.traded[sector].any():
+                # Adding 0.0 for the cities that don't trade leaves their numbers as they are
+                self.jobs[sector] = self.jobs[sector] + self.trade_jobs[sector]
+                self.income[sector] = self.income[sector] + self.trade_income[sector]
+        self.residential_float = self.residential_float | self.traded['R']
+
+        # Summed in the order of the scalar sum() over the sectors dict
+        self.gdp = self.income['R'] + self.income['C'] + self.income['I']
+
+        total_jobs = self.jobs['R'] + self.jobs['C'] + self.jobs['I']
+        self.employment_rate = np.minimum(1.0, total_jobs / np.maximum(np.asarray(population, dtype=np.int64), 1))
+
+        self.business_confidence = np.minimum(1.0, (self.employment_rate + 0.5) / 1.5)
+
+        return self.calculate_tax_income()
+
+    def calculate_tax_income(self) -> 'np.ndarray':
+        return (self.income['R'] * TAX_SHARES['R'] + self.income['C'] * TAX_SHARES['C']
+                + self.income['I'] * TAX_SHARES['I'])
@@ -0,0 +1,204 @@
+import argparse
+import itertools
+import json
+import os
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterator, List, Sequence, Union
+
+from main import City, load_game
+
+METRICS = ['money', 'population', 'happiness', 'gdp']
+
+# The unchanging part of the city (grid, infrastructure) is sent to each
+# worker once by the pool initializer; tasks only carry the small state
+# that changes from turn to turn. Zone density is carried only once a run's
+# has grown away from the city's: a run state's 'zones' is None until then,
+# and otherwise a zone state with a 'token' naming it, so a worker whose
+# city already holds those zones doesn't load them again.
+_worker_city = None
+# The worker city's zones when it was made, and the token of the ones it holds now
+_initial_zones = None
+_worker_zones = None
+_zone_tokens = itertools.count()
+
+
+def _init_worker(city_data: dict):
+    global _worker_city, _initial_zones
+    _worker_city = City.from_dict(city_data)
+    _initial_zones = _worker_city.get_zone_state()
+
+
+def capture_state(city: City, zones: dict = None) -> dict:
+    """Everything a run changes on a city whose buildings stay fixed.
+
+    `zones` is the run's zone state, None while it is the one the run
+    started from.
+    """
+    return {
+        'money': city.money,
+        'population': city.population,
+        'happiness': city.happiness,
+        'time_elapsed': city.time_elapsed,
+        'tax_rate': city.tax_rate,
+        'economy': {
+            'employment_rate': city.economy.employment_rate,
+            'gdp': city.economy.gdp,
+            'inflation_rate': city.economy.inflation_rate,
+            'business_confidence': city.economy.business_confidence,
+            'sectors': {sector: dict(data) for sector, data in city.economy.sectors.items()}
+        },
+        'maintenance_costs': dict(city.maintenance_costs),
+        'rng_state': city.get_rng_state(),
+        'events': city.scheduler.get_state(),
+        'zones': zones
+    }
+
+
+def apply_state(city: City, state: dict):
+    city.money = state['money']
+    city.population = state['population']
+    city.happiness = state['happiness']
+    city.time_elapsed = state['time_elapsed']
+    city.tax_rate = state['tax_rate']
+    economy = state['economy']
+    city.economy.employment_rate = economy['employment_rate']
+    city.economy.gdp = economy['gdp']
+    city.economy.inflation_rate = economy['inflation_rate']
+    city.economy.business_confidence = economy['business_confidence']
+    city.economy.sectors = {sector: dict(data) for sector, data in economy['sectors'].items()}
+    city.maintenance_costs.clear()
+    city.maintenance_costs.update(state['maintenance_costs'])
+    city.set_rng_state(state['rng_state'])
+    city.scheduler.set_state(state['events'], city.rng, city.time_elapsed)
+
+
+def _apply_zones(city: City, zones: dict):
+    """Load a run's zone state into the worker city, unless it holds those zones already."""
+    global _worker_zones
+    token = None if zones is None else zones['token']
+    if token != _worker_zones:
+        city.set_zone_state(_initial_zones if zones is None else zones)
+        _worker_zones = token
+
+
+def _run_block(states: List[dict], turns: int) -> List[tuple]:
+    """Advance each run by `turns` turns on this worker's copy of the city."""
+    global _worker_zones
+    city = _worker_city
+    results = []
+    for state in states:
+        apply_state(city, state)
+        zones = state['zones']
+        _apply_zones(city, zones)
+        before = city.density_layer.snapshot()
+        columns = {metric: array('d') for metric in METRICS}
+        for row in city.run(turns, record_every=1)['history']:
+            for metric in METRICS:
+                columns[metric].append(row[metric])
+        # Encoded again only if some zone grew or shrank during the block
+        if city.density_layer.differences(before):
+            zones = dict(city.get_zone_state(), token=f"{os.getpid()}-{next(_zone_tokens)}")
+            _worker_zones = zones['token']
+        results.append((columns, capture_state(city, zones)))
+    return results
+
+
+def percentile(sorted_values: Sequence[float], percent: float) -> float:
+    """The `percent` percentile of already sorted values, interpolating between neighbours."""
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def _aggregate(turn: int, values: Dict[str, List[float]], percentiles: Sequence[float]) -> dict:
+    summary = {'turn': turn}
+    for metric in METRICS:
+        ordered = sorted(values[metric])
+        stats = {'mean': sum(ordered) / len(ordered)}
+        for percent in percentiles:
+            stats[f"p{percent:g}"] = percentile(ordered, percent)
+        summary[metric] = stats
+    return summary
+
+
+def iter_ensemble(city: Union[City, str], runs: int, turns: int, seed: int = None,
+                  workers: int = None, block_turns: int = 100,
+                  percentiles: Sequence[float] = (5, 50, 95)) -> Iterator[dict]:
+    """Run `runs` independently seeded futures of `city` and yield per-turn aggregates.
+
+    `city` may be a City or the name of a save. Runs are split into
+    batches that advance `block_turns` turns per task, so the aggregates
+    for each block are yielded as soon as every batch has finished it.
+    """
+    if isinstance(city, str):
+        loaded = load_game(city)
+        if loaded is None:
+            raise ValueError(f"Could not load save {city!r}")
+        city = loaded
+    workers = workers or os.cpu_count() or 1
+    seeder = random.Random(seed)
+    original_rng_state = city.get_rng_state()
+    original_events = city.scheduler.get_state()
+    states = []
+    for _ in range(runs):
+        city.rng.seed(seeder.getrandbits(64))
+        # Each run draws its own event schedule from its own generator
+        city.scheduler.start(city.rng, city.time_elapsed)
+        states.append(capture_state(city))
+    city.set_rng_state(original_rng_state)
+    city.scheduler.set_state(original_events, city.rng, city.time_elapsed)
+    batch_count = min(runs, workers * 4)
+    batches = [states[index::batch_count] for index in range(batch_count)]
+
+    first_turn = city.time_elapsed + 1
+    blocks = [min(block_turns, turns - start) for start in range(0, turns, block_turns)]
+    # block index -> batch index -> metric columns
+    finished: Dict[int, Dict[int, list]] = {index: {} for index in range(len(blocks))}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(city.to_dict(),)) as pool:
+        pending = {pool.submit(_run_block, batch, blocks[0]): (index, 0)
+                   for index, batch in enumerate(batches)} if blocks else {}
+        next_block = 0
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch_index, block_index = pending.pop(future)
+                results = future.result()
+                finished[block_index][batch_index] = [columns for columns, _ in results]
+                if block_index + 1 < len(blocks):
+                    new_states = [state for _, state in results]
+                    pending[pool.submit(_run_block, new_states, blocks[block_index + 1])] = \
+                        (batch_index, block_index + 1)
+            while next_block < len(blocks) and len(finished[next_block]) == batch_count:
+                block_start = first_turn + sum(blocks[:next_block])
+                block = finished.pop(next_block)
+                run_columns = [columns for batch_index in range(batch_count) for columns in block[batch_index]]
+                for offset in range(blocks[next_block]):
+                    values = {metric: [columns[metric][offset] for columns in run_columns]
+                              for metric in METRICS}
+                    yield _aggregate(block_start + offset, values, percentiles)
+                next_block += 1
+
+
+def run_ensemble(city: Union[City, str], runs: int, turns: int, seed: int = None,
+                 workers: int = None, **options) -> List[dict]:
+    return list(iter_ensemble(city, runs, turns, seed, workers, **options))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many random futures of a saved city in parallel.")
+    parser.add_argument('save', help="name of the save to start from")
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    for summary in iter_ensemble(args.save, args.runs, args.turns, args.seed, args.workers):
+        print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,926 @@
+import argparse
+import sys
 import time
 import random
 import json
 import os
+import re
+import zlib
+import base64
+import mmap
+import struct
+import threading
+import contextlib
+import io
+import tracemalloc
+import itertools
+import heapq
+import inspect
+import math
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
 from typing import Dict, List, Tuple
-from collections import defaultdict
+from collections import defaultdict, deque
+
+try:
+    import numpy as np
+except ImportError:  # NumPy only speeds up the zone growth pass
+    np = None
+
+CHUNK_SIZE = 64
+CHUNK_CELLS = CHUNK_SIZE * CHUNK_SIZE
+
+
+class GridLayer:
+    """Square grid of uint8 cell values split into sparse CHUNK_SIZE chunks."""
+    # Cells read by whole-chunk scans, across every layer; Instrumentation
+    # reports how many each phase caused
+    cells_scanned = 0
+
+    def __init__(self, size: int, max_value: int = 255):
+        self.size = size
+        self.max_value = max_value
+        # Row-major bytearrays; chunks holding only zeros are dropped, so a
+        # mostly empty map costs memory only where something is built
+        self.chunks: Dict[Tuple[int, int], bytearray] = {}
+        self.chunk_histograms: Dict[Tuple[int, int], List[int]] = {}
+        self.histogram = [0] * (max_value + 1)
+        # Chunks touched since the histograms were last counted
+        self.dirty_chunks = set()
+        # Chunks of a memory-mapped save that haven't been touched yet:
+        # key -> offset of the chunk's bytes in self.buffer
+        self.mapped: Dict[Tuple[int, int], int] = {}
+        self.buffer = None
+        # Snapshot generation -> old bytes (None for an empty chunk) of the
+        # chunks first written after that snapshot and before the next one
+        self.versions: Dict[int, Dict[Tuple[int, int], bytearray]] = {}
+        # Generations in self.versions, oldest first
+        self.snapshot_generations: List[int] = []
+        self.generation = 0
+        # Chunks written since the newest snapshot, whose old bytes are kept already
+        self.fresh = set()
+        # Generations of snapshots that have been dropped, merged on the next snapshot()
+        self.released: List[int] = []
+
+    def _chunk(self, key: Tuple[int, int]):
+        chunk = self.chunks.get(key)
+        if chunk is None and key in self.mapped:
+            offset = self.mapped.pop(key)
+            chunk = self.chunks[key] = bytearray(self.buffer[offset:offset + CHUNK_CELLS])
+            if not self.mapped:
+                self.buffer = None
+        return chunk
+
+    def load_all(self):
+        """Pull every chunk still in a memory-mapped save into memory."""
+        for key in list(self.mapped):
+            self._chunk(key)
+
+    def get(self, x: int, y: int) -> int:
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            if not self.mapped:
+                return 0
+            chunk = self._chunk(key)
+            if chunk is None:
+                return 0
+        return chunk[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE]
+
+    def set(self, x: int, y: int, value: int):
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        chunk = self.chunks.get(key)
+        if chunk is None and self.mapped:
+            chunk = self._chunk(key)
+        if self.versions and key not in self.fresh and self._preserve(key, chunk) and chunk is not None:
+            chunk = self.chunks[key] = bytearray(chunk)
+        if chunk is None:
+            if not value:
+                return
+            chunk = self.chunks[key] = bytearray(CHUNK_CELLS)
+        chunk[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE] = value
+        self.dirty_chunks.add(key)
+        if not value and chunk.count(0) == CHUNK_CELLS:
+            del self.chunks[key]
+
+    def _refresh(self):
+        for key in self.dirty_chunks:
+            old = self.chunk_histograms.pop(key, None)
+            if old is not None:
+                for value, count in enumerate(old):
+                    self.histogram[value] -= count
+            chunk = self._chunk(key)
+            if chunk is None:
+                continue
+            GridLayer.cells_scanned += CHUNK_CELLS
+            new = [chunk.count(value) for value in range(self.max_value + 1)]
+            for value, count in enumerate(new):
+                self.histogram[value] += count
+            self.chunk_histograms[key] = new
+        self.dirty_chunks.clear()
+
+    def chunk_histogram(self, cx: int, cy: int) -> List[int]:
+        """Cached value counts of one chunk (all zeros for an empty chunk)."""
+        self._refresh()
+        histogram = self.chunk_histograms.get((cx, cy))
+        if histogram is None:
+            histogram = [0] * (self.max_value + 1)
+            histogram[0] = CHUNK_CELLS
+        return histogram
+
+    def count(self, value: int) -> int:
+        if value > self.max_value:
+            return 0
+        self._refresh()
+        if value == 0:
+            return self.size * self.size - sum(self.histogram[1:])
+        return self.histogram[value]
+
+    def rescan_count(self, value: int) -> int:
+        """Count a non-zero value by scanning every chunk, bypassing the cache."""
+        self.load_all()
+        GridLayer.cells_scanned += CHUNK_CELLS * len(self.chunks)
+        return sum(chunk.count(value) for chunk in self.chunks.values())
+
+    def row(self, y: int, start: int = 0, stop: int = None) -> bytes:
+        if stop is None:
+            stop = self.size
+        cy, offset = divmod(y, CHUNK_SIZE)
+        offset *= CHUNK_SIZE
+        parts = []
+        x = start
+        while x < stop:
+            cx, local = divmod(x, CHUNK_SIZE)
+            width = min(CHUNK_SIZE - local, stop - x)
+            chunk = self._chunk((cx, cy))
+            if chunk is None:
+                parts.append(bytes(width))
+            else:
+                parts.append(chunk[offset + local:offset + local + width])
+            x += width
+        return b''.join(parts)
+
+    def nonzero(self):
+        """Yield (x, y, value) for every non-empty cell, skipping empty runs in C."""
+        self.load_all()
+        for (cx, cy), chunk in sorted(self.chunks.items(), key=lambda item: (item[0][1], item[0][0])):
+            GridLayer.cells_scanned += CHUNK_CELLS
+            for match in _NONZERO_CELL.finditer(chunk):
+                local_y, local_x = divmod(match.start(), CHUNK_SIZE)
+                yield cx * CHUNK_SIZE + local_x, cy * CHUNK_SIZE + local_y, chunk[match.start()]
+
+    def to_array(self) -> 'np.ndarray':
+        """The whole layer as a size x size uint8 NumPy array."""
+        padded = -(-self.size // CHUNK_SIZE) * CHUNK_SIZE
+        values = np.zeros((padded, padded), dtype=np.uint8)
+        for cx, cy in self.chunk_keys():
+            values[cy * CHUNK_SIZE:(cy + 1) * CHUNK_SIZE, cx * CHUNK_SIZE:(cx + 1) * CHUNK_SIZE] = \
+                np.frombuffer(self._chunk((cx, cy)), dtype=np.uint8).reshape(CHUNK_SIZE, CHUNK_SIZE)
+        return values[:self.size, :self.size]
+
+    def window(self, x0: int, y0: int, x1: int, y1: int) -> 'np.ndarray':
+        """Cells [x0, x1) x [y0, y1) as a uint8 NumPy array, copied a chunk at a time."""
+        values = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        for cy in range(y0 // CHUNK_SIZE, -(-y1 // CHUNK_SIZE)):
+            top, bottom = max(y0, cy * CHUNK_SIZE), min(y1, (cy + 1) * CHUNK_SIZE)
+            for cx in range(x0 // CHUNK_SIZE, -(-x1 // CHUNK_SIZE)):
+                chunk = self._chunk((cx, cy))
+                if chunk is None:
+                    continue
+                left, right = max(x0, cx * CHUNK_SIZE), min(x1, (cx + 1) * CHUNK_SIZE)
+                cells = np.frombuffer(chunk, dtype=np.uint8).reshape(CHUNK_SIZE, CHUNK_SIZE)
+                values[top - y0:bottom - y0, left - x0:right - x0] = \
+                    cells[top - cy * CHUNK_SIZE:bottom - cy * CHUNK_SIZE, left - cx * CHUNK_SIZE:right - cx * CHUNK_SIZE]
+        return values
+
+    def write_array(self, values: 'np.ndarray', x0: int = 0, y0: int = 0):
+        """Store an array at (x0, y0), replacing only the chunks whose cells differ.
+
+        (x0, y0) must be a chunk corner, and the array must end on a chunk
+        boundary or at the edge of the map; it defaults to the whole map.
+        """
+        height, width = values.shape
+        columns, rows = -(-width // CHUNK_SIZE), -(-height // CHUNK_SIZE)
+        padded = np.zeros((rows * CHUNK_SIZE, columns * CHUNK_SIZE), dtype=np.uint8)
+        padded[:height, :width] = values
+        for cy in range(rows):
+            for cx in range(columns):
+                key = (x0 // CHUNK_SIZE + cx, y0 // CHUNK_SIZE + cy)
+                block = padded[cy * CHUNK_SIZE:(cy + 1) * CHUNK_SIZE, cx * CHUNK_SIZE:(cx + 1) * CHUNK_SIZE]
+                old = self._chunk(key)
+                if old is None:
+                    if not block.any():
+                        continue
+                elif np.array_equal(np.frombuffer(old, dtype=np.uint8), block.ravel()):
+                    continue
+                if self.versions and key not in self.fresh:
+                    self._preserve(key, old)
+                # A new bytearray, so a snapshot keeping the old chunk isn't affected
+                if block.any():
+                    self.chunks[key] = bytearray(block.tobytes())
+                else:
+                    del self.chunks[key]
+                self.dirty_chunks.add(key)
+
+    def snapshot(self) -> 'LayerSnapshot':
+        """Freeze the current cells in constant time; see LayerSnapshot."""
+        if self.released:
+            self._merge_released()
+        self.generation += 1
+        self.versions[self.generation] = {}
+        self.snapshot_generations.append(self.generation)
+        self.fresh = set()
+        return LayerSnapshot(self, self.generation)
+
+    def _preserve(self, key: Tuple[int, int], chunk) -> bool:
+        """Keep a chunk's bytes for the newest live snapshot before its first write since then.
+
+        Returns True if they were kept, in which case the write must go to
+        a copy of the chunk.
+        """
+        self.fresh.add(key)
+        if self.released:
+            self._merge_released()
+            if not self.versions:
+                return False
+        kept = self.versions[self.snapshot_generations[-1]]
+        if key in kept:
+            # Only after a newer, dropped snapshot was merged into this one
+            return False
+        kept[key] = chunk
+        return True
+
+    def _merge_released(self):
+        """Forget dropped snapshots, handing the bytes they kept to the snapshot before them."""
+        released, self.released = self.released, []
+        for generation in released:
+            index = bisect_left(self.snapshot_generations, generation)
+            del self.snapshot_generations[index]
+            kept = self.versions.pop(generation)
+            if index:
+                older = self.versions[self.snapshot_generations[index - 1]]
+                for key, chunk in kept.items():
+                    older.setdefault(key, chunk)
+
+    def _snapshot_chunk(self, generation: int, key: Tuple[int, int]):
+        """The chunk as it was at snapshot `generation` (None if it was empty)."""
+        generations = self.snapshot_generations
+        for newer in generations[bisect_left(generations, generation):]:
+            kept = self.versions[newer]
+            if key in kept:
+                return kept[key]
+        # Not written since: the layer still holds it
+        chunk = self.chunks.get(key)
+        if chunk is None and key in self.mapped:
+            chunk = self.buffer[self.mapped[key]:self.mapped[key] + CHUNK_CELLS]
+        return chunk
+
+    def _changed_keys(self, generation: int) -> set:
+        """Keys of the chunks written to since snapshot `generation`."""
+        generations = self.snapshot_generations
+        keys = set()
+        for newer in generations[bisect_left(generations, generation):]:
+            keys.update(self.versions[newer])
+        return keys
+
+    def differences(self, snapshot: 'LayerSnapshot') -> List[Tuple[int, int, int]]:
+        """(x, y, value in the snapshot) for every cell that has changed since `snapshot`.
+
+        Only the chunks written to since the snapshot are read, unless it
+        was taken of another layer.
+        """
+        if snapshot.layer is self:
+            keys = self._changed_keys(snapshot.generation)
+        else:
+            keys = snapshot.keys() | set(self.chunk_keys())
+        changes = []
+        for key in sorted(keys):
+            old = snapshot.chunk(key)
+            new = self._chunk(key)
+            old = bytes(CHUNK_CELLS) if old is None else bytes(old)
+            new = bytes(CHUNK_CELLS) if new is None else bytes(new)
+            if old == new:
+                continue
+            # XOR the chunks as big integers so the differing cells are found in C
+            delta = (int.from_bytes(old, 'little') ^ int.from_bytes(new, 'little')).to_bytes(CHUNK_CELLS, 'little')
+            cx, cy = key
+            for match in _NONZERO_CELL.finditer(delta):
+                local_y, local_x = divmod(match.start(), CHUNK_SIZE)
+                changes.append((cx * CHUNK_SIZE + local_x, cy * CHUNK_SIZE + local_y, old[match.start()]))
+        return changes
 
-class Infrastructure:
-    def __init__(self):
-        self.power_grid = set()
-        self.road_network = set()
-        self.water_grid = set()
-        
     def to_dict(self) -> dict:
         return {
-            'power_grid': list(self.power_grid),
-            'road_network': list(self.road_network),
-            'water_grid': list(self.water_grid)
+            'chunk_size': CHUNK_SIZE,
+            'chunks': [[cx, cy, base64.b64encode(zlib.compress(bytes(self._chunk((cx, cy))))).decode('ascii')]
+                       for cx, cy in self.chunk_keys()]
         }
+
+    @classmethod
+    def from_dict(cls, data: dict, size: int, max_value: int = 255):
+        if data['chunk_size'] != CHUNK_SIZE:
+            raise ValueError(f"Unsupported chunk size {data['chunk_size']}")
+        layer = cls(size, max_value)
+        for cx, cy, encoded in data['chunks']:
+            layer.chunks[(cx, cy)] = bytearray(zlib.decompress(base64.b64decode(encoded)))
+            layer.dirty_chunks.add((cx, cy))
+        return layer
+
+    def chunk_keys(self) -> List[Tuple[int, int]]:
+        """Keys of every non-empty chunk, loaded or still mapped, in file order."""
+        return sorted(set(self.chunks) | set(self.mapped))
+
+    def write_chunks(self, f, keys: List[Tuple[int, int]]):
+        for key in keys:
+            f.write(self._chunk(key))
+
+    @classmethod
+    def from_buffer(cls, buffer, base: int, table: List[list], size: int, max_value: int = 255):
+        """Layer whose chunks are read from `buffer` (e.g. an mmap) the first time they are used."""
+        layer = cls(size, max_value)
+        layer.buffer = buffer
+        for cx, cy, offset in table:
+            layer.mapped[(cx, cy)] = base + offset
+            layer.dirty_chunks.add((cx, cy))
+        return layer
+
+
+_NONZERO_CELL = re.compile(b'[^\\x00]')
+
+# Infrastructure networks share one layer, one bit per network
+INFRA_BITS = {'POWER': 1, 'ROAD': 2, 'WATER': 4}
+FULLY_CONNECTED = 7
+# Building that feeds each utility into tiles on or next to it. Roads have
+# no source: every road tile gives access where it is.
+NETWORK_SOURCES = {'POWER': 'E', 'WATER': 'T'}
+SOURCE_BUILDINGS = set(NETWORK_SOURCES.values())
+
+
+def _neighbors(x: int, y: int):
+    return ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1))
+
+
+class NetworkView:
+    """Read-only, set-like view of the cells carrying one network."""
+
+    def __init__(self, layer: GridLayer, bit: int):
+        self.layer = layer
+        self.bit = bit
+
+    def __contains__(self, cell) -> bool:
+        x, y = cell
+        if not (0 <= x < self.layer.size and 0 <= y < self.layer.size):
+            return False
+        return bool(self.layer.get(x, y) & self.bit)
+
+    def __len__(self) -> int:
+        return sum(self.layer.count(value) for value in range(FULLY_CONNECTED + 1) if value & self.bit)
+
+    def __iter__(self):
+        for x, y, value in self.layer.nonzero():
+            if value & self.bit:
+                yield (x, y)
+
+
+class NetworkComponents:
+    """Union-find over the tiles of one network, tracking which components reach a source."""
+
+    def __init__(self):
+        # Tile -> its node in the forest. A removed tile's node stays behind,
+        # so the nodes under it still lead to their root, until _compact()
+        self.nodes: Dict[Tuple[int, int], int] = {}
+        self.parent: List[int] = []
+        # Root node -> the tiles of its component
+        self.members: Dict[int, set] = {}
+        self.fed_tiles = set()
+        self.fed_count: Dict[int, int] = {}
+
+    def _root(self, node: int) -> int:
+        parent = self.parent
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def _new_node(self, root: int = None) -> int:
+        node = len(self.parent)
+        self.parent.append(node if root is None else root)
+        return node
+
+    def find(self, tile: Tuple[int, int]) -> int:
+        return self._root(self.nodes[tile])
+
+    def is_live(self, tile: Tuple[int, int]) -> bool:
+        return tile in self.nodes and self.fed_count[self.find(tile)] > 0
+
+    def add(self, tile: Tuple[int, int], fed: bool) -> List[Tuple[int, int]]:
+        """Add a tile; returns the tiles that became supplied."""
+        node = self.nodes[tile] = self._new_node()
+        self.members[node] = {tile}
+        self.fed_count[node] = 1 if fed else 0
+        if fed:
+            self.fed_tiles.add(tile)
+        roots = {node}
+        for neighbor in _neighbors(*tile):
+            if neighbor in self.nodes:
+                roots.add(self.find(neighbor))
+        gained = []
+        if any(self.fed_count[root] for root in roots):
+            gained.append(tile)
+            for root in roots:
+                if root != node and not self.fed_count[root]:
+                    gained.extend(self.members[root])
+        # Union by size: the smaller member sets move into the largest
+        largest = max(roots, key=lambda root: len(self.members[root]))
+        for root in roots:
+            if root != largest:
+                self.parent[root] = largest
+                self.members[largest].update(self.members.pop(root))
+                self.fed_count[largest] += self.fed_count.pop(root)
+        return gained
+
+    def remove(self, tile: Tuple[int, int]) -> List[Tuple[int, int]]:
+        """Remove a tile; returns the tiles that lost supply, including the tile itself."""
+        root = self.find(tile)
+        del self.nodes[tile]
+        members = self.members[root]
+        members.discard(tile)
+        was_live = self.fed_count[root] > 0
+        if tile in self.fed_tiles:
+            self.fed_tiles.discard(tile)
+            self.fed_count[root] -= 1
+        lost = [tile] if was_live else []
+        if not members:
+            del self.members[root], self.fed_count[root]
+            return lost
+        # Pieces that came apart get new roots; the rest keeps the old one
+        for piece in self._split_off([neighbor for neighbor in _neighbors(*tile) if neighbor in self.nodes]):
+            piece_root = self.nodes[piece[0]] = self._new_node()
+            fed = 0
+            for member in piece:
+                if member != piece[0]:
+                    self.nodes[member] = self._new_node(piece_root)
+                if member in self.fed_tiles:
+                    fed += 1
+            members.difference_update(piece)
+            self.members[piece_root] = set(piece)
+            self.fed_count[piece_root] = fed
+            self.fed_count[root] -= fed
+            if was_live and not fed:
+                lost.extend(piece)
+        if was_live and not self.fed_count[root]:
+            lost.extend(members)
+        if len(self.parent) > 2 * len(self.nodes) + 64:
+            self._compact()
+        return lost
+
+    def _split_off(self, starts: List[Tuple[int, int]]) -> List[List[Tuple[int, int]]]:
+        """The tiles of every piece but one that `starts`, the neighbours of a removed tile, fall into."""
+        # One search per start, a tile at a time in turn; searches that meet
+        # merge, and one that runs out of tiles first is a piece of its own, so
+        # the work follows the smaller pieces and the largest is never walked
+        owner = {start: index for index, start in enumerate(starts)}
+        alias = list(range(len(starts)))
+        searches = [(deque([start]), [start]) for start in starts]
+        active = list(range(len(starts)))
+        pieces = []
+        while len(active) > 1:
+            for index in list(active):
+                if alias[index] != index:
+                    continue
+                frontier, tiles = searches[index]
+                if not frontier:
+                    active.remove(index)
+                    pieces.append(tiles)
+                    if len(active) == 1:
+                        break
+                    continue
+                current = frontier.popleft()
+                for neighbor in _neighbors(*current):
+                    if neighbor not in self.nodes:
+                        continue
+                    other = owner.get(neighbor)
+                    if other is None:
+                        owner[neighbor] = index
+                        frontier.append(neighbor)
+                        tiles.append(neighbor)
+                        continue
+                    while alias[other] != other:
+                        other = alias[other]
+                    if other != index:
+                        alias[other] = index
+                        frontier.extend(searches[other][0])
+                        tiles.extend(searches[other][1])
+                        active.remove(other)
+                if len(active) == 1:
+                    break
+        return pieces
+
+    def _compact(self):
+        """Rebuild the forest without the nodes that removed tiles left behind."""
+        self.parent = []
+        self.nodes = {}
+        members, fed_count = {}, {}
+        for root, tiles in self.members.items():
+            new_root = len(self.parent)
+            for tile in tiles:
+                self.nodes[tile] = len(self.parent)
+                self.parent.append(new_root)
+            members[new_root] = tiles
+            fed_count[new_root] = self.fed_count[root]
+        self.members, self.fed_count = members, fed_count
+
+    def set_fed(self, tile: Tuple[int, int], fed: bool) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+        """Mark a tile as touching a source or not; returns (gained, lost) tiles."""
+        if (tile in self.fed_tiles) == fed:
+            return [], []
+        root = self.find(tile)
+        was_live = self.fed_count[root] > 0
+        if fed:
+            self.fed_tiles.add(tile)
+            self.fed_count[root] += 1
+        else:
+            self.fed_tiles.discard(tile)
+            self.fed_count[root] -= 1
+        if was_live == (self.fed_count[root] > 0):
+            return [], []
+        return (list(self.members[root]), []) if fed else ([], list(self.members[root]))
+
+
+# A road tile carries this many homes' commuters per turn at full speed;
+# each further batch of that size adds a turn to crossing it
+ROAD_CAPACITY = 8
+# Happiness lost when congestion doubles the average commute
+COMMUTE_HAPPINESS = 15
+# Road tiles whose home count or destination flag can change when a road
+# (radius 2) or a building (radius 1) changes at the centre
+_DIAMONDS = {radius: [(dx, dy) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)
+                      if abs(dx) + abs(dy) <= radius]
+             for radius in (1, 2)}
+
+
+class TrafficModel:
+    """Commutes from homes to the nearest commercial or industrial building along the roads."""
+    # Road tiles whose distance or load was recomputed, across every model
+    tiles_solved = 0
+
+    def __init__(self, infrastructure: 'Infrastructure'):
+        self.infrastructure = infrastructure
+        # Tiles are numbered x + y * stride; the spare column keeps x + 1 and
+        # x - 1 from wrapping onto the next or previous row
+        self.stride = infrastructure.layer.size + 1
+        # Road tile -> steps to the nearest destination, for the tiles that
+        # reach one; built on first refresh
+        self.distance: Dict[int, int] = None
+        # Road tile -> the tile it steps to (the neighbour one closer that
+        # comes first in row order), and the commuters crossing it
+        self.step: Dict[int, int] = {}
+        self.load: Dict[int, int] = {}
+        # Road tile -> its share of the totals
+        self.terms: Dict[int, Tuple[int, int, int, int]] = {}
+        self.roads = set()
+        self.dirty = set()
+        # Sums over the tiles; a binary save restores them without any tiles
+        self.totals = None
+        # Road tile -> number of homes entering the roads there, and the
+        # road tiles on or next to a job
+        self.origins: Dict[int, int] = {}
+        self.destinations = set()
+
+    def invalidate(self, x: int, y: int, radius: int):
+        """Re-read the tiles near (x, y) on the next refresh; call for roads and buildings changing there."""
+        if self.distance is None:
+            self.totals = None
+            return
+        size = self.stride - 1
+        for dx, dy in _DIAMONDS[radius]:
+            tx, ty = x + dx, y + dy
+            if 0 <= tx < size and 0 <= ty < size:
+                self.dirty.add(tx + ty * self.stride)
+
+    def refresh(self) -> Tuple[int, int, int, int]:
+        """(commuters, travel time, free-flow time, congested tiles) summed over the city."""
+        if self.distance is None:
+            if self.totals is not None:
+                return self.totals
+            self.distance = {}
+            self.totals = (0, 0, 0, 0)
+            road = INFRA_BITS['ROAD']
+            self.dirty = {x + y * self.stride for x, y, value in self.infrastructure.layer.nonzero() if value & road}
+        if self.dirty:
+            self._repair()
+        return self.totals
+
+    def frontage(self, x: int, y: int) -> Tuple[int, int]:
+        """The road tile a building at (x, y) is reached through, or None."""
+        layer = self.infrastructure.layer
+        road = INFRA_BITS['ROAD']
+        for tx, ty in ((x, y),) + _neighbors(x, y):
+            if 0 <= tx < layer.size and 0 <= ty < layer.size and layer.get(tx, ty) & road:
+                return (tx, ty)
+        return None
+
+    def _read_tile(self, tile: int):
+        """Refresh the road flag, destination flag and home count of one tile from the grid."""
+        self.roads.discard(tile)
+        self.origins.pop(tile, None)
+        self.destinations.discard(tile)
+        y, x = divmod(tile, self.stride)
+        if not self.infrastructure.layer.get(x, y) & INFRA_BITS['ROAD']:
+            return
+        self.roads.add(tile)
+        grid = self.infrastructure.grid_layer
+        size = grid.size
+        jobs = (BUILDING_CODES['C'], BUILDING_CODES['I'])
+        home = BUILDING_CODES['R']
+        homes = 0
+        for cx, cy in ((x, y),) + _neighbors(x, y):
+            if 0 <= cx < size and 0 <= cy < size:
+                code = grid.get(cx, cy)
+                if code in jobs:
+                    self.destinations.add(tile)
+                elif code == home and self.frontage(cx, cy) == (x, y):
+                    homes += 1
+        if homes:
+            self.origins[tile] = homes
+
+    def _repair(self):
+        """Bring distances, steps, loads and totals up to date with the dirty tiles."""
+        # Distances are repaired outwards from the dirty tiles and load changes
+        # passed down the steps, so the work follows what changed, not the network size
+        stride = self.stride
+        roads, destinations, origins = self.roads, self.destinations, self.origins
+        distance, step, load, terms = self.distance, self.step, self.load, self.terms
+        dirty = self.dirty
+        self.dirty = set()
+        for tile in dirty:
+            self._read_tile(tile)
+        # Distance before this repair of every tile it touches
+        before = {}
+        # Drop the distances that have lost the neighbour one step closer
+        # that they were built on, and then those built on them
+        pending = list(dirty)
+        raised = []
+        while pending:
+            tile = pending.pop()
+            current = distance.get(tile)
+            if current is None:
+                continue
+            if tile in roads and (tile in destinations or any(
+                    distance.get(neighbor) == current - 1 and neighbor in roads
+                    for neighbor in (tile + 1, tile - 1, tile + stride, tile - stride))):
+                continue
+            before.setdefault(tile, current)
+            del distance[tile]
+            raised.append(tile)
+            for neighbor in (tile + 1, tile - 1, tile + stride, tile - stride):
+                if distance.get(neighbor) == current + 1:
+                    pending.append(neighbor)
+        # Then fill them, and the changed tiles, in from the destinations and
+        # the untouched tiles around them, one distance at a time
+        levels = defaultdict(list)
+        for tile in itertools.chain(dirty, raised):
+            if tile not in roads:
+                continue
+            if tile in destinations:
+                reached = 0
+            else:
+                reached = min((distance[neighbor] for neighbor in (tile + 1, tile - 1, tile + stride, tile - stride)
+                               if neighbor in distance and neighbor not in before), default=None)
+                if reached is None:
+                    continue
+                reached += 1
+            if reached < distance.get(tile, reached + 1):
+                before.setdefault(tile, distance.get(tile))
+                distance[tile] = reached
+                levels[reached].append(tile)
+        while levels:
+            reached = min(levels)
+            tiles = levels.pop(reached)
+            following = []
+            for tile in tiles:
+                if distance[tile] != reached:
+                    continue
+                for neighbor in (tile + 1, tile - 1, tile + stride, tile - stride):
+                    if neighbor in roads and reached + 1 < distance.get(neighbor, reached + 2):
+                        before.setdefault(neighbor, distance.get(neighbor))
+                        distance[neighbor] = reached + 1
+                        following.append(neighbor)
+            if following:
+                levels[reached + 1].extend(following)
+        changed = {tile for tile, old in before.items() if distance.get(tile) != old}
+        # Tiles whose next step may be another now, and whose load and share of the totals must be recounted
+        steps = set(changed)
+        for tile in changed:
+            steps.update((tile + 1, tile - 1, tile + stride, tile - stride))
+        recount = set(changed)
+        recount.update(dirty)
+        for tile in steps:
+            current = distance.get(tile)
+            if current:
+                closer = current - 1
+                new = min(neighbor for neighbor in (tile + 1, tile - 1, tile + stride, tile - stride)
+                          if distance.get(neighbor) == closer)
+            else:
+                new = None
+            old = step.get(tile)
+            if new != old:
+                if new is None:
+                    del step[tile]
+                else:
+                    step[tile] = new
+                    recount.add(new)
+                if old is not None:
+                    recount.add(old)
+        # Loads only flow from a tile to its step, one closer, so counting the
+        # farthest tiles first sees every neighbour's final load
+        commuters, total_time, free_flow_time, congested = self.totals
+        levels = defaultdict(list)
+        for tile in recount:
+            if tile in distance:
+                levels[distance[tile]].append(tile)
+            else:
+                load.pop(tile, None)
+                term = terms.pop(tile, None)
+                if term is not None:
+                    commuters -= term[0]
+                    total_time -= term[1]
+                    free_flow_time -= term[2]
+                    congested -= term[3]
+        queued = set(recount)
+        solved = len(changed)
+        for reached in range(max(levels, default=-1), -1, -1):
+            for tile in levels.pop(reached, ()):
+                solved += 1
+                homes = origins.get(tile, 0)
+                tile_load = homes
+                for neighbor in (tile + 1, tile - 1, tile + stride, tile - stride):
+                    if step.get(neighbor) == tile:
+                        tile_load += load.get(neighbor, 0)
+                term = terms.pop(tile, None)
+                if term is not None:
+                    commuters -= term[0]
+                    total_time -= term[1]
+                    free_flow_time -= term[2]
+                    congested -= term[3]
+                if tile_load:
+                    term = terms[tile] = (homes, (1 + (tile_load - 1) // ROAD_CAPACITY) * tile_load,
+                                          homes * (reached + 1), 1 if tile_load > ROAD_CAPACITY else 0)
+                    commuters += term[0]
+                    total_time += term[1]
+                    free_flow_time += term[2]
+                    congested += term[3]
+                if tile_load != load.get(tile, 0):
+                    load[tile] = tile_load
+                    following = step.get(tile)
+                    if following is not None and following not in queued:
+                        queued.add(following)
+                        levels[reached - 1].append(following)
+        self.totals = (commuters, total_time, free_flow_time, congested)
+        TrafficModel.tiles_solved += solved
+
+
+class Infrastructure:
+    def __init__(self, grid_size: int = 10, layer: GridLayer = None, grid_layer: GridLayer = None):
+        self.layer = layer if layer is not None else GridLayer(grid_size, FULLY_CONNECTED)
+        # The city's building layer, where the source buildings are looked up
+        self.grid_layer = grid_layer
+        self.power_grid = NetworkView(self.layer, INFRA_BITS['POWER'])
+        self.road_network = NetworkView(self.layer, INFRA_BITS['ROAD'])
+        self.water_grid = NetworkView(self.layer, INFRA_BITS['WATER'])
+        # Per network connectivity, built on first use after a load, and a
+        # layer with one bit per network that is set where a tile is supplied
+        self.networks: Dict[str, NetworkComponents] = None
+        self.live_layer = GridLayer(self.layer.size, FULLY_CONNECTED)
+        # Number of cells where power, road and water are all supplied
+        self.connected_count = 0
+        self.traffic = TrafficModel(self)
+        
+    def to_dict(self) -> dict:
+        return {'layer': self.layer.to_dict()}
     
     @classmethod
-    def from_dict(cls, data: dict):
-        infrastructure = cls()
-        infrastructure.power_grid = set(tuple(x) for x in data['power_grid'])
-        infrastructure.road_network = set(tuple(x) for x in data['road_network'])
-        infrastructure.water_grid = set(tuple(x) for x in data['water_grid'])
+    def from_dict(cls, data: dict, grid_size: int = 10, grid_layer: GridLayer = None):
+        if 'layer' in data:
+            infrastructure = cls(grid_size, GridLayer.from_dict(data['layer'], grid_size, FULLY_CONNECTED),
+                                 grid_layer)
+            infrastructure.ensure_networks()
+            return infrastructure
+        # Saves from before chunked storage list each network's cells
+        infrastructure = cls(grid_size, grid_layer=grid_layer)
+        for key, infra_type in [('power_grid', 'POWER'), ('road_network', 'ROAD'), ('water_grid', 'WATER')]:
+            for x, y in data[key]:
+                infrastructure.add_connection(x, y, infra_type)
         return infrastructure
+
+    def ensure_networks(self):
+        """Build the connectivity structures from the layer if they don't exist yet."""
+        if self.networks is not None:
+            return
+        self.networks = {infra_type: NetworkComponents() for infra_type in INFRA_BITS}
+        self.live_layer = GridLayer(self.layer.size, FULLY_CONNECTED)
+        self.connected_count = 0
+        for x, y, value in self.layer.nonzero():
+            for infra_type, bit in INFRA_BITS.items():
+                if value & bit:
+                    self._set_live(self.networks[infra_type].add((x, y), self._is_fed(x, y, infra_type)), bit, True)
+
+    def _is_fed(self, x: int, y: int, infra_type: str) -> bool:
+        if infra_type == 'ROAD':
+            return True
+        if self.grid_layer is None:
+            return False
+        source = BUILDING_CODES[NETWORK_SOURCES[infra_type]]
+        if self.grid_layer.get(x, y) == source:
+            return True
+        return any(self.in_bounds(nx, ny) and self.grid_layer.get(nx, ny) == source
+                   for nx, ny in _neighbors(x, y))
+
+    def _set_live(self, tiles: List[Tuple[int, int]], bit: int, live: bool):
+        layer = self.live_layer
+        for x, y in tiles:
+            value = layer.get(x, y)
+            new_value = value | bit if live else value & ~bit
+            if new_value == value:
+                continue
+            if value == FULLY_CONNECTED:
+                self.connected_count -= 1
+            elif new_value == FULLY_CONNECTED:
+                self.connected_count += 1
+            layer.set(x, y, new_value)
+
+    def update_sources(self, x: int, y: int):
+        """Re-check supply around (x, y) after a source building appeared or vanished there."""
+        self.ensure_networks()
+        for infra_type in NETWORK_SOURCES:
+            bit = INFRA_BITS[infra_type]
+            network = self.networks[infra_type]
+            for tx, ty in ((x, y),) + _neighbors(x, y):
+                if self.in_bounds(tx, ty) and self.layer.get(tx, ty) & bit:
+                    gained, lost = network.set_fed((tx, ty), self._is_fed(tx, ty, infra_type))
+                    self._set_live(gained, bit, True)
+                    self._set_live(lost, bit, False)
+
+    def is_serviced(self, x: int, y: int) -> bool:
+        """Whether (x, y) gets power, road access and water from a source."""
+        if not self.in_bounds(x, y):
+            return False
+        self.ensure_networks()
+        return self.live_layer.get(x, y) == FULLY_CONNECTED
+
+    def count_connected(self) -> int:
+        """Full rescan: flood each network from its sources and count cells supplied by all three."""
+        supplied = None
+        for infra_type, bit in INFRA_BITS.items():
+            tiles = {(x, y) for x, y, value in self.layer.nonzero() if value & bit}
+            reached = [tile for tile in tiles if self._is_fed(*tile, infra_type)]
+            seen = set(reached)
+            for current in reached:
+                for neighbor in _neighbors(*current):
+                    if neighbor in tiles and neighbor not in seen:
+                        seen.add(neighbor)
+                        reached.append(neighbor)
+            supplied = seen if supplied is None else supplied & seen
+        return len(supplied)
         
     def add_connection(self, x: int, y: int, infra_type: str):
-        if infra_type == 'POWER':
-            self.power_grid.add((x, y))
-        elif infra_type == 'ROAD':
-            self.road_network.add((x, y))
-        elif infra_type == 'WATER':
-            self.water_grid.add((x, y))
+        bit = INFRA_BITS.get(infra_type)
+        if bit is None or not self.in_bounds(x, y):
+            return
+        value = self.layer.get(x, y)
+        if value & bit:
+            return
+        self.ensure_networks()
+        if infra_type == 'ROAD':
+            self.traffic.invalidate(x, y, 2)
+        self.layer.set(x, y, value | bit)
+        self._set_live(self.networks[infra_type].add((x, y), self._is_fed(x, y, infra_type)), bit, True)
             
     def remove_connection(self, x: int, y: int, infra_type: str):
-        if infra_type == 'POWER':
-            self.power_grid.discard((x, y))
-        elif infra_type == 'ROAD':
-            self.road_network.discard((x, y))
-        elif infra_type == 'WATER':
-            self.water_grid.discard((x, y))
+        bit = INFRA_BITS.get(infra_type)
+        if bit is None or not self.in_bounds(x, y):
+            return
+        value = self.layer.get(x, y)
+        if not value & bit:
+            return
+        self.ensure_networks()
+        if infra_type == 'ROAD':
+            self.traffic.invalidate(x, y, 2)
+        self.layer.set(x, y, value & ~bit)
+        self._set_live(self.networks[infra_type].remove((x, y)), bit, False)
             
     def has_connection(self, x: int, y: int, infra_type: str) -> bool:
-        if infra_type == 'POWER':
-            return (x, y) in self.power_grid
-        elif infra_type == 'ROAD':
-            return (x, y) in self.road_network
-        elif infra_type == 'WATER':
-            return (x, y) in self.water_grid
-        return False
+        bit = INFRA_BITS.get(infra_type)
+        if bit is None or not self.in_bounds(x, y):
+            return False
+        return bool(self.layer.get(x, y) & bit)
+
+    def in_bounds(self, x: int, y: int) -> bool:
+        return 0 <= x < self.layer.size and 0 <= y < self.layer.size
+
+# Economy sectors, which events can target
+SECTORS = ['R', 'C', 'I']
 
 class Economy:
     def __init__(self):
@@ -62,6 +933,9 @@ class Economy:
             'C': {'jobs': 0, 'income': 0},
             'I': {'jobs': 0, 'income': 0}
         }
+        # (sector, jobs, income) traded with neighbouring cities, added to what
+        # the city's own buildings make; set by a region before each turn
+        self.trade: Tuple[Tuple[str, float, float], ...] = ()
     
     def to_dict(self) -> dict:
         return {
@@ -69,7 +943,8 @@ class Economy:
             'gdp': self.gdp,
             'inflation_rate': self.inflation_rate,
             'business_confidence': self.business_confidence,
-            'sectors': self.sectors
+            'sectors': self.sectors,
+            'trade': [list(flow) for flow in self.trade]
         }
     
     @classmethod
@@ -80,17 +955,26 @@ class Economy:
         economy.inflation_rate = data['inflation_rate']
         economy.business_confidence = data['business_confidence']
         economy.sectors = data['sectors']
+        economy.trade = tuple(tuple(flow) for flow in data.get('trade', ()))
         return economy
         
-    def update_economy(self, building_counts: Dict[str, int], population: int):
+    def update_economy(self, building_counts: Dict[str, int], population: int, productivity: float = 1.0,
+                       sector_productivity: Tuple[Tuple[str, float], ...] = ()):
         # Update jobs and income for each sector
         self.sectors['R']['jobs'] = building_counts['R'] * 5
         self.sectors['C']['jobs'] = building_counts['C'] * 20
         self.sectors['I']['jobs'] = building_counts['I'] * 50
         
         self.sectors['R']['income'] = building_counts['R'] * 1000
-        self.sectors['C']['income'] = building_counts['C'] * 2000 * self.business_confidence
-        self.sectors['I']['income'] = building_counts['I'] * 5000 * self.business_confidence
+        # Congested commutes make businesses less productive
+        self.sectors['C']['income'] = building_counts['C'] * 2000 * self.business_confidence * productivity
+        self.sectors['I']['income'] = building_counts['I'] * 5000 * self.business_confidence * productivity
+        # Lasting events scale the output of the sectors they target
+        for sector, factor in sector_productivity:
+            self.sectors[sector]['income'] *= factor
+        for sector, jobs, income in self.trade:
+            self.sectors[sector]['jobs'] += jobs
+            self.sectors[sector]['income'] += income
         
         self.gdp = sum(sector['income'] for sector in self.sectors.values())
         
@@ -101,59 +985,826 @@ class Economy:
         
         return self.calculate_tax_income(population)
     
+    def get_state(self) -> tuple:
+        """Snapshot of everything update_economy writes."""
+        return (self.gdp, self.employment_rate, self.business_confidence,
+                tuple((sector, data['jobs'], data['income']) for sector, data in self.sectors.items()))
+
+    def set_state(self, state: tuple):
+        self.gdp, self.employment_rate, self.business_confidence, sectors = state
+        for sector, jobs, income in sectors:
+            self.sectors[sector]['jobs'] = jobs
+            self.sectors[sector]['income'] = income
+
     def calculate_tax_income(self, population: int) -> float:
         residential_tax = self.sectors['R']['income'] * 0.05
         commercial_tax = self.sectors['C']['income'] * 0.08
         industrial_tax = self.sectors['I']['income'] * 0.12
         return residential_tax + commercial_tax + industrial_tax
 
+# Random events, loaded once into EVENTS. Each may start on any turn with
+# its `chance`, then not again for `cooldown` turns. `duration` keeps it
+# active for that many turns, scaling the income of the Economy `sectors`
+# it targets (all of them by default) by `productivity` meanwhile.
+# `region` picks a random square of that radius around the fields x and y.
+# The effect is a City method called with `args` (and `region=`), and may
+# return extra fields for the message.
+EVENT_DEFINITIONS = [
+    {'key': 'boom', 'message': "Economic boom! Businesses are thriving.", 'chance': 0.025,
+     'effect': 'apply_economic_event', 'args': [1000, 0.1, 0.05]},
+    {'key': 'recession', 'message': "Recession hits the city.", 'chance': 0.02, 'cooldown': 20,
+     'duration': 8, 'productivity': 0.8, 'sectors': ['C', 'I'], 'effect': 'apply_economic_event',
+     'args': [-500, -0.05, -0.1]},
+    {'key': 'technology', 'message': "New technology brings efficiency improvements.", 'chance': 0.025,
+     'effect': 'reduce_maintenance_costs', 'args': [0.9]},
+    {'key': 'aging', 'message': "Infrastructure aging causes increased maintenance.", 'chance': 0.025,
+     'effect': 'increase_maintenance_costs', 'args': [1.1]},
+    {'key': 'decay', 'message': "Urban decay around ({x}, {y}): {buildings} buildings lose their upgrades.",
+     'chance': 0.01, 'cooldown': 30, 'region': 4, 'effect': 'apply_urban_decay'},
+]
+EVENT_FIELDS = {'key', 'message', 'chance', 'cooldown', 'duration', 'productivity', 'sectors', 'region',
+                'effect', 'args'}
+STATS_MEMO_SIZE = 64
+
+
+def load_event_definitions(definitions: List[dict]) -> Dict[str, dict]:
+    """Check event definitions and precompute what sampling them needs, by key."""
+    events = {}
+    for definition in definitions:
+        event = {'cooldown': 0, 'duration': 0, 'productivity': 1.0, 'sectors': SECTORS, 'args': []}
+        event.update(definition)
+        if not 0 < event['chance'] < 1:
+            raise ValueError(f"Event {event['key']!r} needs a chance between 0 and 1")
+        unknown = set(event['sectors']) - set(SECTORS)
+        if unknown:
+            raise ValueError(f"Event {event['key']!r} targets unknown sectors {sorted(unknown)}")
+        unknown = set(event) - EVENT_FIELDS
+        if unknown:
+            raise ValueError(f"Event {event['key']!r} has unknown fields {sorted(unknown)}")
+        effect = getattr(City, event['effect'], None)
+        if event['effect'].startswith('_') or not callable(effect):
+            raise ValueError(f"Event {event['key']!r} has unknown effect {event['effect']!r}")
+        # Bind now so a bad definition fails on loading, not on the turn it fires
+        targets = {'region': None} if 'region' in event else {}
+        try:
+            inspect.signature(effect).bind(None, *event['args'], **targets)
+        except TypeError as error:
+            raise ValueError(f"Event {event['key']!r} can't call {event['effect']}: {error}") from None
+        # For drawing the turns until the next start from a geometric distribution
+        event['log_miss'] = math.log(1 - event['chance'])
+        events[event['key']] = event
+    return events
+
+
+class EventScheduler:
+    """Priority queue of the turns on which events next start and lasting events end."""
+
+    def __init__(self, events: Dict[str, dict] = None):
+        self.events = EVENTS if events is None else events
+        # (turn, 0 for an end or 1 for a start, event key)
+        self.queue: List[Tuple[int, int, str]] = []
+        # (end turn, key) of the lasting events in progress
+        self.active: List[Tuple[int, str]] = []
+        # (sector, factor) for every sector whose productivity the active events change
+        self.productivity: Tuple[Tuple[str, float], ...] = ()
+        self.next_turn = math.inf
+
+    def start(self, rng: random.Random, turn: int):
+        """Draw a fresh start for every event after `turn`, keeping the lasting events in progress."""
+        self.queue = [entry for entry in self.queue if entry[1] == 0]
+        heapq.heapify(self.queue)
+        for key in self.events:
+            self._schedule(key, turn, rng)
+        self._update()
+
+    def _schedule(self, key: str, turn: int, rng: random.Random):
+        # The wait is drawn geometrically up front, so a turn with nothing
+        # due costs one comparison against next_turn
+        event = self.events[key]
+        wait = 1 + int(math.log(1.0 - rng.random()) / event['log_miss'])
+        heapq.heappush(self.queue, (turn + event['cooldown'] + wait, 1, key))
+
+    def _update(self):
+        self.next_turn = self.queue[0][0] if self.queue else math.inf
+        factors = dict.fromkeys(SECTORS, 1.0)
+        for _, key in sorted(self.active):
+            event = self.events[key]
+            for sector in event['sectors']:
+                factors[sector] *= event['productivity']
+        self.productivity = tuple((sector, factor) for sector, factor in factors.items() if factor != 1.0)
+
+    def fire_due(self, city: 'City') -> Tuple[str, str]:
+        """Apply everything due by the city's turn; returns the (key, message) of the event started, if any."""
+        turn = city.time_elapsed
+        started = None
+        while self.queue and self.queue[0][0] <= turn:
+            due, order, key = heapq.heappop(self.queue)
+            event = self.events.get(key)
+            if event is None:
+                continue  # from a save made with other definitions
+            if order == 0:
+                self.active.remove((due, key))
+            elif started is not None:
+                # At most one event starts per turn; the others wait a turn
+                heapq.heappush(self.queue, (turn + 1, 1, key))
+            else:
+                started = key, self._apply(city, event)
+                self._schedule(key, turn, city.rng)
+        self._update()
+        return started
+
+    def _apply(self, city: 'City', event: dict) -> str:
+        targets = {}
+        fields = {}
+        if 'region' in event:
+            x, y = city.rng.randrange(city.grid_size), city.rng.randrange(city.grid_size)
+            radius = event['region']
+            targets['region'] = (x - radius, y - radius, x + radius, y + radius)
+            fields.update(x=x, y=y)
+        fields.update(getattr(city, event['effect'])(*event['args'], **targets) or {})
+        if event['duration']:
+            end = city.time_elapsed + event['duration']
+            self.active.append((end, event['key']))
+            heapq.heappush(self.queue, (end, 0, event['key']))
+        return event['message'].format(**fields)
+
+    def get_state(self) -> dict:
+        return {'queue': [list(entry) for entry in sorted(self.queue)],
+                'active': [list(entry) for entry in self.active]}
+
+    def set_state(self, state: dict, rng: random.Random, turn: int):
+        """Restore a saved queue, drawing a start after `turn` for every event it has none for."""
+        self.queue = [tuple(entry) for entry in state['queue']]
+        heapq.heapify(self.queue)
+        self.active = [tuple(entry) for entry in state['active'] if entry[1] in self.events]
+        # Events defined since the state was saved
+        scheduled = {key for _, order, key in self.queue if order == 1}
+        for key in self.events:
+            if key not in scheduled:
+                self._schedule(key, turn, rng)
+        self._update()
+
+
+BUILDING_TYPES = ['R', 'C', 'I', 'P', 'H', 'S', 'F', 'E', 'T']
+# Services benefit the homes within their radius (Euclidean, in cells);
+# happiness gains the weight times the share of homes covered.
+SERVICE_RADII = {'P': 3, 'H': 6, 'S': 5, 'F': 5}
+SERVICE_HAPPINESS = {'P': 15, 'H': 25, 'S': 20, 'F': 10}
+# Homes and the jobs their residents commute to
+COMMUTE_BUILDINGS = {'R', 'C', 'I'}
+SERVICE_STAMPS = {
+    service: [(dx, dy) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)
+              if dx * dx + dy * dy <= radius * radius]
+    for service, radius in SERVICE_RADII.items()
+}
+# uint8 codes stored in the grid layer; 0 is an empty cell
+BUILDING_CODES = {building_type: code for code, building_type in enumerate(BUILDING_TYPES, start=1)}
+BUILDING_CODES[None] = 0
+CODE_TO_BUILDING = {code: building_type for building_type, code in BUILDING_CODES.items()}
+# Zone growth: R, C and I buildings move one density level per turn towards
+# the level the land value of their cell supports. Land value is
+# LAND_VALUE_BASE plus, over the square of LAND_VALUE_RADIUS around the
+# cell, the weights of its buildings and SERVICED_LAND_VALUE for every
+# cell with power, road and water, less POLLUTION_LAND_VALUE per
+# industrial building. Industry itself doesn't mind the pollution.
+ZONE_TYPES = ['R', 'C', 'I']
+MAX_DENSITY = 3
+LAND_VALUE_RADIUS = 3
+LAND_VALUE_BASE = 0
+LAND_VALUE_WEIGHTS = {'P': 8, 'H': 6, 'S': 6, 'F': 4}
+SERVICED_LAND_VALUE = 2
+POLLUTION_LAND_VALUE = 6
+# Land value each zone needs for density levels 2 and 3
+DENSITY_THRESHOLDS = {'R': (40, 90), 'C': (50, 100), 'I': (30, 70)}
+# The same by building code, so the growth pass can look them up per cell
+_CODE_LAND_VALUE = [LAND_VALUE_WEIGHTS.get(CODE_TO_BUILDING.get(code), 0) for code in range(256)]
+_CODE_THRESHOLDS = [DENSITY_THRESHOLDS.get(CODE_TO_BUILDING.get(code), (1 << 30,) * (MAX_DENSITY - 1))
+                    for code in range(256)]
+
+
+def _box_sums(rows: List[List[int]], radius: int) -> List[List[int]]:
+    """Sum of the square of `radius` around every cell; cells off the rows count as 0."""
+    height = len(rows)
+    width = len(rows[0]) if rows else 0
+    horizontal = []
+    for row in rows:
+        running = list(itertools.accumulate(row, initial=0))
+        horizontal.append([running[min(x + radius + 1, width)] - running[max(x - radius, 0)] for x in range(width)])
+    running = list(itertools.accumulate(horizontal, lambda total, row: [a + b for a, b in zip(total, row)],
+                                        initial=[0] * width))
+    return [[a - b for a, b in zip(running[min(y + radius + 1, height)], running[max(y - radius, 0)])]
+            for y in range(height)]
+
+
+def _box_sums_array(values: 'np.ndarray', radius: int) -> 'np.ndarray':
+    """_box_sums for a NumPy array, from running sums along each axis."""
+    window = 2 * radius + 1
+    sums = np.pad(values, ((radius + 1, radius), (radius + 1, radius))).cumsum(axis=0, dtype=np.int32)
+    sums = sums[window:] - sums[:-window]
+    sums = sums.cumsum(axis=1, dtype=np.int32)
+    return sums[:, window:] - sums[:, :-window]
+
+
+class LayerSnapshot:
+    """A GridLayer's cells as they were when GridLayer.snapshot() returned this."""
+    __slots__ = ('layer', 'generation')
+
+    def __init__(self, layer: GridLayer, generation: int):
+        self.layer = layer
+        self.generation = generation
+
+    def __del__(self):
+        # What this snapshot kept is handed to the one before it on the layer's next snapshot or write
+        self.layer.released.append(self.generation)
+
+    def chunk(self, key: Tuple[int, int]):
+        # The chunk's old bytes sit in the first snapshot from this one onwards
+        # that was the newest when the chunk was written, else in the layer
+        return self.layer._snapshot_chunk(self.generation, key)
+
+    def keys(self) -> set:
+        """Keys of every chunk that may have been non-empty in the snapshot."""
+        return self.layer._changed_keys(self.generation) | set(self.layer.chunk_keys())
+
+
+class GridView:
+    """Read-only `grid[y][x]` access to the building layer, for callers of the old nested lists."""
+
+    def __init__(self, layer: GridLayer):
+        self.layer = layer
+
+    def __len__(self) -> int:
+        return self.layer.size
+
+    def __getitem__(self, y: int) -> Tuple[str, ...]:
+        # A tuple, so an old-style `grid[y][x] = ...` raises instead of writing to a copy
+        if not 0 <= y < self.layer.size:
+            raise IndexError(y)
+        return tuple(CODE_TO_BUILDING[code] for code in self.layer.row(y))
+
+    def __iter__(self):
+        for y in range(self.layer.size):
+            yield self[y]
+
+
+class Instrumentation:
+    """Opt-in timings, counters and allocation stats for the turn's hot paths."""
+
+    def __init__(self, trace_allocations: bool = False):
+        self.trace_allocations = trace_allocations
+        # phase -> {'calls', 'seconds', 'max_seconds', 'cells_scanned', 'road_tiles_solved', 'allocated'}
+        self.phases: Dict[str, dict] = {}
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.hooks = []
+        self._started_tracing = False
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def attach(self, city: 'City'):
+        # The wrappers are instance attributes that detach() removes again, so
+        # a city without instrumentation runs the plain methods at no cost
+        if city.instrumentation is not None:
+            city.instrumentation.detach(city)
+        city.instrumentation = self
+        city.simulate_turn = self.wrap(city.simulate_turn, 'simulate_turn')
+        city.update_city_stats = self.wrap(city.update_city_stats, 'update_city_stats')
+        city.grow_zones = self.wrap(city.grow_zones, 'grow_zones')
+        city._compute_city_stats = self.wrap(city._compute_city_stats, 'compute_city_stats', 'stats_recomputed')
+        city.economy.update_economy = self.wrap(city.economy.update_economy, 'update_economy')
+        fire_events = city.fire_events
+
+        def traced_events():
+            with self.phase('event') as record:
+                started = fire_events()
+                record['phase'] = f"event:{started[0]}" if started is not None else 'event:end'
+            if started is not None:
+                self.count('events_fired')
+            return started
+        city.fire_events = traced_events
+
+    def detach(self, city: 'City'):
+        for name in ('simulate_turn', 'update_city_stats', 'grow_zones', '_compute_city_stats', 'fire_events',
+                     'instrumentation'):
+            city.__dict__.pop(name, None)
+        city.economy.__dict__.pop('update_economy', None)
+
+    def wrap(self, method, name: str, counter: str = None):
+        def traced(*args, **kwargs):
+            if counter is not None:
+                self.count(counter)
+            with self.phase(name):
+                return method(*args, **kwargs)
+        return traced
+
+    def add_hook(self, callback):
+        """Call `callback(record)` after every phase; the record holds that call's numbers."""
+        self.hooks.append(callback)
+
+    def remove_hook(self, callback):
+        self.hooks.remove(callback)
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time the body as phase `name`; it may rename the phase through the yielded record."""
+        record = {'phase': name}
+        cells = GridLayer.cells_scanned
+        tiles = TrafficModel.tiles_solved
+        memory = tracemalloc.get_traced_memory()[0] if self.trace_allocations else 0
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed = time.perf_counter() - started
+            record['seconds'] = elapsed
+            record['cells_scanned'] = GridLayer.cells_scanned - cells
+            record['road_tiles_solved'] = TrafficModel.tiles_solved - tiles
+            record['allocated'] = tracemalloc.get_traced_memory()[0] - memory if self.trace_allocations else 0
+            totals = self.phases.get(record['phase'])
+            if totals is None:
+                totals = self.phases[record['phase']] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                         'cells_scanned': 0, 'road_tiles_solved': 0,
+                                                         'allocated': 0}
+            totals['calls'] += 1
+            totals['seconds'] += elapsed
+            totals['max_seconds'] = max(totals['max_seconds'], elapsed)
+            for key in ('cells_scanned', 'road_tiles_solved', 'allocated'):
+                totals[key] += record[key]
+            for hook in self.hooks:
+                hook(record)
+
+    def report(self) -> dict:
+        report = {'phases': {name: dict(totals) for name, totals in self.phases.items()},
+                  'counters': dict(self.counters)}
+        if self.trace_allocations and tracemalloc.is_tracing():
+            report['traced_memory'], report['peak_memory'] = tracemalloc.get_traced_memory()
+        return report
+
+    def reset(self):
+        self.phases.clear()
+        self.counters.clear()
+        if self.trace_allocations and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def close(self):
+        """Stop allocation tracing if this instrumentation started it."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self.trace_allocations = False
+
+
+METRIC_COLUMNS = ['money', 'population', 'happiness', 'gdp', 'employment_rate', 'business_confidence',
+                  'tax_income', 'maintenance']
+# Metrics files are a sequence of chunks, each this header followed by the
+# chunk's turns (int64) and then each column in turn (float64)
+METRICS_MAGIC = b'CSMT'
+METRICS_VERSION = 1
+METRICS_CHUNK = struct.Struct('<4sHHIqq')  # magic, version, columns, rows, first turn, last turn
+
+
+class MetricsRecorder:
+    """Per-turn city metrics, buffered in memory and flushed in batches to a columnar file."""
+
+    def __init__(self, path: str = None, every: int = 1, batch_size: int = 4096, capacity: int = 65536):
+        if every < 1:
+            raise ValueError("every must be positive")
+        # Every `batch_size` rows are appended to `path` as one chunk of columns;
+        # without a path only the last `capacity` rows are kept
+        self.path = path
+        # Only turns divisible by this are recorded
+        self.every = every
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.turns = array('q')
+        self.columns = {name: array('d') for name in METRIC_COLUMNS}
+        # Rows recorded since the last flush, as (turn, *metrics)
+        self.queue = []
+
+    def attach(self, city: 'City'):
+        city.metrics_recorder = self
+
+    def detach(self, city: 'City'):
+        city.__dict__.pop('metrics_recorder', None)
+
+    def record(self, city: 'City'):
+        """Append the row for the turn the city has just finished."""
+        turn = city.time_elapsed
+        if turn % self.every:
+            return
+        economy = city.economy
+        self.queue.append((turn, city.money, city.population, city.happiness, economy.gdp,
+                           economy.employment_rate, economy.business_confidence, city.last_tax_revenue,
+                           city.last_maintenance))
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def record_settled(self, city: 'City', first_turn: int, last_turn: int, money: float):
+        """Rows for turns first_turn..last_turn of a settled city, in which only the money moved.
+
+        `money` is the balance before first_turn; every turn adds the last
+        tax revenue and takes off the last maintenance, as City.run does.
+        """
+        every = self.every
+        first_recorded = first_turn + (-first_turn) % every
+        if first_recorded > last_turn:
+            return
+        economy = city.economy
+        tax_revenue, maintenance = city.last_tax_revenue, city.last_maintenance
+        if first_recorded + every > last_turn:
+            # A single row, as for most stretches between events: walk the balance up to it
+            for _ in range(first_recorded - first_turn + 1):
+                money += tax_revenue
+                money -= maintenance
+            self.queue.append((first_recorded, money, city.population, city.happiness, economy.gdp,
+                               economy.employment_rate, economy.business_confidence, tax_revenue, maintenance))
+            if len(self.queue) >= self.batch_size:
+                self.flush()
+            return
+        # The balance after each turn, summed in the same order as City.run does;
+        # the rows are built by itertools in C, with no Python work per turn
+        balances = itertools.accumulate(itertools.chain.from_iterable(
+            itertools.repeat((city.last_tax_revenue, -city.last_maintenance), last_turn - first_turn + 1)),
+            initial=money)
+        rows = zip(range(first_recorded, last_turn + 1, every),
+                   itertools.islice(balances, 2 * (first_recorded - first_turn + 1), None, 2 * every),
+                   *map(itertools.repeat, (city.population, city.happiness, economy.gdp, economy.employment_rate,
+                                           economy.business_confidence, city.last_tax_revenue,
+                                           city.last_maintenance)))
+        while True:
+            self.queue.extend(itertools.islice(rows, self.batch_size - len(self.queue)))
+            if len(self.queue) < self.batch_size:
+                return
+            self.flush()
+
+    def flush(self):
+        """Write the recorded rows to the file as one chunk, or trim the in-memory ones to `capacity`."""
+        if self.queue:
+            turns, *values = zip(*self.queue)
+            self.turns.extend(turns)
+            for name, column in zip(METRIC_COLUMNS, values):
+                self.columns[name].extend(column)
+            self.queue.clear()
+        rows = len(self.turns)
+        if self.path is None:
+            excess = rows - self.capacity
+            if excess > 0:
+                del self.turns[:excess]
+                for column in self.columns.values():
+                    del column[:excess]
+        elif rows:
+            with open(self.path, 'ab') as f:
+                f.write(METRICS_CHUNK.pack(METRICS_MAGIC, METRICS_VERSION, len(METRIC_COLUMNS), rows,
+                                           min(self.turns), max(self.turns)))
+                f.write(self.turns.tobytes())
+                for name in METRIC_COLUMNS:
+                    f.write(self.columns[name].tobytes())
+            del self.turns[:]
+            for column in self.columns.values():
+                del column[:]
+
+    def close(self):
+        self.flush()
+
+    def truncate(self, turn: int):
+        """Forget the rows after `turn`, once the city has been put back to it."""
+        # Rows are in turn order: the file's chunks, then the flushed arrays, then the queue
+        self.queue = [row for row in self.queue if row[0] <= turn]
+        if self.queue:
+            return
+        cut = bisect_right(self.turns, turn)
+        del self.turns[cut:]
+        for column in self.columns.values():
+            del column[cut:]
+        if cut or self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r+b') as f:
+            while True:
+                offset = f.tell()
+                header = f.read(METRICS_CHUNK.size)
+                if len(header) < METRICS_CHUNK.size:
+                    return
+                _, _, column_count, rows, first, last = METRICS_CHUNK.unpack(header)
+                if last > turn:
+                    break
+                f.seek(offset + METRICS_CHUNK.size + rows * 8 * (1 + column_count))
+            # Cut the file before the first chunk reaching past `turn`, and keep its earlier rows in memory
+            self.turns.frombytes(f.read(rows * 8))
+            kept = bisect_right(self.turns, turn)
+            del self.turns[kept:]
+            for name in METRIC_COLUMNS:
+                self.columns[name].frombytes(f.read(rows * 8)[:kept * 8])
+            f.truncate(offset)
+
+    def _read_chunks(self, first_turn: int, last_turn: int, names: List[str]):
+        """Yield (turns, {name: values}) for the flushed chunks overlapping the turn range."""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(METRICS_CHUNK.size)
+                if len(header) < METRICS_CHUNK.size:
+                    return
+                magic, version, column_count, rows, first, last = METRICS_CHUNK.unpack(header)
+                if magic != METRICS_MAGIC or version != METRICS_VERSION or column_count != len(METRIC_COLUMNS):
+                    raise ValueError(f"{self.path} is not a metrics file this version can read")
+                start = f.tell()
+                if last < first_turn or first > last_turn:
+                    f.seek(start + rows * 8 * (1 + column_count))
+                    continue
+                turns = array('q')
+                turns.frombytes(f.read(rows * 8))
+                if len(turns) < rows:
+                    return  # torn write at the end of the file
+                values = {}
+                for name in names:
+                    # Columnar: only the requested columns are read
+                    f.seek(start + rows * 8 * (1 + METRIC_COLUMNS.index(name)))
+                    values[name] = array('d')
+                    values[name].frombytes(f.read(rows * 8))
+                    if len(values[name]) < rows:
+                        return
+                f.seek(start + rows * 8 * (1 + column_count))
+                yield turns, values
+
+    def query(self, first_turn: int = 0, last_turn: int = None, columns: List[str] = None,
+              step: int = 1) -> Dict[str, list]:
+        """Recorded rows for turns first_turn..last_turn, flushed or still buffered.
+
+        Returns {'turn': [...], column: [...]} in recording order. With
+        step > 1 long runs are downsampled: the rows falling in each block
+        of `step` turns are averaged into one, labelled with the block's
+        first turn.
+        """
+        names = list(METRIC_COLUMNS if columns is None else columns)
+        for name in names:
+            if name not in METRIC_COLUMNS:
+                raise ValueError(f"Unknown metric {name!r}")
+        if last_turn is None:
+            last_turn = 2 ** 63 - 1
+        self.flush()
+        result = {'turn': [], **{name: [] for name in names}}
+        buffered = (self.turns, {name: self.columns[name] for name in names})
+        for turns, values in itertools.chain(self._read_chunks(first_turn, last_turn, names), [buffered]):
+            for index, turn in enumerate(turns):
+                if first_turn <= turn <= last_turn:
+                    result['turn'].append(turn)
+                    for name in names:
+                        result[name].append(values[name][index])
+        if step > 1:
+            result = _downsample(result, names, step)
+        return result
+
+    def export_csv(self, path: str):
+        rows = self.query()
+        with open(path, 'w') as f:
+            f.write(",".join(['turn'] + METRIC_COLUMNS) + "\n")
+            for index, turn in enumerate(rows['turn']):
+                f.write(",".join([str(turn)] + [repr(rows[name][index]) for name in METRIC_COLUMNS]) + "\n")
+
+
+def _downsample(rows: Dict[str, list], names: List[str], step: int) -> Dict[str, list]:
+    result = {'turn': [], **{name: [] for name in names}}
+    start = 0
+    turns = rows['turn']
+    while start < len(turns):
+        block = turns[start] // step
+        end = start
+        while end < len(turns) and turns[end] // step == block:
+            end += 1
+        result['turn'].append(block * step)
+        for name in names:
+            values = rows[name][start:end]
+            result[name].append(sum(values) / len(values))
+        start = end
+    return result
+
+
 class City:
-    def __init__(self, name: str):
+    # When enabled, every stats refresh cross-checks the incremental
+    # counters against a full rescan of the grid and infrastructure.
+    debug_stats = False
+    # The Instrumentation attached to this city, if any
+    instrumentation = None
+    # The MetricsRecorder attached to this city, if any
+    metrics_recorder = None
+
+    def __init__(self, name: str, grid_size: int = 10, seed: int = None):
         self.name = name
         self.money = 10000
         self.population = 0
         self.happiness = 100
-        self.grid_size = 10
-        self.grid = [[None for _ in range(self.grid_size)] for _ in range(self.grid_size)]
-        self.infrastructure = Infrastructure()
+        if grid_size < 1:
+            raise ValueError("grid_size must be positive")
+        self.grid_size = grid_size
+        self.grid_layer = GridLayer(grid_size, len(BUILDING_TYPES))
+        self.grid = GridView(self.grid_layer)
+        self.infrastructure = Infrastructure(grid_size, grid_layer=self.grid_layer)
         self.economy = Economy()
         self.tax_rate = 10
-        self.buildings = []
+        # Coordinate-keyed index of buildings plus per-type coordinate sets.
+        # Built from the grid on first use, so a memory-mapped save doesn't
+        # have to read every chunk just to load.
+        self._building_index = {}
+        self._buildings_by_type = {building_type: set() for building_type in BUILDING_TYPES}
+        self.building_counts = {building_type: 0 for building_type in BUILDING_TYPES}
+        # Per service, a layer counting the buildings of that service whose
+        # radius reaches each cell, and the number of homes reached at all.
+        # Like the building index, the layers are rebuilt on first use after a load.
+        self._coverage = {service: GridLayer(grid_size) for service in SERVICE_RADII}
+        self.covered_residents = {service: 0 for service in SERVICE_RADII}
+        # Density levels above the first of every zone building, and their total per zone
+        self.density_layer = GridLayer(grid_size, MAX_DENSITY - 1)
+        self.zone_upgrades = {zone: 0 for zone in ZONE_TYPES}
+        # Key of the buildings at the last growth pass that changed nothing
+        self._zones_settled_at = None
         self.time_elapsed = 0
         self.maintenance_costs = defaultdict(float)
+        # Bumped whenever buildings change; with the tax rate and economy
+        # state it keys the memoized results of update_city_stats
+        self.stats_version = 0
+        self._stats_memo = {}
+        # What the last stats refresh collected in taxes and paid in maintenance
+        self.last_tax_revenue = 0.0
+        self.last_maintenance = 0.0
+        # Each city draws its events from its own generator, so runs are
+        # reproducible and cities in other threads don't share a stream
+        self.rng = random.Random(seed)
+        self.scheduler = EventScheduler()
+        self.scheduler.start(self.rng, 0)
 
-    def to_dict(self) -> dict:
-        return {
+    def to_dict(self, include_layers: bool = True) -> dict:
+        data = {
             'name': self.name,
             'money': self.money,
             'population': self.population,
             'happiness': self.happiness,
             'grid_size': self.grid_size,
-            'grid': self.grid,
-            'infrastructure': self.infrastructure.to_dict(),
-            'economy': self.economy.to_dict(),
+            # Ahead of the layers, so read_save_header finds them near the start
             'tax_rate': self.tax_rate,
-            'buildings': self.buildings,
-            'time_elapsed': self.time_elapsed,
-            'maintenance_costs': dict(self.maintenance_costs)
+            'time_elapsed': self.time_elapsed
         }
+        if include_layers:
+            data['grid'] = self.grid_layer.to_dict()
+            data['infrastructure'] = self.infrastructure.to_dict()
+            data['density'] = self.density_layer.to_dict()
+        data.update({
+            'economy': self.economy.to_dict(),
+            'maintenance_costs': dict(self.maintenance_costs),
+            'rng_state': self.get_rng_state(),
+            'events': self.scheduler.get_state()
+        })
+        return data
     
     @classmethod
-    def from_dict(cls, data: dict):
-        city = cls(data['name'])
+    def from_dict(cls, data: dict, grid_layer: GridLayer = None, infrastructure: 'Infrastructure' = None,
+                  density_layer: GridLayer = None):
+        """Build a city from to_dict() output, optionally around already loaded layers."""
+        city = cls(data['name'], data['grid_size'])
         city.money = data['money']
         city.population = data['population']
         city.happiness = data['happiness']
-        city.grid_size = data['grid_size']
-        city.grid = data['grid']
-        city.infrastructure = Infrastructure.from_dict(data['infrastructure'])
+        if grid_layer is not None:
+            city.grid_layer = grid_layer
+            city.grid = GridView(grid_layer)
+        elif isinstance(data['grid'], dict):
+            city.grid_layer = GridLayer.from_dict(data['grid'], city.grid_size, len(BUILDING_TYPES))
+            city.grid = GridView(city.grid_layer)
+        else:
+            # Saves from before chunked storage hold the grid as nested lists
+            for y, row in enumerate(data['grid']):
+                for x, cell in enumerate(row):
+                    if cell:
+                        city.grid_layer.set(x, y, BUILDING_CODES[cell])
+        if infrastructure is None:
+            infrastructure = Infrastructure.from_dict(data['infrastructure'], city.grid_size, city.grid_layer)
+        city.infrastructure = infrastructure
         city.economy = Economy.from_dict(data['economy'])
         city.tax_rate = data['tax_rate']
-        city.buildings = data['buildings']
+        city._building_index = None
         city.time_elapsed = data['time_elapsed']
         city.maintenance_costs = defaultdict(float, data['maintenance_costs'])
+        if 'building_counts' in data:
+            city.building_counts = {building_type: 0 for building_type in BUILDING_TYPES}
+            city.building_counts.update(data['building_counts'])
+        else:
+            city.building_counts = city.count_buildings()
+        if density_layer is not None:
+            city.density_layer = density_layer
+        elif 'density' in data:
+            city.density_layer = GridLayer.from_dict(data['density'], city.grid_size, MAX_DENSITY - 1)
+        # Saves from before zone growth have every building at the first level
+        if 'zone_upgrades' in data:
+            city.zone_upgrades.update(data['zone_upgrades'])
+        else:
+            city.zone_upgrades = city.count_zone_upgrades()
+        city._coverage = None
+        if 'covered_residents' in data:
+            city.covered_residents = dict(data['covered_residents'])
+        else:
+            city._ensure_coverage()
+        if 'rng_state' in data:
+            city.set_rng_state(data['rng_state'])
+        if 'events' in data:
+            city.scheduler.set_state(data['events'], city.rng, city.time_elapsed)
+        else:
+            # Saves from before scheduled events: draw the schedule from the saved generator
+            city.scheduler.start(city.rng, city.time_elapsed)
         return city
 
+    def get_rng_state(self) -> list:
+        """The event generator's state in a JSON-friendly form."""
+        version, internal_state, gauss_next = self.rng.getstate()
+        return [version, list(internal_state), gauss_next]
+
+    def set_rng_state(self, state: list):
+        version, internal_state, gauss_next = state
+        self.rng.setstate((version, tuple(internal_state), gauss_next))
+
+    def get_zone_state(self) -> dict:
+        """The zones' density levels in a JSON-friendly form."""
+        return {'density': self.density_layer.to_dict(), 'zone_upgrades': dict(self.zone_upgrades)}
+
+    def set_zone_state(self, state: dict):
+        self.density_layer = GridLayer.from_dict(state['density'], self.grid_size, MAX_DENSITY - 1)
+        self.zone_upgrades = dict(state['zone_upgrades'])
+        self.stats_version += 1
+
+    def snapshot(self) -> dict:
+        """The city's state for restore(), taking each layer's snapshot in constant time.
+
+        The layers keep the old bytes of a chunk only when it is next
+        written to, so a snapshot costs memory for the chunks changed after
+        it, not for the whole map.
+        """
+        return {
+            'grid_size': self.grid_size,
+            'grid': self.grid_layer.snapshot(),
+            'infrastructure': self.infrastructure.layer.snapshot(),
+            'density': self.density_layer.snapshot(),
+            'zone_upgrades': dict(self.zone_upgrades),
+            'name': self.name,
+            'money': self.money,
+            'population': self.population,
+            'happiness': self.happiness,
+            'tax_rate': self.tax_rate,
+            'time_elapsed': self.time_elapsed,
+            'economy': (self.economy.get_state(), self.economy.inflation_rate),
+            'maintenance_costs': dict(self.maintenance_costs),
+            'rng_state': self.rng.getstate(),
+            'events': self.scheduler.get_state()
+        }
+
+    def restore(self, snapshot: dict):
+        """Go back (or forward) to a snapshot, rebuilding and demolishing only the cells that differ."""
+        if snapshot['grid_size'] != self.grid_size:
+            raise ValueError("Snapshot is of a different map size")
+        # Through place_building and add_connection, so the index, counters,
+        # networks, coverage and traffic follow incrementally
+        for x, y, code in self.grid_layer.differences(snapshot['grid']):
+            self.remove_building(x, y)
+            if code:
+                self.place_building(x, y, CODE_TO_BUILDING[code])
+        infrastructure = self.infrastructure
+        for x, y, value in infrastructure.layer.differences(snapshot['infrastructure']):
+            current = infrastructure.layer.get(x, y)
+            for infra_type, bit in INFRA_BITS.items():
+                if value & bit and not current & bit:
+                    infrastructure.add_connection(x, y, infra_type)
+                elif current & bit and not value & bit:
+                    infrastructure.remove_connection(x, y, infra_type)
+        # After the buildings, whose removal resets their cells
+        for x, y, value in self.density_layer.differences(snapshot['density']):
+            self.density_layer.set(x, y, value)
+        self.zone_upgrades = dict(snapshot['zone_upgrades'])
+        self.name = snapshot['name']
+        self.money = snapshot['money']
+        self.population = snapshot['population']
+        self.happiness = snapshot['happiness']
+        self.tax_rate = snapshot['tax_rate']
+        self.time_elapsed = snapshot['time_elapsed']
+        economy_state, self.economy.inflation_rate = snapshot['economy']
+        self.economy.set_state(economy_state)
+        self.maintenance_costs.clear()
+        self.maintenance_costs.update(snapshot['maintenance_costs'])
+        self.rng.setstate(snapshot['rng_state'])
+        self.scheduler.set_state(snapshot['events'], self.rng, self.time_elapsed)
+        self.stats_version += 1
+        if self.metrics_recorder is not None:
+            self.metrics_recorder.truncate(self.time_elapsed)
+
+    @contextlib.contextmanager
+    def what_if(self):
+        """Try changes on the city inside a with block; everything is put back afterwards."""
+        snapshot = self.snapshot()
+        try:
+            yield self
+        finally:
+            self.restore(snapshot)
+
     def get_building_cost(self, building_type: str) -> int:
         costs = {
             'R': 1000,   # Residential
@@ -163,6 +1814,8 @@ class City:
             'H': 5000,   # Hospital
             'S': 3000,   # School
             'F': 2500,   # Fire Station
+            'E': 8000,   # Power Plant
+            'T': 6000,   # Water Tower
             'POWER': 500,  # Power line
             'ROAD': 300,   # Road
             'WATER': 400   # Water pipe
@@ -178,6 +1831,8 @@ class City:
             'H': 'Hospital',
             'S': 'School',
             'F': 'Fire Station',
+            'E': 'Power Plant',
+            'T': 'Water Tower',
             'POWER': 'Power Line',
             'ROAD': 'Road',
             'WATER': 'Water Pipe',
@@ -186,128 +1841,623 @@ class City:
         return names.get(code, 'Unknown')
 
     def is_connected(self, x: int, y: int) -> bool:
-        # Check if location has all required infrastructure
-        has_power = self.infrastructure.has_connection(x, y, 'POWER')
-        has_road = self.infrastructure.has_connection(x, y, 'ROAD')
-        has_water = self.infrastructure.has_connection(x, y, 'WATER')
-        return has_power and has_road and has_water
+        # Check if location gets power, road access and water through the networks
+        return self.infrastructure.is_serviced(x, y)
 
-    def build(self, x: int, y: int, building_type: str) -> bool:
+    def build_error(self, x: int, y: int, building_type: str) -> str:
+        """Why `building_type` can't be built at (x, y) right now, or None if it can."""
         if not (0 <= x < self.grid_size and 0 <= y < self.grid_size):
-            print("Invalid coordinates!")
-            return False
+            return "Invalid coordinates!"
 
-        if self.grid[y][x] is not None and building_type not in ['POWER', 'ROAD', 'WATER']:
-            print("This spot is already occupied!")
-            return False
+        if building_type not in BUILDING_TYPES and building_type not in ['POWER', 'ROAD', 'WATER']:
+            return "Unknown building type!"
 
-        cost = self.get_building_cost(building_type)
-        if self.money < cost:
-            print("Not enough money!")
+        if self.grid_layer.get(x, y) and building_type not in ['POWER', 'ROAD', 'WATER']:
+            return "This spot is already occupied!"
+
+        if self.money < self.get_building_cost(building_type):
+            return "Not enough money!"
+        return None
+
+    def build(self, x: int, y: int, building_type: str, update_stats: bool = True) -> bool:
+        """Build at (x, y); with update_stats=False the caller refreshes the stats later, e.g. once per batch."""
+        error = self.build_error(x, y, building_type)
+        if error is not None:
+            print(error)
             return False
 
+        cost = self.get_building_cost(building_type)
         if building_type in ['POWER', 'ROAD', 'WATER']:
             self.infrastructure.add_connection(x, y, building_type)
         else:
-            self.grid[y][x] = building_type
-            self.buildings.append((x, y, building_type))
+            self.place_building(x, y, building_type)
             
         self.money -= cost
         self.maintenance_costs[building_type] += cost * 0.01  # 1% maintenance cost
-        self.update_city_stats()
+        self.stats_version += 1
+        if update_stats:
+            self.update_city_stats()
         return True
 
+    def place_building(self, x: int, y: int, building_type: str):
+        """Put a building on an empty cell, keeping the index and counters in step."""
+        # Before the grid changes, so coverage built lazily here doesn't count the building twice
+        self._update_coverage(x, y, building_type, 1)
+        self.grid_layer.set(x, y, BUILDING_CODES[building_type])
+        self._index_add(x, y, building_type)
+        self.building_counts[building_type] += 1
+        if building_type in SOURCE_BUILDINGS:
+            self.infrastructure.update_sources(x, y)
+        if building_type in COMMUTE_BUILDINGS:
+            self.infrastructure.traffic.invalidate(x, y, 1)
+
+    def remove_building(self, x: int, y: int) -> str:
+        """Clear the building at (x, y); returns its type, or None if the cell was empty."""
+        building_type = CODE_TO_BUILDING[self.grid_layer.get(x, y)]
+        if building_type is None:
+            return None
+        self._update_coverage(x, y, building_type, -1)
+        self.grid_layer.set(x, y, 0)
+        self._index_remove(x, y)
+        self.building_counts[building_type] -= 1
+        upgrades = self.density_layer.get(x, y)
+        if upgrades:
+            self.density_layer.set(x, y, 0)
+            self.zone_upgrades[building_type] -= upgrades
+        if building_type in SOURCE_BUILDINGS:
+            self.infrastructure.update_sources(x, y)
+        if building_type in COMMUTE_BUILDINGS:
+            self.infrastructure.traffic.invalidate(x, y, 1)
+        return building_type
+
+    def _ensure_coverage(self):
+        if self._coverage is not None:
+            return
+        self._coverage = {service: GridLayer(self.grid_size) for service in SERVICE_RADII}
+        self.covered_residents = {service: 0 for service in SERVICE_RADII}
+        for service in SERVICE_RADII:
+            for x, y in self.buildings_of_type(service):
+                self._stamp_coverage(x, y, service, 1)
+
+    def _stamp_coverage(self, x: int, y: int, service: str, delta: int):
+        layer = self._coverage[service]
+        residential = BUILDING_CODES['R']
+        size = self.grid_size
+        for dx, dy in SERVICE_STAMPS[service]:
+            cx, cy = x + dx, y + dy
+            if not (0 <= cx < size and 0 <= cy < size):
+                continue
+            old = layer.get(cx, cy)
+            layer.set(cx, cy, old + delta)
+            # A home counts as covered while at least one service reaches it
+            if (old == 0 or old + delta == 0) and self.grid_layer.get(cx, cy) == residential:
+                self.covered_residents[service] += delta
+
+    def _update_coverage(self, x: int, y: int, building_type: str, delta: int):
+        """Apply a building placed (delta 1) or removed (delta -1) at (x, y) to the coverage."""
+        if building_type != 'R' and building_type not in SERVICE_RADII:
+            return
+        self._ensure_coverage()
+        if building_type == 'R':
+            for service, layer in self._coverage.items():
+                if layer.get(x, y):
+                    self.covered_residents[service] += delta
+        else:
+            self._stamp_coverage(x, y, service=building_type, delta=delta)
+
+    def count_covered_residents(self) -> Dict[str, int]:
+        """Full rescan: for each service, the homes within reach of at least one such building."""
+        homes = self.buildings_of_type('R')
+        counts = {}
+        for service, radius in SERVICE_RADII.items():
+            sites = self.buildings_of_type(service)
+            counts[service] = sum(1 for hx, hy in homes
+                                  if any((hx - sx) ** 2 + (hy - sy) ** 2 <= radius * radius for sx, sy in sites))
+        return counts
+
+    def _ensure_building_index(self):
+        if self._building_index is None:
+            self._building_index = {}
+            self._buildings_by_type = {building_type: set() for building_type in BUILDING_TYPES}
+            for x, y, code in self.grid_layer.nonzero():
+                self._index_add(x, y, CODE_TO_BUILDING[code])
+
+    def _index_add(self, x: int, y: int, building_type: str):
+        if self._building_index is not None:
+            self._building_index[(x, y)] = building_type
+            self._buildings_by_type[building_type].add((x, y))
+
+    def _index_remove(self, x: int, y: int):
+        if self._building_index is not None:
+            building_type = self._building_index.pop((x, y))
+            self._buildings_by_type[building_type].discard((x, y))
+
+    @property
+    def buildings(self) -> Tuple[Tuple[int, int, str], ...]:
+        """(x, y, type) for every building, as the old list attribute provided, but read-only."""
+        self._ensure_building_index()
+        return tuple((x, y, building_type) for (x, y), building_type in self._building_index.items())
+
+    def building_at(self, x: int, y: int) -> str:
+        return CODE_TO_BUILDING[self.grid_layer.get(x, y)]
+
+    def buildings_of_type(self, building_type: str) -> set:
+        """Coordinates of every building of one type, e.g. all hospitals."""
+        self._ensure_building_index()
+        return set(self._buildings_by_type[building_type])
+
+    def count_buildings(self) -> Dict[str, int]:
+        """Count buildings from the grid's per-chunk aggregates, independent of the incremental counters."""
+        return {building_type: self.grid_layer.count(BUILDING_CODES[building_type])
+                for building_type in BUILDING_TYPES}
+
+    def count_zone_upgrades(self) -> Dict[str, int]:
+        """Total density levels above the first per zone, counted from the density layer."""
+        upgrades = {zone: 0 for zone in ZONE_TYPES}
+        for x, y, value in self.density_layer.nonzero():
+            upgrades[CODE_TO_BUILDING[self.grid_layer.get(x, y)]] += value
+        return upgrades
+
+    def zone_counts(self) -> Dict[str, int]:
+        """R, C and I buildings weighted by their density level."""
+        return {zone: self.building_counts[zone] + self.zone_upgrades[zone] for zone in ZONE_TYPES}
+
+    def verify_stats(self):
+        """Raise if the incremental counters or chunk aggregates disagree with a full rescan."""
+        building_counts = {building_type: self.grid_layer.rescan_count(BUILDING_CODES[building_type])
+                           for building_type in BUILDING_TYPES}
+        aggregated = self.count_buildings()
+        if building_counts != self.building_counts or aggregated != building_counts:
+            raise RuntimeError(f"Building counters drifted: incremental {self.building_counts}, "
+                               f"chunk aggregates {aggregated}, rescan {building_counts}")
+        connected = self.infrastructure.count_connected()
+        self.infrastructure.ensure_networks()
+        aggregated = self.infrastructure.live_layer.count(FULLY_CONNECTED)
+        if connected != self.infrastructure.connected_count or aggregated != connected:
+            raise RuntimeError(f"Connected cell counter drifted: incremental "
+                               f"{self.infrastructure.connected_count}, chunk aggregates {aggregated}, "
+                               f"rescan {connected}")
+        covered = self.count_covered_residents()
+        self._ensure_coverage()
+        if covered != self.covered_residents:
+            raise RuntimeError(f"Service coverage drifted: incremental {self.covered_residents}, "
+                               f"rescan {covered}")
+        upgrades = self.count_zone_upgrades()
+        if upgrades != self.zone_upgrades:
+            raise RuntimeError(f"Zone density drifted: incremental {self.zone_upgrades}, rescan {upgrades}")
+        commutes = TrafficModel(self.infrastructure).refresh()
+        if commutes != self.infrastructure.traffic.refresh():
+            raise RuntimeError(f"Commute totals drifted: incremental {self.infrastructure.traffic.totals}, "
+                               f"rescan {commutes}")
+
+    def _stats_key(self) -> tuple:
+        return (self.stats_version, self.infrastructure.connected_count, self.tax_rate,
+                self.economy.business_confidence, self.economy.employment_rate, self.scheduler.productivity,
+                self.economy.trade)
+
     def update_city_stats(self):
-        # Count buildings
-        building_counts = {'R': 0, 'C': 0, 'I': 0, 'P': 0, 'H': 0, 'S': 0, 'F': 0}
-        for row in self.grid:
-            for cell in row:
-                if cell:
-                    building_counts[cell] += 1
-
-        # Update population based on residential zones and infrastructure
-        base_population = building_counts['R'] * 100
-        infrastructure_modifier = sum(1 for x in range(self.grid_size) 
-                                   for y in range(self.grid_size) 
-                                   if self.is_connected(x, y)) / (self.grid_size * self.grid_size)
+        if self.debug_stats:
+            self.verify_stats()
+        key = self._stats_key()
+        cached = self._stats_memo.get(key)
+        if cached is None:
+            cached = self._compute_city_stats(key)
+        else:
+            # Same inputs as an earlier refresh: reuse its results
+            self.population, self.happiness, economy_state = cached[2]
+            self.economy.set_state(economy_state)
+        self.last_tax_revenue = cached[0]
+        self.money += cached[0]
+
+        # Apply maintenance costs
+        self.last_maintenance = sum(self.maintenance_costs.values())
+        self.money -= self.last_maintenance
+
+    def _compute_city_stats(self, key: tuple) -> tuple:
+        building_counts = self.building_counts
+        zones = self.zone_counts()
+
+        # Update population based on residential zones, their density and infrastructure
+        base_population = zones['R'] * 100
+        infrastructure_modifier = self.infrastructure.connected_count / (self.grid_size * self.grid_size)
         self.population = int(base_population * (0.5 + 0.5 * infrastructure_modifier))
 
         # Calculate happiness based on various factors
+        homes = max(building_counts['R'], 1)
+        service_bonus = sum(weight * self.covered_residents[service] / homes  # Parks, hospitals,
+                            for service, weight in SERVICE_HAPPINESS.items())  # schools, fire stations
+        congestion = self.commute_congestion()
         self.happiness = min(100, 50 + 
-                           building_counts['P'] * 5 +     # Parks
-                           building_counts['H'] * 10 +    # Hospitals
-                           building_counts['S'] * 7 +     # Schools
+                           service_bonus +
                            infrastructure_modifier * 20 -  # Infrastructure
-                           max(0, self.tax_rate - 10) * 2)  # Tax penalty
+                           max(0, self.tax_rate - 10) * 2 -  # Tax penalty
+                           min(1.0, congestion) * COMMUTE_HAPPINESS)  # Traffic
 
         # Update economy and collect taxes
-        tax_income = self.economy.update_economy(building_counts, self.population)
-        self.money += tax_income * (self.tax_rate / 100)
+        # Lasting events such as recessions scale the productivity of the sectors they target
+        tax_income = self.economy.update_economy(zones, self.population, 1.0 / (1 + congestion),
+                                                 self.scheduler.productivity)
+        tax_revenue = tax_income * (self.tax_rate / 100)
 
-        # Apply maintenance costs
-        total_maintenance = sum(self.maintenance_costs.values())
-        self.money -= total_maintenance
+        # The economy has settled once a refresh leaves its own inputs unchanged,
+        # so every following refresh repeats it until something is built or an
+        # event hits. Entries from older building layouts can never match again.
+        settled = self._stats_key() == key
+        if len(self._stats_memo) >= STATS_MEMO_SIZE or any(
+                old_key[0] != key[0] for old_key in self._stats_memo):
+            self._stats_memo.clear()
+        entry = (tax_revenue, settled,
+                 (self.population, self.happiness, self.economy.get_state()))
+        self._stats_memo[key] = entry
+        return entry
+
+    def _zones_key(self) -> tuple:
+        return (self.stats_version, self.infrastructure.connected_count)
+
+    def land_values(self):
+        """Every cell's land value, as a NumPy array or, without NumPy, a list of rows."""
+        self.infrastructure.ensure_networks()
+        size = self.grid_size
+        if np is not None:
+            return self._land_value_arrays(0, 0, size, size)[1]
+        return self._land_value_rows(0, 0, size, size)[1]
+
+    def _land_value_bounds(self, x0: int, y0: int, x1: int, y1: int) -> tuple:
+        """The cells a stencil over [x0, x1) x [y0, y1) reads, clipped to the map."""
+        size = self.grid_size
+        return (max(x0 - LAND_VALUE_RADIUS, 0), max(y0 - LAND_VALUE_RADIUS, 0),
+                min(x1 + LAND_VALUE_RADIUS, size), min(y1 + LAND_VALUE_RADIUS, size))
+
+    def _land_value_arrays(self, x0: int, y0: int, x1: int, y1: int) -> tuple:
+        """Building codes, land value and land value before pollution of [x0, x1) x [y0, y1) as NumPy arrays.
+
+        One stencil pass over the rectangle and the LAND_VALUE_RADIUS of
+        cells around it.
+        """
+        wx0, wy0, wx1, wy1 = self._land_value_bounds(x0, y0, x1, y1)
+        codes = self.grid_layer.window(wx0, wy0, wx1, wy1)
+        serviced = self.infrastructure.live_layer.window(wx0, wy0, wx1, wy1) == FULLY_CONNECTED
+        weights = np.array(_CODE_LAND_VALUE, dtype=np.int16)[codes] + serviced * np.int16(SERVICED_LAND_VALUE)
+        unpolluted = LAND_VALUE_BASE + _box_sums_array(weights, LAND_VALUE_RADIUS)
+        industry = (codes == BUILDING_CODES['I']) * np.int16(POLLUTION_LAND_VALUE)
+        land_value = unpolluted - _box_sums_array(industry, LAND_VALUE_RADIUS)
+        inner = (slice(y0 - wy0, y1 - wy0), slice(x0 - wx0, x1 - wx0))
+        return codes[inner], land_value[inner], unpolluted[inner]
+
+    def _land_value_rows(self, x0: int, y0: int, x1: int, y1: int) -> tuple:
+        """_land_value_arrays with lists of rows, for when NumPy isn't installed."""
+        wx0, wy0, wx1, wy1 = self._land_value_bounds(x0, y0, x1, y1)
+        codes = [self.grid_layer.row(y, wx0, wx1) for y in range(wy0, wy1)]
+        live = [self.infrastructure.live_layer.row(y, wx0, wx1) for y in range(wy0, wy1)]
+        weights = [[_CODE_LAND_VALUE[code] + (SERVICED_LAND_VALUE if serviced == FULLY_CONNECTED else 0)
+                    for code, serviced in zip(row, live_row)] for row, live_row in zip(codes, live)]
+        unpolluted = [[LAND_VALUE_BASE + value for value in row] for row in _box_sums(weights, LAND_VALUE_RADIUS)]
+        industry = BUILDING_CODES['I']
+        pollution = _box_sums([[POLLUTION_LAND_VALUE if code == industry else 0 for code in row] for row in codes],
+                              LAND_VALUE_RADIUS)
+        land_value = [[a - b for a, b in zip(row, polluted)] for row, polluted in zip(unpolluted, pollution)]
+        rows = slice(y0 - wy0, y1 - wy0)
+        columns = slice(x0 - wx0, x1 - wx0)
+        return tuple([row[columns] for row in values[rows]] for values in (codes, land_value, unpolluted))
+
+    def _zone_runs(self) -> List[Tuple[int, int, int]]:
+        """(cy, first cx, last cx + 1) for each run of side-by-side chunks holding R, C or I buildings."""
+        zone_codes = [BUILDING_CODES[zone] for zone in ZONE_TYPES]
+        keys = sorted((cy, cx) for cx, cy in self.grid_layer.chunk_keys()
+                      if any(self.grid_layer.chunk_histogram(cx, cy)[code] for code in zone_codes))
+        runs = []
+        for cy, cx in keys:
+            if runs and runs[-1][0] == cy and runs[-1][2] == cx:
+                runs[-1] = (cy, runs[-1][1], cx + 1)
+            else:
+                runs.append((cy, cx, cx + 1))
+        return runs
+
+    def grow_zones(self, force: bool = False) -> int:
+        """Move every R, C and I building one density level towards what its land value supports.
+
+        Returns the number of buildings that changed level. Once a pass
+        changes nothing, the next ones are skipped until something is
+        built or demolished (or `force` is set). The stencil only runs
+        over the chunks holding zone buildings, a row of side-by-side
+        chunks at a time.
+        """
+        key = self._zones_key()
+        if key == self._zones_settled_at and not force:
+            return 0
+        if not any(self.grid_layer.count(BUILDING_CODES[zone]) for zone in ZONE_TYPES):
+            self._zones_settled_at = key
+            return 0
+        self.infrastructure.ensure_networks()
+        size = self.grid_size
+        grow = self._grow_window if np is not None else self._grow_rows
+        changed = 0
+        for cy, cx0, cx1 in self._zone_runs():
+            changed += grow(cx0 * CHUNK_SIZE, cy * CHUNK_SIZE,
+                            min(cx1 * CHUNK_SIZE, size), min((cy + 1) * CHUNK_SIZE, size))
+        if changed:
+            self.stats_version += 1
+        else:
+            self._zones_settled_at = key
+        return changed
+
+    def _grow_window(self, x0: int, y0: int, x1: int, y1: int) -> int:
+        """grow_zones for the buildings in [x0, x1) x [y0, y1), with NumPy."""
+        codes, land_value, unpolluted = self._land_value_arrays(x0, y0, x1, y1)
+        value = np.where(codes == BUILDING_CODES['I'], unpolluted, land_value)
+        thresholds = np.array(_CODE_THRESHOLDS, dtype=np.int32)
+        targets = np.zeros(codes.shape, dtype=np.int8)
+        for level in range(MAX_DENSITY - 1):
+            targets += value >= thresholds[:, level][codes]
+        current = self.density_layer.window(x0, y0, x1, y1)
+        steps = np.sign(targets - current.astype(np.int8))
+        changed = int(np.count_nonzero(steps))
+        if changed:
+            self.density_layer.write_array((current + steps).astype(np.uint8), x0, y0)
+            totals = np.bincount(codes.ravel(), weights=steps.ravel(), minlength=len(BUILDING_TYPES) + 1)
+            for zone in ZONE_TYPES:
+                self.zone_upgrades[zone] += int(totals[BUILDING_CODES[zone]])
+        return changed
+
+    def _grow_rows(self, x0: int, y0: int, x1: int, y1: int) -> int:
+        """_grow_window for when NumPy isn't installed."""
+        codes, land_value, unpolluted = self._land_value_rows(x0, y0, x1, y1)
+        industry = BUILDING_CODES['I']
+        changed = 0
+        for y, row in enumerate(codes, start=y0):
+            for x, code in enumerate(row, start=x0):
+                building_type = CODE_TO_BUILDING[code]
+                if building_type not in self.zone_upgrades:
+                    continue
+                value = (unpolluted if code == industry else land_value)[y - y0][x - x0]
+                target = sum(value >= threshold for threshold in _CODE_THRESHOLDS[code])
+                current = self.density_layer.get(x, y)
+                if target != current:
+                    step = 1 if target > current else -1
+                    self.density_layer.set(x, y, current + step)
+                    self.zone_upgrades[building_type] += step
+                    changed += 1
+        return changed
+
+    def commute_congestion(self) -> float:
+        """How much longer commutes take than on empty roads, e.g. 0.5 for 50% longer."""
+        _, travel_time, free_flow_time, _ = self.infrastructure.traffic.refresh()
+        return travel_time / free_flow_time - 1 if free_flow_time else 0.0
 
-    def simulate_turn(self):
+    def simulate_turn(self) -> str:
+        """Advance one turn; returns the key of the event that fired, if any."""
         self.time_elapsed += 1
+        self.grow_zones()
         self.update_city_stats()
         
         # Random events with economic impact
-        if random.random() < 0.1:  # 10% chance of event
-            events = [
-                ("Economic boom! Businesses are thriving.", 
-                 lambda: self.apply_economic_event(1000, 0.1, 0.05)),
-                ("Recession hits the city.", 
-                 lambda: self.apply_economic_event(-500, -0.05, -0.1)),
-                ("New technology brings efficiency improvements.", 
-                 lambda: self.reduce_maintenance_costs(0.9)),
-                ("Infrastructure aging causes increased maintenance.", 
-                 lambda: self.increase_maintenance_costs(1.1))
-            ]
-            event, effect = random.choice(events)
-            print(f"\nEvent: {event}")
-            effect()
+        key = None
+        if self.scheduler.next_turn <= self.time_elapsed:
+            started = self.fire_events()
+            if started is not None:
+                key, message = started
+                print(f"\nEvent: {message}")
+        if self.metrics_recorder is not None:
+            self.metrics_recorder.record(self)
+        return key
+
+    def fire_events(self) -> Tuple[str, str]:
+        """Apply the events due this turn; returns the (key, message) of the one that started, if any."""
+        return self.scheduler.fire_due(self)
+
+    def metrics(self) -> dict:
+        return {
+            'turn': self.time_elapsed,
+            'money': self.money,
+            'population': self.population,
+            'happiness': self.happiness,
+            'gdp': self.economy.gdp,
+            'employment_rate': self.economy.employment_rate,
+            'business_confidence': self.economy.business_confidence
+        }
+
+    def run(self, turns: int, record_every: int = 0) -> dict:
+        """Advance `turns` turns silently, with the same results as calling simulate_turn() that often."""
+        events = []
+        # Metrics every `record_every` turns, none when 0
+        history = []
+        end = self.time_elapsed + turns
+        scheduler = self.scheduler
+        recorder = self.metrics_recorder
+        # The next turn the recorder keeps a row for
+        next_record = math.inf
+        if recorder is not None:
+            next_record = self.time_elapsed + 1 + (-(self.time_elapsed + 1)) % recorder.every
+        while self.time_elapsed < end:
+            self.time_elapsed += 1
+            self.grow_zones()
+            self.update_city_stats()
+            due = scheduler.next_turn <= self.time_elapsed
+            cached = self._stats_memo.get(self._stats_key())
+            if (not due and cached is not None and cached[1] and self._zones_settled_at == self._zones_key()
+                    and not self.debug_stats):
+                if record_every and self.time_elapsed % record_every == 0:
+                    history.append(self.metrics())
+                if self.time_elapsed == next_record:
+                    recorder.record(self)
+                    next_record += recorder.every
+                if self.time_elapsed == end:
+                    break
+                # Settled city and zones: nothing but money changes until the next
+                # scheduled event, so apply the settled state once and repeat its cash flow locally.
+                self.population, self.happiness, economy_state = cached[2]
+                self.economy.set_state(economy_state)
+                self.last_tax_revenue = tax_revenue = cached[0]
+                self.last_maintenance = total_maintenance = sum(self.maintenance_costs.values())
+                money = start_money = self.money
+                turn = start_turn = self.time_elapsed
+                next_event = scheduler.next_turn
+                while turn < end:
+                    turn += 1
+                    money += tax_revenue
+                    money -= total_maintenance
+                    if turn >= next_event:
+                        due = True
+                        break
+                    if record_every and turn % record_every == 0:
+                        self.money, self.time_elapsed = money, turn
+                        history.append(self.metrics())
+                last = turn - 1 if due else turn
+                if last >= next_record:
+                    # The whole quiet stretch at once; the turn of an event is recorded below
+                    recorder.record_settled(self, start_turn + 1, last, start_money)
+                    next_record += (last - next_record) // recorder.every * recorder.every + recorder.every
+                self.money, self.time_elapsed = money, turn
+                if not due:
+                    break
+            if due:
+                started = self.fire_events()
+                if started is not None:
+                    events.append({'turn': self.time_elapsed, 'event': started[0], 'message': started[1]})
+            if record_every and self.time_elapsed % record_every == 0:
+                history.append(self.metrics())
+            if self.time_elapsed == next_record:
+                recorder.record(self)
+                next_record += recorder.every
+        return {'turns': turns, 'events': events, 'history': history, 'final': self.metrics()}
 
     def apply_economic_event(self, money_change: int, employment_change: float, confidence_change: float):
         self.money += money_change
         self.economy.employment_rate = max(0.1, min(1.0, self.economy.employment_rate + employment_change))
         self.economy.business_confidence = max(0.1, min(1.0, self.economy.business_confidence + confidence_change))
 
-    def reduce_maintenance_costs(self, factor: float):
+    def scale_maintenance_costs(self, factor: float):
         for building_type in self.maintenance_costs:
             self.maintenance_costs[building_type] *= factor
 
+    def reduce_maintenance_costs(self, factor: float):
+        self.scale_maintenance_costs(factor)
+
     def increase_maintenance_costs(self, factor: float):
-        for building_type in self.maintenance_costs:
-            self.maintenance_costs[building_type] *= factor
+        self.scale_maintenance_costs(factor)
 
-def display_grid(city: City):
-    print("\n  " + " ".join(str(i) for i in range(city.grid_size)))
-    for y in range(city.grid_size):
-        print(f"{y}", end=" ")
-        for x in range(city.grid_size):
-            cell = city.grid[y][x]
-            infra = []
-            if city.infrastructure.has_connection(x, y, 'POWER'):
-                infra.append('P')
-            if city.infrastructure.has_connection(x, y, 'ROAD'):
-                infra.append('R')
-            if city.infrastructure.has_connection(x, y, 'WATER'):
-                infra.append('W')
-            
-            if cell:
-                print(cell, end=" ")
-            elif infra:
-                print('+', end=" ")  # Show infrastructure with +
-            else:
-                print('.', end=" ")
-        print()
+    def apply_urban_decay(self, region: Tuple[int, int, int, int]) -> dict:
+        """Drop every R, C and I building in the region back to its first density level."""
+        buildings = 0
+        for x, y in rect_cells(*region, self.grid_size):
+            upgrades = self.density_layer.get(x, y)
+            if upgrades:
+                self.density_layer.set(x, y, 0)
+                self.zone_upgrades[CODE_TO_BUILDING[self.grid_layer.get(x, y)]] -= upgrades
+                buildings += 1
+        if buildings:
+            self.stats_version += 1
+        return {'buildings': buildings}
+
+# Loaded after City so every definition's effect is checked against its methods
+EVENTS = load_event_definitions(EVENT_DEFINITIONS)
+
+# Byte translation tables used to render whole map rows at once: a building
+# letter wins over '+' (any infrastructure), which wins over '.' (empty).
+_BUILDING_GLYPHS = bytes(ord(CODE_TO_BUILDING[code]) if code in CODE_TO_BUILDING and code else 0
+                         for code in range(256))
+_INFRA_GLYPHS = bytes([ord('.')] + [ord('+')] * 255)
+
+def render_row(city: City, y: int, start: int = 0, stop: int = None) -> str:
+    buildings = city.grid_layer.row(y, start, stop).translate(_BUILDING_GLYPHS)
+    infra = city.infrastructure.layer.row(y, start, stop).translate(_INFRA_GLYPHS)
+    return bytes(map(max, buildings, infra)).decode('ascii')
+
+def render_chunk(city: City, cx: int, cy: int) -> str:
+    """One character summing up a chunk: its most common building, '+' for bare infrastructure, else '.'."""
+    histogram = city.grid_layer.chunk_histogram(cx, cy)
+    count, code = max((count, code) for code, count in enumerate(histogram) if code)
+    if count:
+        return CODE_TO_BUILDING[code]
+    return '+' if city.infrastructure.layer.chunk_histogram(cx, cy)[0] < CHUNK_CELLS else '.'
+
+VIEWPORT_SIZE = 40
+
+def viewport_origin(city: City, x: int, y: int) -> Tuple[int, int]:
+    """Top-left corner of the default viewport that keeps (x, y) in view."""
+    limit = max(0, city.grid_size - VIEWPORT_SIZE)
+    return (max(0, min(x - VIEWPORT_SIZE // 2, limit)),
+            max(0, min(y - VIEWPORT_SIZE // 2, limit)))
+
+def _layout(x0: int, x1: int, y0: int, y1: int, rows: List[str]) -> str:
+    # Column headers show the last digit so wide viewports stay aligned
+    label_width = len(str(y1 - 1))
+    lines = [" " * (label_width + 1) + " ".join(str(i % 10) for i in range(x0, x1))]
+    for y, row in zip(range(y0, y1), rows):
+        lines.append(f"{y:>{label_width}} " + " ".join(row) + " ")
+    return "\n".join(lines)
+
+def render_grid(city: City, x0: int = 0, y0: int = 0, width: int = VIEWPORT_SIZE, height: int = VIEWPORT_SIZE) -> str:
+    """The viewport as one string; the work depends on the viewport, not the map size."""
+    x1 = min(city.grid_size, x0 + width)
+    y1 = min(city.grid_size, y0 + height)
+    return _layout(x0, x1, y0, y1, [render_row(city, y, x0, x1) for y in range(y0, y1)])
+
+def render_overview(city: City, cx0: int = 0, cy0: int = 0, width: int = VIEWPORT_SIZE,
+                    height: int = VIEWPORT_SIZE) -> str:
+    """A zoomed-out viewport with one character per chunk, labelled with chunk coordinates."""
+    chunks = -(-city.grid_size // CHUNK_SIZE)
+    cx1 = min(chunks, cx0 + width)
+    cy1 = min(chunks, cy0 + height)
+    return _layout(cx0, cx1, cy0, cy1, ["".join(render_chunk(city, cx, cy) for cx in range(cx0, cx1))
+                                        for cy in range(cy0, cy1)])
+
+def display_grid(city: City, x0: int = 0, y0: int = 0, width: int = VIEWPORT_SIZE, height: int = VIEWPORT_SIZE):
+    print("\n" + render_grid(city, x0, y0, width, height))
+
+def display_overview(city: City, cx0: int = 0, cy0: int = 0):
+    print(f"\nOverview: one character per {CHUNK_SIZE}x{CHUNK_SIZE} chunk")
+    print(render_overview(city, cx0, cy0))
+
+class LiveView:
+    """Keeps a viewport drawn in place at the top of an ANSI terminal."""
+
+    def __init__(self, out=None):
+        self.out = out
+        self.viewport = None
+        self.rows: List[str] = []
+
+    def draw(self, city: City, x0: int = 0, y0: int = 0, width: int = VIEWPORT_SIZE, height: int = VIEWPORT_SIZE):
+        out = self.out or sys.stdout
+        x1 = min(city.grid_size, x0 + width)
+        y1 = min(city.grid_size, y0 + height)
+        rows = [render_row(city, y, x0, x1) for y in range(y0, y1)]
+        viewport = (x0, y0, x1, y1)
+        if viewport != self.viewport:
+            # Map on screen lines 1.. (header first), the scrolling region below it
+            frame = ("\x1b[r\x1b[2J\x1b[H" + _layout(x0, x1, y0, y1, rows) +
+                     f"\x1b[{len(rows) + 3};r\x1b[{len(rows) + 3};1H")
+        else:
+            # Same viewport: rewrite only the cells that changed since the last frame
+            label_width = len(str(y1 - 1))
+            parts = ["\x1b7"]
+            for line, (old, new) in enumerate(zip(self.rows, rows), start=2):
+                if old == new:
+                    continue
+                for i, (before, after) in enumerate(zip(old, new)):
+                    if before != after:
+                        parts.append(f"\x1b[{line};{label_width + 2 + 2 * i}H{after}")
+            parts.append("\x1b8")
+            frame = "".join(parts) if len(parts) > 2 else ""
+        self.viewport, self.rows = viewport, rows
+        out.write(frame)
+        out.flush()
+
+    def close(self):
+        """Give the whole screen back to normal scrolling output."""
+        if self.viewport is not None:
+            (self.out or sys.stdout).write("\x1b[r\n")
+        self.viewport = None
+        self.rows = []
 
 def display_stats(city: City):
     print(f"\n=== {city.name} Statistics ===")
     print(f"Money: ${city.money:,.2f}")
     print(f"Population: {city.population:,}")
     print(f"Happiness: {city.happiness}%")
+    print("Average Density: " + ", ".join(
+        f"{zone} {1 + levels / max(city.building_counts[zone], 1):.2f}"
+        for zone, levels in city.zone_upgrades.items()))
     print(f"Tax Rate: {city.tax_rate}%")
     print(f"Employment Rate: {city.economy.employment_rate*100:.1f}%")
     print(f"Business Confidence: {city.economy.business_confidence*100:.1f}%")
@@ -333,13 +2483,9 @@ def audit_city(city: City):
     print(f"\n=== Detailed Audit of {city.name} ===")
     
     # Building counts and costs
-    building_counts = {'R': 0, 'C': 0, 'I': 0, 'P': 0, 'H': 0, 'S': 0, 'F': 0}
-    total_investment = 0
-    for row in city.grid:
-        for cell in row:
-            if cell:
-                building_counts[cell] += 1
-                total_investment += city.get_building_cost(cell)
+    building_counts = city.count_buildings()
+    total_investment = sum(city.get_building_cost(building_type) * count
+                           for building_type, count in building_counts.items())
 
     # Infrastructure coverage
     total_cells = city.grid_size * city.grid_size
@@ -356,6 +2502,19 @@ def audit_city(city: City):
     print(f"Power Grid: {power_coverage:.1f}%")
     print(f"Road Network: {road_coverage:.1f}%")
     print(f"Water System: {water_coverage:.1f}%")
+    print(f"Fully Serviced Cells: {city.infrastructure.connected_count:,}")
+
+    print(f"\nService Coverage (share of homes in range):")
+    homes = max(city.building_counts['R'], 1)
+    for service, covered in city.covered_residents.items():
+        print(f"{city.get_building_name(service)}: {covered / homes * 100:.1f}%")
+
+    commuters, travel_time, free_flow_time, congested = city.infrastructure.traffic.refresh()
+    print(f"\nTraffic:")
+    print(f"Commuting Homes: {commuters:,} of {city.building_counts['R']:,}")
+    print(f"Average Commute: {travel_time / max(commuters, 1):.1f} turns")
+    print(f"Congestion Delay: {city.commute_congestion() * 100:.1f}%")
+    print(f"Congested Road Tiles: {congested:,}")
 
     print(f"\nFinancial Summary:")
     print(f"Total Infrastructure Investment: ${total_investment:,.2f}")
@@ -378,6 +2537,8 @@ def display_economy(city: City):
     print(f"Employment Rate: {city.economy.employment_rate*100:.1f}%")
     print(f"Business Confidence: {city.economy.business_confidence*100:.1f}%")
     print(f"Inflation Rate: {city.economy.inflation_rate*100:.1f}%")
+    for end, key in sorted(city.scheduler.active):
+        print(f"Active Event: {key} until turn {end}")
 
     print("\nSector Analysis:")
     total_jobs = sum(sector['jobs'] for sector in city.economy.sectors.values())
@@ -409,22 +2570,191 @@ def display_economy(city: City):
     print(f"Jobs per Resident: {jobs_per_resident:.2f}")
     print(f"City Wealth Rating: {'Wealthy' if city.money > 100000 else 'Stable' if city.money > 50000 else 'Growing' if city.money > 10000 else 'Struggling'}")
 
-def save_game(city: City, filename: str):
-    """Save the current game state to a file."""
-    save_data = city.to_dict()
-    
+def display_profile(report: dict):
+    print("\n=== Profile ===")
+    print(f"{'Phase':<20}{'Calls':>8}{'Total ms':>11}{'Mean us':>10}{'Max us':>10}"
+          f"{'Cells':>12}{'Road tiles':>12}{'Alloc KiB':>11}")
+    for name, totals in sorted(report['phases'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:<20}{totals['calls']:>8,}{totals['seconds'] * 1000:>11.2f}"
+              f"{totals['seconds'] / totals['calls'] * 1e6:>10.1f}{totals['max_seconds'] * 1e6:>10.1f}"
+              f"{totals['cells_scanned']:>12,}{totals['road_tiles_solved']:>12,}{totals['allocated'] / 1024:>11.1f}")
+    for name, value in sorted(report['counters'].items()):
+        print(f"{name}: {value:,}")
+    if 'peak_memory' in report:
+        print(f"Traced memory: {report['traced_memory'] / 1024:,.1f} KiB (peak {report['peak_memory'] / 1024:,.1f} KiB)")
+
+def display_metrics(rows: Dict[str, list]):
+    print("\n=== Metrics ===")
+    print(f"{'Turn':>8}{'Money':>16}{'Population':>12}{'Happiness':>11}{'GDP':>14}"
+          f"{'Employment':>12}{'Confidence':>12}{'Tax income':>12}{'Maintenance':>13}")
+    for index, turn in enumerate(rows['turn']):
+        print(f"{turn:>8}{rows['money'][index]:>16,.2f}{rows['population'][index]:>12,.0f}"
+              f"{rows['happiness'][index]:>10.1f}%{rows['gdp'][index]:>14,.2f}"
+              f"{rows['employment_rate'][index]:>11.1%}{rows['business_confidence'][index]:>12.1%}"
+              f"{rows['tax_income'][index]:>12,.2f}{rows['maintenance'][index]:>13,.2f}")
+    if not rows['turn']:
+        print("No turns recorded in that range")
+
+# Binary saves: fixed prelude, JSON header, then the raw layer chunks. The
+# chunk data starts on a page boundary so each chunk maps to whole pages.
+SAVE_MAGIC = b'CSIM'
+SAVE_VERSION = 1
+SAVE_PRELUDE = struct.Struct('<4sHxxI')  # magic, version, header length
+
+def _write_atomically(filepath: str, write):
+    # Write next to the target and rename over it, so a save that is still
+    # memory-mapped by a loaded city is never truncated underneath it. The
+    # temporary name is unique, so concurrent saves of one name don't mix.
+    directory, name = os.path.split(filepath)
+    descriptor, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            write(f)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+def save_binary(city: City, filepath: str):
+    header = city.to_dict(include_layers=False)
+    header['building_counts'] = city.building_counts
+    header['zone_upgrades'] = city.zone_upgrades
+    header['connected_count'] = city.infrastructure.connected_count
+    header['covered_residents'] = city.covered_residents
+    header['commutes'] = city.infrastructure.traffic.refresh()
+    header['chunk_size'] = CHUNK_SIZE
+    layers = [('grid', city.grid_layer), ('infrastructure', city.infrastructure.layer),
+              ('density', city.density_layer)]
+    # Chunk offsets are relative to the start of the data section, so the
+    # header's own length doesn't feed back into it
+    chunk_keys = [layer.chunk_keys() for _, layer in layers]
+    chunk_tables = {}
+    offset = 0
+    for (layer_name, _), keys in zip(layers, chunk_keys):
+        chunk_tables[layer_name] = [[cx, cy, offset + index * CHUNK_CELLS] for index, (cx, cy) in enumerate(keys)]
+        offset += len(keys) * CHUNK_CELLS
+    header['layers'] = chunk_tables
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(SAVE_PRELUDE.size + len(header_bytes)) // mmap.PAGESIZE) * mmap.PAGESIZE
+
+    def write(f):
+        f.write(SAVE_PRELUDE.pack(SAVE_MAGIC, SAVE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(bytes(data_start - SAVE_PRELUDE.size - len(header_bytes)))
+        for (_, layer), keys in zip(layers, chunk_keys):
+            layer.write_chunks(f, keys)
+    _write_atomically(filepath, write)
+
+def load_binary(filepath: str) -> City:
+    """Memory-map a binary save; layer chunks are read from disk when first used."""
+    with open(filepath, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _read_binary_header(f)
+        header_length = f.tell() - SAVE_PRELUDE.size
+    if header['chunk_size'] != CHUNK_SIZE:
+        raise ValueError(f"Unsupported chunk size {header['chunk_size']}")
+    data_start = -(-(SAVE_PRELUDE.size + header_length) // mmap.PAGESIZE) * mmap.PAGESIZE
+    size = header['grid_size']
+    grid_layer = GridLayer.from_buffer(buffer, data_start, header['layers']['grid'], size, len(BUILDING_TYPES))
+    infrastructure = Infrastructure(size, GridLayer.from_buffer(
+        buffer, data_start, header['layers']['infrastructure'], size, FULLY_CONNECTED), grid_layer)
+    infrastructure.connected_count = header['connected_count']
+    if 'commutes' in header:
+        infrastructure.traffic.totals = tuple(header['commutes'])
+    density_layer = None
+    if 'density' in header['layers']:
+        density_layer = GridLayer.from_buffer(buffer, data_start, header['layers']['density'], size, MAX_DENSITY - 1)
+    return City.from_dict(header, grid_layer, infrastructure, density_layer)
+
+# Fields a save catalog entry takes from the save's header
+CATALOG_FIELDS = ('name', 'money', 'population', 'grid_size', 'time_elapsed')
+_JSON_DECODER = json.JSONDecoder()
+_JSON_SEPARATOR = re.compile(r'\s*[,:]?\s*')
+
+def _read_binary_header(f) -> dict:
+    magic, version, header_length = SAVE_PRELUDE.unpack(f.read(SAVE_PRELUDE.size))
+    if magic != SAVE_MAGIC or version != SAVE_VERSION:
+        raise ValueError(f"Not a version {SAVE_VERSION} city save")
+    return json.loads(f.read(header_length))
+
+def _read_json_header(f, fields) -> dict:
+    # Decode one top-level key and value at a time from a growing prefix of
+    # the file, stopping as soon as every wanted field has been seen
+    header = {}
+    text = f.read(4096)
+    start = re.match(r'\s*\{', text)
+    if start is None:
+        raise ValueError("Not a JSON city save")
+    position = start.end()
+    at_end = False
+    while not set(fields) <= header.keys():
+        try:
+            position = _JSON_SEPARATOR.match(text, position).end()
+            if text.startswith('}', position):
+                break
+            key, after_key = _JSON_DECODER.raw_decode(text, position)
+            value, after_value = _JSON_DECODER.raw_decode(text, _JSON_SEPARATOR.match(text, after_key).end())
+            # A number cut off by the end of the prefix would decode short
+            if after_value == len(text) and not at_end:
+                raise json.JSONDecodeError("Truncated value", text, after_value)
+        except json.JSONDecodeError:
+            if at_end:
+                raise
+            more = f.read(len(text))
+            at_end = not more
+            text += more
+            continue
+        header[key] = value
+        position = after_value
+    return header
+
+def read_save_header(filepath: str, fields=CATALOG_FIELDS) -> dict:
+    """A save's city fields without reading its map.
+
+    Binary saves return their whole JSON header. JSON saves are decoded
+    key by key only until every name in `fields` has been seen.
+    """
+    if filepath.endswith('.city'):
+        with open(filepath, 'rb') as f:
+            return _read_binary_header(f)
+    with open(filepath, 'r') as f:
+        return _read_json_header(f, fields)
+
+# Save names are plain file names: no path separators and no leading '.',
+# so a save can't leave its directory or clash with the catalog
+SAVE_NAME = re.compile(r'[^./\\\x00][^/\\\x00]*')
+
+def save_path(filename: str, extension: str, directory: str = 'saves') -> str:
+    """Where the save `filename` goes in `directory`; raises ValueError for names that would leave it."""
+    if not SAVE_NAME.fullmatch(filename):
+        raise ValueError(f"Invalid save name {filename!r}")
+    return os.path.join(directory, f"{filename}{extension}")
+
+def save_game(city: City, filename: str, binary: bool = True, directory: str = 'saves'):
+    """Save the current game state to a file (binary by default, JSON for export)."""
+    filepath = save_path(filename, '.city' if binary else '.json', directory)
     # Ensure the saves directory exists
-    os.makedirs('saves', exist_ok=True)
+    os.makedirs(directory, exist_ok=True)
     
     # Save to file
-    filepath = os.path.join('saves', f"{filename}.json")
-    with open(filepath, 'w') as f:
-        json.dump(save_data, f)
+    if binary:
+        save_binary(city, filepath)
+    else:
+        save_data = city.to_dict()
+        _write_atomically(filepath, lambda f: f.write(json.dumps(save_data).encode('utf-8')))
     print(f"\nGame saved successfully to {filepath}")
 
-def load_game(filename: str) -> City:
-    """Load a game state from a file."""
-    filepath = os.path.join('saves', f"{filename}.json")
+def load_game(filename: str, directory: str = 'saves') -> City:
+    """Load a game state from a file, preferring the binary save over a JSON one."""
+    filepath = save_path(filename, '.city', directory)
+    if os.path.exists(filepath):
+        try:
+            return load_binary(filepath)
+        except (ValueError, struct.error):
+            print(f"Error reading save file at {filepath}")
+            return None
+    filepath = save_path(filename, '.json', directory)
     try:
         with open(filepath, 'r') as f:
             save_data = json.load(f)
@@ -436,34 +2766,238 @@ def load_game(filename: str) -> City:
         print(f"Error reading save file at {filepath}")
         return None
 
-def list_saved_games():
-    """List all available save files."""
-    if not os.path.exists('saves'):
+# Save file extensions and the kind of save they hold
+SAVE_KINDS = {'.city': 'city', '.json': 'json', '.autosave': 'autosave'}
+
+class SaveCatalog:
+    """Index of the saves in a directory, refreshed from their mtimes."""
+
+    def __init__(self, directory: str = 'saves'):
+        self.directory = directory
+        self.index_path = os.path.join(directory, '.catalog')
+        # file name -> the save's name, kind, city name, turn, money, population,
+        # grid size, file size and mtime; autosaves describe their latest checkpoint
+        self.entries: Dict[str, dict] = {}
+        self.loaded = False
+
+    def refresh(self) -> List[dict]:
+        """Bring the index up to date with the directory; returns the entries sorted by name."""
+        if not self.loaded:
+            self.loaded = True
+            try:
+                with open(self.index_path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        entries = {}
+        changed = False
+        try:
+            scan = os.scandir(self.directory)
+        except FileNotFoundError:
+            scan = contextlib.nullcontext([])
+        with scan as items:
+            for item in items:
+                name, extension = os.path.splitext(item.name)
+                kind = SAVE_KINDS.get(extension)
+                if kind is None or item.is_dir() != (kind == 'autosave'):
+                    continue
+                # Only saves whose size or mtime changed have their header read again
+                stat = item.stat()
+                entry = self.entries.get(item.name)
+                if entry is None or entry['stat'] != [stat.st_mtime_ns, stat.st_size]:
+                    entry = self._read_entry(item.path, name, kind, stat)
+                    changed = True
+                entries[item.name] = entry
+        if changed or entries.keys() != self.entries.keys():
+            self.entries = entries
+            if os.path.isdir(self.directory):
+                _write_atomically(self.index_path, lambda f: f.write(json.dumps(entries).encode('utf-8')))
+        return sorted(self.entries.values(), key=lambda entry: (entry['name'], entry['kind']))
+
+    def _read_entry(self, path: str, name: str, kind: str, stat: os.stat_result) -> dict:
+        entry = {'name': name, 'kind': kind, 'stat': [stat.st_mtime_ns, stat.st_size], 'mtime': stat.st_mtime,
+                 'file_size': stat.st_size, 'city': None, 'turn': None, 'money': None, 'population': None,
+                 'grid_size': None}
+        try:
+            if kind == 'autosave':
+                checkpoints = sorted(filename for filename in os.listdir(path)
+                                     if filename.startswith('checkpoint-') and filename.endswith('.city'))
+                path = os.path.join(path, checkpoints[-1])
+                entry['file_size'] = os.path.getsize(path)
+            header = read_save_header(path)
+            entry.update(city=header['name'], turn=header['time_elapsed'], money=header['money'],
+                         population=header['population'], grid_size=header['grid_size'])
+        except (OSError, IndexError, KeyError, ValueError, struct.error):
+            pass  # listed as unreadable until the file changes
+        return entry
+
+
+# Catalogs already read in this process, by directory
+_save_catalogs: Dict[str, SaveCatalog] = {}
+
+def save_catalog(directory: str = 'saves') -> SaveCatalog:
+    """The catalog of `directory`, read from its index file on first use."""
+    catalog = _save_catalogs.get(directory)
+    if catalog is None:
+        catalog = _save_catalogs[directory] = SaveCatalog(directory)
+    return catalog
+
+def forget_save_catalog(directory: str):
+    """Drop the catalog of a directory that won't be listed again, e.g. once it is removed."""
+    _save_catalogs.pop(directory, None)
+
+def list_saved_games(directory: str = 'saves'):
+    """List all available save files with their cities; returns the names load_game accepts."""
+    entries = save_catalog(directory).refresh()
+    if not entries:
         print("No saved games found.")
         return []
-    
-    saves = [f[:-5] for f in os.listdir('saves') if f.endswith('.json')]
-    if not saves:
-        print("No saved games found.")
+
+    print("\nAvailable saved games:")
+    for entry in entries:
+        label = f"{entry['name']} ({entry['kind']})"
+        if entry['city'] is None:
+            print(f"- {label}: unreadable")
+            continue
+        modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['mtime']))
+        print(f"- {label}: {entry['city']}, turn {entry['turn']}, ${entry['money']:,.0f}, "
+              f"population {entry['population']:,}, {entry['grid_size']}x{entry['grid_size']} map, "
+              f"{entry['file_size'] / 1024:,.1f} KiB, saved {modified}")
+    return sorted({entry['name'] for entry in entries if entry['kind'] != 'autosave'})
+
+class ActionJournal:
+    """Autosave that appends every action to a log instead of rewriting the city."""
+
+    def __init__(self, directory: str, city: City, checkpoint_every: int = 100, seq: int = 0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.checkpoint_every = checkpoint_every
+        self.seq = seq
+        self.since_checkpoint = 0
+        self.segment = None
+        self.compactor = None
+        self.checkpoint(city)
+
+    def _path(self, kind: str, seq: int) -> str:
+        # checkpoint-<seq>.city is a full binary save; segment-<seq>.log holds
+        # one JSON line per action after it
+        extension = 'city' if kind == 'checkpoint' else 'log'
+        return os.path.join(self.directory, f"{kind}-{seq:012d}.{extension}")
+
+    def record(self, city: City, action: str, *args, event: str = None):
+        """Append one successful action; `event` is the outcome of a turn."""
+        self.seq += 1
+        entry = {'seq': self.seq, 'action': action, 'args': list(args)}
+        if action == 'turn':
+            entry['event'] = event
+        self.segment.write(json.dumps(entry) + '\n')
+        self.segment.flush()
+        self.since_checkpoint += 1
+        if self.since_checkpoint >= self.checkpoint_every:
+            self.checkpoint(city)
+
+    def checkpoint(self, city: City):
+        save_binary(city, self._path('checkpoint', self.seq))
+        if self.segment is not None:
+            self.segment.close()
+        self.segment = open(self._path('segment', self.seq), 'a')
+        self.since_checkpoint = 0
+        # The checkpoints and segments this one supersedes are deleted in the background
+        if self.compactor is not None:
+            self.compactor.join()
+        self.compactor = threading.Thread(target=self._compact, args=(self.seq,), daemon=True)
+        self.compactor.start()
+
+    def _compact(self, seq: int):
+        for filename in os.listdir(self.directory):
+            parsed = _parse_journal_filename(filename)
+            if parsed is not None and parsed[1] < seq:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        if self.compactor is not None:
+            self.compactor.join()
+            self.compactor = None
+
+    @classmethod
+    def recover(cls, directory: str, checkpoint_every: int = 100):
+        """Load the latest checkpoint, replay the journal tail and resume journaling."""
+        files = [parsed + (filename,) for filename in os.listdir(directory)
+                 for parsed in [_parse_journal_filename(filename)] if parsed is not None]
+        checkpoints = sorted(seq for kind, seq, _ in files if kind == 'checkpoint')
+        if not checkpoints:
+            raise FileNotFoundError(f"No checkpoint in {directory}")
+        seq = checkpoints[-1]
+        city = load_binary(os.path.join(directory, f"checkpoint-{seq:012d}.city"))
+        segments = sorted((start, filename) for kind, start, filename in files
+                          if kind == 'segment' and start >= seq)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _, filename in segments:
+                with open(os.path.join(directory, filename)) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            break  # torn write at the end of the log
+                        if entry['seq'] <= seq:
+                            continue
+                        apply_journal_entry(city, entry)
+                        seq = entry['seq']
+        return city, cls(directory, city, checkpoint_every, seq)
+
+
+def _parse_journal_filename(filename: str):
+    match = re.fullmatch(r'(checkpoint|segment)-(\d+)\.(?:city|log)', filename)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+def apply_journal_entry(city: City, entry: dict):
+    action, args = entry['action'], entry['args']
+    if action == 'build':
+        city.build(*args)
+    elif action == 'demolish':
+        demolish(city, *args)
+    elif action in BULK_ACTIONS:
+        BULK_ACTIONS[action](city, *args)
+    elif action == 'refresh':
+        city.update_city_stats()
+    elif action == 'tax':
+        city.tax_rate = args[0]
+        # Sessions that defer the refresh record it as its own action
+        if len(args) < 2 or args[1]:
+            city.update_city_stats()
+    elif action == 'run':
+        city.run(*args)
+    elif action == 'turn':
+        events = city.run(1)['events']
+        event = events[0]['event'] if events else None
+        if event != entry['event']:
+            raise RuntimeError(f"Journal replay diverged at action {entry['seq']}: "
+                               f"expected event {entry['event']}, got {event}")
     else:
-        print("\nAvailable saved games:")
-        for save in saves:
-            print(f"- {save}")
-    return saves
+        raise ValueError(f"Unknown journal action {action!r}")
+
 
+def demolish(city: City, x: int, y: int, update_stats: bool = True) -> bool:
+    """Demolish a building or infrastructure at the given coordinates.
 
-def demolish(city: City, x: int, y: int) -> bool:
-    """Demolish a building or infrastructure at the given coordinates."""
+    With update_stats=False the stats refresh and the success message are
+    left to the caller, as for build().
+    """
     if not (0 <= x < city.grid_size and 0 <= y < city.grid_size):
         print("Invalid coordinates!")
         return False
 
     demolished = False
     # Remove building if present
-    if city.grid[y][x] is not None:
-        building_type = city.grid[y][x]
-        city.grid[y][x] = None
-        city.buildings = [(bx, by, bt) for bx, by, bt in city.buildings if bx != x or by != y]
+    if city.remove_building(x, y) is not None:
         demolished = True
     
     # Remove infrastructure
@@ -473,32 +3007,601 @@ def demolish(city: City, x: int, y: int) -> bool:
             demolished = True
 
     if demolished:
-        print("Successfully demolished!")
-        city.update_city_stats()
+        city.stats_version += 1
+        if update_stats:
+            print("Successfully demolished!")
+            city.update_city_stats()
         return True
     else:
         print("Nothing to demolish at these coordinates.")
         return False
 
+def line_cells(x1: int, y1: int, x2: int, y2: int) -> List[Tuple[int, int]]:
+    """Cells of a 4-connected line from (x1, y1) to (x2, y2), so roads and lines along it join up."""
+    dx, dy = abs(x2 - x1), abs(y2 - y1)
+    step_x = 1 if x2 >= x1 else -1
+    step_y = 1 if y2 >= y1 else -1
+    x, y = x1, y1
+    cells = [(x, y)]
+    taken_x = taken_y = 0
+    while taken_x < dx or taken_y < dy:
+        # Step along whichever axis keeps the path closest to the straight line
+        if (1 + 2 * taken_x) * dy < (1 + 2 * taken_y) * dx:
+            x += step_x
+            taken_x += 1
+        else:
+            y += step_y
+            taken_y += 1
+        cells.append((x, y))
+    return cells
+
+def rect_cells(x1: int, y1: int, x2: int, y2: int, size: int = None) -> List[Tuple[int, int]]:
+    """Every cell of the rectangle with corners (x1, y1) and (x2, y2), inclusive.
+
+    With `size`, only the cells on a size x size map, so a huge rectangle
+    costs no more than the map.
+    """
+    left, right = min(x1, x2), max(x1, x2)
+    top, bottom = min(y1, y2), max(y1, y2)
+    if size is not None:
+        left, top = max(left, 0), max(top, 0)
+        right, bottom = min(right, size - 1), min(bottom, size - 1)
+    return [(x, y) for y in range(top, bottom + 1) for x in range(left, right + 1)]
+
+def build_cells(city: City, cells: List[Tuple[int, int]], building_type: str) -> Dict[str, int]:
+    """Build on many cells without refreshing the stats; returns how many were built and why others weren't."""
+    outcome = defaultdict(int)
+    for x, y in cells:
+        error = city.build_error(x, y, building_type)
+        if error is None:
+            city.build(x, y, building_type, update_stats=False)
+            outcome['built'] += 1
+        else:
+            outcome[error] += 1
+    return dict(outcome)
+
+def build_line(city: City, x1: int, y1: int, x2: int, y2: int, building_type: str) -> Dict[str, int]:
+    return build_cells(city, line_cells(x1, y1, x2, y2), building_type)
+
+def build_zone(city: City, x1: int, y1: int, x2: int, y2: int, building_type: str) -> Dict[str, int]:
+    return build_cells(city, rect_cells(x1, y1, x2, y2, city.grid_size), building_type)
+
+def clear_zone(city: City, x1: int, y1: int, x2: int, y2: int) -> Dict[str, int]:
+    """Demolish everything in a rectangle without refreshing the stats."""
+    cleared = 0
+    for x, y in rect_cells(x1, y1, x2, y2, city.grid_size):
+        if city.building_at(x, y) is not None or city.infrastructure.layer.get(x, y):
+            demolish(city, x, y, update_stats=False)
+            cleared += 1
+    return {'cleared': cleared}
+
+# Journal actions for the bulk operations, replayed by apply_journal_entry
+BULK_ACTIONS = {'line': build_line, 'zone': build_zone, 'clear': clear_zone}
+
 def display_help():
     print("\nAvailable Commands:")
     print("build x y type - Build at coordinates (x,y). Types:")
     print("                 R(esidential), C(ommercial), I(ndustrial)")
     print("                 P(ark), H(ospital), S(chool), F(ire Station)")
+    print("                 E (Power Plant), T (Water Tower) feed adjacent lines/pipes")
     print("                 POWER, ROAD, WATER (infrastructure)")
     print("demolish x y   - Remove building at coordinates (x,y)")
-    print("map           - Display city map")
+    print("map [x y]     - Display city map (viewport from x,y on large maps)")
+    print("zoom [x y]    - Zoomed-out map, one character per chunk")
+    print("live on|off  - Keep the map drawn in place, redrawing only changed cells (ANSI)")
     print("stats        - Display city statistics")
     print("audit        - Display detailed city report")
     print("economy      - Display detailed economic report")
     print("save name    - Save current game")
+    print("export name  - Save current game as JSON")
     print("load name    - Load a saved game")
+    print("autosave name [n] - Journal every action, checkpointing every n actions")
+    print("recover name - Restore an autosaved game from its journal")
     print("saves        - List all saved games")
     print("tax rate     - Set tax rate (0-20)")
+    print("run turns    - Fast-forward a number of turns")
+    print("line x1 y1 x2 y2 type - Build along a line, e.g. a road")
+    print("zone x1 y1 x2 y2 type - Build on every free cell of a rectangle")
+    print("clear x1 y1 x2 y2 - Demolish everything in a rectangle")
+    print("profile [turns|on|off] - Profile some turns, or every command until off")
+    print("undo / redo  - Take back the last change (and the turns since), or redo it")
+    print("branch [name] - List what-if branches, or start a new one from here")
+    print("switch name  - Go to another branch; the current one keeps its state")
+    print("metrics on [name [n]] - Record metrics every n turns, flushed to saves/name.metrics")
+    print("metrics [first last [step]] - Show recorded metrics, averaged over blocks of step turns")
+    print("metrics csv name | off - Export the recorded metrics to saves/name.csv, or stop recording")
     print("help         - Show this help message")
     print("exit         - Exit game")
 
+# Commands whose effect undo can take back
+UNDOABLE_COMMANDS = {'build', 'demolish', 'line', 'zone', 'clear', 'tax', 'run'}
+# Commands that move between snapshots and so don't simulate a turn
+HISTORY_COMMANDS = {'undo', 'redo', 'branch', 'switch'}
+UNDO_LIMIT = 100
+
+class CommandSession:
+    """Runs text commands against one city, as typed at the prompt or read from a script."""
+
+    def __init__(self, city: City, interactive: bool = True, save_directory: str = 'saves',
+                 undo_history: bool = None):
+        self.city = city
+        # Interactive sessions show the map and simulate a turn after every command
+        self.interactive = interactive
+        # Whether undoable commands snapshot the city, by default only when interactive
+        self.undo_history = interactive if undo_history is None else undo_history
+        # Where save, load, autosave and metrics files go
+        self.save_directory = save_directory
+        self.journal = None
+        # Actions recorded so far, journaled or not
+        self.actions = 0
+        # Changes made since the stats were last refreshed
+        self.stale = False
+        self.finished = False
+        # LiveView while the map is kept on screen with ANSI diffs
+        self.live = None
+        # (snapshot, stale) before each undoable command, and those undone
+        self.undo_stack = deque(maxlen=UNDO_LIMIT)
+        self.redo_stack = []
+        # What-if branches other than the current one: name -> (snapshot, stale)
+        self.branches = {}
+        self.current_branch = 'main'
+        # command -> (method, minimum number of arguments)
+        self.commands = {
+            'save': (self.save, 1), 'export': (self.export, 1), 'load': (self.load, 1),
+            'autosave': (self.autosave, 1), 'recover': (self.recover, 1), 'saves': (self.saves, 0),
+            'help': (self.help, 0), 'map': (self.map, 0), 'zoom': (self.zoom, 0), 'live': (self.live_view, 1),
+            'stats': (self.stats, 0),
+            'audit': (self.audit, 0), 'economy': (self.economy, 0), 'tax': (self.tax, 1),
+            'run': (self.run, 1), 'profile': (self.profile, 0), 'build': (self.build, 3),
+            'demolish': (self.demolish, 2), 'line': (self.line, 5), 'zone': (self.zone, 5),
+            'clear': (self.clear, 4), 'undo': (self.undo, 0), 'redo': (self.redo, 0),
+            'branch': (self.branch, 0), 'switch': (self.switch, 1), 'metrics': (self.metrics, 0),
+            'exit': (self.exit, 0),
+        }
+
+    def record(self, action: str, *args, event: str = None):
+        self.actions += 1
+        if self.journal is not None:
+            self.journal.record(self.city, action, *args, event=event)
+
+    def changed(self):
+        # Batch sessions refresh once for a whole run of changes, just before something reads the stats
+        self.stale = True
+        if self.interactive:
+            self.refresh()
+
+    def refresh(self):
+        """Bring the stats up to date after changes whose refresh was deferred."""
+        if self.stale:
+            self.city.update_city_stats()
+            self.record('refresh')
+            self.stale = False
+
+    def turn(self):
+        self.refresh()
+        self.record('turn', event=self.city.simulate_turn())
+
+    def execute(self, line: str):
+        command = line.lower().split()
+        if not command:
+            return
+        try:
+            handler = self.commands.get(command[0])
+            if handler is None or len(command) - 1 < handler[1]:
+                print("Invalid command. Type 'help' for available commands.")
+            else:
+                snapshot = None
+                if self.undo_history and command[0] in UNDOABLE_COMMANDS:
+                    snapshot, actions = self.snapshot(), self.actions
+                handler[0](command[1:])
+                # A command rejected before changing anything takes no undo slot
+                if snapshot is not None and self.actions != actions:
+                    self.undo_stack.append(snapshot)
+                    self.redo_stack.clear()
+        except Exception as e:
+            print(f"An error occurred: {str(e)}")
+            print("Please try again or type 'help' for available commands.")
+        # Simulate a turn after each valid command
+        if self.interactive and not self.finished and command[0] not in HISTORY_COMMANDS:
+            self.turn()
+
+    def close(self):
+        self.refresh()
+        if self.city.metrics_recorder is not None:
+            self.city.metrics_recorder.close()
+        if self.live is not None:
+            self.live.close()
+            self.live = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def exit(self, args: List[str]):
+        self.finished = True
+
+    def snapshot(self) -> tuple:
+        return self.city.snapshot(), self.stale
+
+    def restore(self, entry: tuple):
+        snapshot, self.stale = entry
+        self.city.restore(snapshot)
+        if self.journal is not None:
+            # Replaying the journal can't jump back in time, so start it afresh here
+            self.journal.checkpoint(self.city)
+        if self.interactive:
+            self.show_map()
+
+    def forget_history(self):
+        """Drop the undo history and branches, e.g. once another city is loaded."""
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.branches.clear()
+
+    def undo(self, args: List[str]):
+        if not self.undo_stack:
+            print("Nothing to undo" if self.undo_history else "Undo history is off in this session")
+            return
+        self.redo_stack.append(self.snapshot())
+        self.restore(self.undo_stack.pop())
+        print(f"Undone; back to turn {self.city.time_elapsed}")
+
+    def redo(self, args: List[str]):
+        if not self.redo_stack:
+            print("Nothing to redo")
+            return
+        self.undo_stack.append(self.snapshot())
+        self.restore(self.redo_stack.pop())
+        print(f"Redone; now at turn {self.city.time_elapsed}")
+
+    def branch(self, args: List[str]):
+        if not args:
+            for name in sorted(set(self.branches) | {self.current_branch}):
+                print(f"{'*' if name == self.current_branch else ' '} {name}")
+            return
+        name = args[0]
+        if name == self.current_branch or name in self.branches:
+            print(f"Branch {name} already exists")
+            return
+        self.branches[self.current_branch] = self.snapshot()
+        self.current_branch = name
+        print(f"Started branch {name}")
+
+    def switch(self, args: List[str]):
+        name = args[0]
+        if name == self.current_branch:
+            print(f"Already on branch {name}")
+            return
+        if name not in self.branches:
+            print(f"No branch named {name}")
+            return
+        self.branches[self.current_branch] = self.snapshot()
+        self.current_branch = name
+        # Undo only goes back within the branch
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.restore(self.branches.pop(name))
+        print(f"Switched to branch {name} (turn {self.city.time_elapsed})")
+
+    def _save_path(self, name: str, extension: str) -> str:
+        try:
+            return save_path(name, extension, self.save_directory)
+        except ValueError:
+            print("Invalid save name: use a plain name without '/', '\\' or a leading '.'")
+            return None
+
+    def save(self, args: List[str]):
+        if self._save_path(args[0], '.city') is None:
+            return
+        self.refresh()
+        save_game(self.city, args[0], directory=self.save_directory)
+
+    def export(self, args: List[str]):
+        if self._save_path(args[0], '.json') is None:
+            return
+        self.refresh()
+        save_game(self.city, args[0], binary=False, directory=self.save_directory)
+
+    def load(self, args: List[str]):
+        if self._save_path(args[0], '.city') is None:
+            return
+        loaded_city = load_game(args[0], self.save_directory)
+        if loaded_city:
+            loaded_city.metrics_recorder = self.city.metrics_recorder
+            self.city = loaded_city
+            self.stale = False
+            self.forget_history()
+            print(f"Loaded game: {self.city.name}")
+            if self.journal is not None:
+                self.journal.checkpoint(self.city)
+
+    def autosave(self, args: List[str]):
+        try:
+            checkpoint_every = int(args[1]) if len(args) > 1 else 100
+        except ValueError:
+            print("Invalid checkpoint interval")
+            return
+        directory = self._save_path(args[0], '.autosave')
+        if directory is None:
+            return
+        self.refresh()
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = ActionJournal(directory, self.city, checkpoint_every)
+        print(f"Autosaving to {self.journal.directory}")
+
+    def recover(self, args: List[str]):
+        directory = self._save_path(args[0], '.autosave')
+        if directory is None:
+            return
+        if os.path.isdir(directory):
+            if self.journal is not None:
+                self.journal.close()
+            recorder = self.city.metrics_recorder
+            self.city, self.journal = ActionJournal.recover(directory)
+            self.city.metrics_recorder = recorder
+            self.stale = False
+            self.forget_history()
+            print(f"Recovered game: {self.city.name} (turn {self.city.time_elapsed})")
+        else:
+            print(f"No autosave found at {directory}")
+
+    def saves(self, args: List[str]):
+        list_saved_games(self.save_directory)
+
+    def help(self, args: List[str]):
+        display_help()
+
+    def show_map(self, x0: int = 0, y0: int = 0):
+        if self.live is not None:
+            self.live.draw(self.city, x0, y0)
+        else:
+            display_grid(self.city, x0, y0)
+
+    def map(self, args: List[str]):
+        try:
+            if len(args) >= 2:
+                self.show_map(int(args[0]), int(args[1]))
+            else:
+                self.show_map()
+        except ValueError:
+            print("Invalid coordinates")
+
+    def zoom(self, args: List[str]):
+        coordinates = self._coordinates(args[:2]) if len(args) >= 2 else [0, 0]
+        if coordinates is not None:
+            display_overview(self.city, coordinates[0] // CHUNK_SIZE, coordinates[1] // CHUNK_SIZE)
+
+    def live_view(self, args: List[str]):
+        if args[0] == "on":
+            if self.live is None:
+                self.live = LiveView()
+            self.show_map()
+        elif args[0] == "off" and self.live is not None:
+            self.live.close()
+            self.live = None
+
+    def stats(self, args: List[str]):
+        self.refresh()
+        display_stats(self.city)
+
+    def audit(self, args: List[str]):
+        self.refresh()
+        audit_city(self.city)
+
+    def economy(self, args: List[str]):
+        self.refresh()
+        display_economy(self.city)
+
+    def tax(self, args: List[str]):
+        try:
+            new_rate = float(args[0])
+        except ValueError:
+            print("Invalid tax rate")
+            return
+        if 0 <= new_rate <= 20:
+            self.city.tax_rate = new_rate
+            print(f"Tax rate set to {new_rate}%")
+            self.record('tax', new_rate, False)
+            self.changed()
+        else:
+            print("Tax rate must be between 0 and 20%")
+
+    def run(self, args: List[str]):
+        try:
+            turns = int(args[0])
+        except ValueError:
+            print("Invalid number of turns")
+            return
+        self.refresh()
+        result = self.city.run(turns)
+        self.record('run', result['turns'])
+        print(f"Fast-forwarded {result['turns']} turns, {len(result['events'])} events")
+        for event in result['events'][-5:]:
+            print(f"Turn {event['turn']}: {event['message']}")
+        if self.interactive:
+            display_stats(self.city)
+
+    def profile(self, args: List[str]):
+        city = self.city
+        argument = args[0] if args else "100"
+        if argument == "on":
+            if city.instrumentation is None:
+                Instrumentation(trace_allocations=True).attach(city)
+            print("Profiling every turn; 'profile off' shows the report")
+        elif argument == "off":
+            instrumentation = city.instrumentation
+            if instrumentation is not None:
+                instrumentation.detach(city)
+                display_profile(instrumentation.report())
+                instrumentation.close()
+        else:
+            try:
+                turns = int(argument)
+            except ValueError:
+                print("Invalid number of turns")
+                return
+            self.refresh()
+            previous = city.instrumentation
+            instrumentation = Instrumentation(trace_allocations=True)
+            instrumentation.attach(city)
+            try:
+                for _ in range(turns):
+                    self.turn()
+            finally:
+                instrumentation.detach(city)
+                report = instrumentation.report()
+                instrumentation.close()
+                if previous is not None:
+                    previous.attach(city)
+            display_profile(report)
+
+    def metrics(self, args: List[str]):
+        recorder = self.city.metrics_recorder
+        if args and args[0] == "on":
+            try:
+                every = int(args[2]) if len(args) > 2 else 1
+                if every < 1:
+                    raise ValueError
+            except ValueError:
+                print("Invalid number of turns")
+                return
+            path = None
+            if len(args) > 1:
+                path = self._save_path(args[1], '.metrics')
+                if path is None:
+                    return
+                os.makedirs(self.save_directory, exist_ok=True)
+            if recorder is not None:
+                recorder.close()
+            MetricsRecorder(path, every).attach(self.city)
+            print(f"Recording metrics every {every} turns" + (f" to {path}" if path else ""))
+            return
+        if recorder is None:
+            print("Metrics aren't being recorded; 'metrics on' starts recording")
+        elif args and args[0] == "off":
+            recorder.close()
+            recorder.detach(self.city)
+            print("Stopped recording metrics")
+        elif args and args[0] == "csv":
+            if len(args) < 2:
+                print("Usage: metrics csv name")
+                return
+            path = self._save_path(args[1], '.csv')
+            if path is None:
+                return
+            recorder.export_csv(path)
+            print(f"Exported metrics to {path}")
+        else:
+            try:
+                numbers = [int(arg) for arg in args[:3]]
+            except ValueError:
+                print("Invalid turn range")
+                return
+            if not numbers:
+                # The last ten recorded turns
+                numbers = [self.city.time_elapsed - 9 * recorder.every, self.city.time_elapsed]
+            last = numbers[1] if len(numbers) > 1 else None
+            step = numbers[2] if len(numbers) > 2 else 1
+            display_metrics(recorder.query(numbers[0], last, step=step))
+
+    def _coordinates(self, args: List[str]) -> List[int]:
+        try:
+            return [int(arg) for arg in args]
+        except ValueError:
+            print("Invalid coordinates")
+            return None
+
+    def build(self, args: List[str]):
+        coordinates = self._coordinates(args[:2])
+        if coordinates is None:
+            return
+        x, y = coordinates
+        building_type = args[2].upper()
+        if self.city.build(x, y, building_type, update_stats=False):
+            self.record('build', x, y, building_type, False)
+            self.changed()
+            if self.interactive:
+                print(f"Successfully built {self.city.get_building_name(building_type)}")
+                self.turn()
+                self.show_map(*viewport_origin(self.city, x, y))
+
+    def demolish(self, args: List[str]):
+        coordinates = self._coordinates(args[:2])
+        if coordinates is None:
+            return
+        x, y = coordinates
+        if demolish(self.city, x, y, update_stats=False):
+            self.record('demolish', x, y, False)
+            self.changed()
+            if self.interactive:
+                print("Successfully demolished!")
+                self.turn()
+                self.show_map(*viewport_origin(self.city, x, y))
+
+    def _bulk(self, action: str, coordinates: List[int], *args):
+        outcome = BULK_ACTIONS[action](self.city, *coordinates, *args)
+        self.record(action, *coordinates, *args)
+        self.changed()
+        print(", ".join(f"{reason}: {count}" for reason, count in outcome.items()) or "Nothing to do")
+        if self.interactive:
+            self.show_map(*viewport_origin(self.city, coordinates[0], coordinates[1]))
+
+    def line(self, args: List[str]):
+        coordinates = self._coordinates(args[:4])
+        if coordinates is not None:
+            self._bulk('line', coordinates, args[4].upper())
+
+    def zone(self, args: List[str]):
+        coordinates = self._coordinates(args[:4])
+        if coordinates is not None:
+            self._bulk('zone', coordinates, args[4].upper())
+
+    def clear(self, args: List[str]):
+        coordinates = self._coordinates(args[:4])
+        if coordinates is not None:
+            self._bulk('clear', coordinates)
+
+def run_script(city: City, lines, undo_history: bool = False) -> City:
+    """Run commands from an iterable of lines as one batch; '#' starts a comment.
+
+    undo and redo only work in a script run with undo_history.
+    """
+    session = CommandSession(city, interactive=False, undo_history=undo_history)
+    try:
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            session.execute(line)
+            if session.finished:
+                break
+    finally:
+        session.close()
+    return session.city
+
 def main():
+    parser = argparse.ArgumentParser(description="Text SimCity")
+    parser.add_argument('script', nargs='?',
+                        help="run the commands in this file ('-' for stdin) as one batch instead of playing")
+    parser.add_argument('--load', metavar='SAVE', help="city to start the script from")
+    parser.add_argument('--name', default="Scripted City", help="name of a new city for the script")
+    parser.add_argument('--size', type=int, default=10, help="map size of a new city for the script")
+    parser.add_argument('--undo', action='store_true', help="keep undo history while running the script")
+    args = parser.parse_args()
+    if args.script is not None:
+        try:
+            city = load_game(args.load) if args.load else City(args.name, args.size)
+        except ValueError as e:
+            parser.error(str(e))
+        if city is None:
+            sys.exit(1)
+        if args.script == '-':
+            run_script(city, sys.stdin, args.undo)
+        else:
+            with open(args.script) as f:
+                run_script(city, f, args.undo)
+        return
+
     print("Welcome to Text SimCity!")
     print("\n1. New Game")
     print("2. Load Game")
@@ -509,101 +3612,35 @@ def main():
         saves = list_saved_games()
         if saves:
             save_name = input("Enter the name of the save to load: ")
-            city = load_game(save_name)
+            try:
+                city = load_game(save_name)
+            except ValueError as e:
+                print(e)
     
     if city is None:
         city_name = input("Enter your city name: ")
-        city = City(city_name)
+        size_text = input("Enter map size (default 10): ").strip()
+        try:
+            city = City(city_name, int(size_text) if size_text else 10)
+        except ValueError:
+            print("Invalid map size, using 10")
+            city = City(city_name)
     
     print(f"\nYou are now the mayor of {city.name}")
     display_help()
 
-    while True:
-        try:
-            command = input("\nEnter command: ").lower().split()
-            
-            if not command:
-                continue
+    session = CommandSession(city)
+    try:
+        while not session.finished:
+            session.execute(input("\nEnter command: "))
+    except EOFError:
+        session.close()
+        return
 
-            if command[0] == "exit":
-                save_choice = input("Would you like to save before exiting? (y/n): ")
-                if save_choice.lower() == 'y':
-                    save_name = input("Enter save name: ")
-                    save_game(city, save_name)
-                break
-                
-            elif command[0] == "save" and len(command) > 1:
-                save_name = command[1]
-                save_game(city, save_name)
-                
-            elif command[0] == "load" and len(command) > 1:
-                save_name = command[1]
-                loaded_city = load_game(save_name)
-                if loaded_city:
-                    city = loaded_city
-                    print(f"Loaded game: {city.name}")
-                    
-            elif command[0] == "saves":
-                list_saved_games()
-                
-            elif command[0] == "help":
-                display_help()
-                
-            elif command[0] == "map":
-                display_grid(city)
-                
-            elif command[0] == "stats":
-                display_stats(city)
-                
-            elif command[0] == "audit":
-                audit_city(city)
-                
-            elif command[0] == "economy":
-                display_economy(city)
-                
-            elif command[0] == "tax" and len(command) > 1:
-                try:
-                    new_rate = float(command[1])
-                    if 0 <= new_rate <= 20:
-                        city.tax_rate = new_rate
-                        print(f"Tax rate set to {new_rate}%")
-                        city.update_city_stats()
-                    else:
-                        print("Tax rate must be between 0 and 20%")
-                except ValueError:
-                    print("Invalid tax rate")
-                    
-            elif command[0] == "build" and len(command) >= 4:
-                try:
-                    x = int(command[1])
-                    y = int(command[2])
-                    building_type = command[3].upper()
-                    if city.build(x, y, building_type):
-                        print(f"Successfully built {city.get_building_name(building_type)}")
-                        city.simulate_turn()
-                        display_grid(city)
-                except ValueError:
-                    print("Invalid coordinates")
-                    
-            elif command[0] == "demolish" and len(command) >= 3:
-                try:
-                    x = int(command[1])
-                    y = int(command[2])
-                    if demolish(city, x, y):
-                        city.simulate_turn()
-                        display_grid(city)
-                except ValueError:
-                    print("Invalid coordinates")
-                    
-            else:
-                print("Invalid command. Type 'help' for available commands.")
-                
-        except Exception as e:
-            print(f"An error occurred: {str(e)}")
-            print("Please try again or type 'help' for available commands.")
-        
-        # Simulate a turn after each valid command
-        city.simulate_turn()
+    save_choice = input("Would you like to save before exiting? (y/n): ")
+    if save_choice.lower() == 'y':
+        session.save([input("Enter save name: ")])
+    session.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,267 @@
+import argparse
+import json
+import math
+import os
+import random
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Sequence, Tuple
+
+from benchmark import populate
+from economy_batch import JOBS_PER_BUILDING, SECTORS
+from main import BUILDING_TYPES, City
+
+# What each city publishes after its turn, one row of float64 per city.
+# Every traded resource has a surplus it offers and a shortfall it wants.
+FIELDS = ['money', 'population', 'gdp', 'jobs_surplus', 'jobs_shortfall', 'goods_surplus', 'goods_shortfall',
+          'power_surplus', 'power_shortfall']
+ROW = struct.Struct(f"<{len(FIELDS)}d")
+# How a unit of each resource shows up in the Economy sectors, as
+# (sector, jobs, income) for the city buying it and for the one selling it:
+# commuters earn wages at home and add to their employer's output,
+# factories sell goods to shops, and power plants sell to households.
+TRADE_RESOURCES = {
+    'jobs': (('R', 1, 150.0), ('C', 0, 50.0)),
+    'goods': (('C', 0, 40.0), ('I', 0, 100.0)),
+    'power': (('R', 0, -20.0), ('I', 0, 20.0)),
+}
+GOODS_PER_FACTORY = 10
+GOODS_PER_SHOP = 10
+# Buildings one power plant can supply
+POWER_PLANT_CAPACITY = 50
+
+# The cities living in this worker process, by index in the region, and
+# the region's shared rows. Each city is pinned to one worker for the
+# region's lifetime, so only the published rows cross processes.
+_cities: Dict[int, City] = {}
+_neighbours: List[Tuple[int, ...]] = []
+_shared = None
+
+
+def region_neighbours(count: int, width: int) -> List[Tuple[int, ...]]:
+    """Indexes of the cities left, right, above and below each city on a grid `width` cities wide."""
+    neighbours = []
+    for index in range(count):
+        x, y = index % width, index // width
+        neighbours.append(tuple(other for other, inside in (
+            (index - width, y > 0), (index - 1, x > 0), (index + 1, x + 1 < width and index + 1 < count),
+            (index + width, index + width < count)) if inside))
+    return neighbours
+
+
+def published_row(city: City) -> tuple:
+    """The row a city publishes for its neighbours to trade against."""
+    counts = city.building_counts
+    zones = city.zone_counts()
+    jobs = sum(zones[sector] * JOBS_PER_BUILDING[sector] for sector in SECTORS) - city.population
+    goods = counts['I'] * GOODS_PER_FACTORY - counts['C'] * GOODS_PER_SHOP
+    power = counts['E'] * POWER_PLANT_CAPACITY - (sum(counts.values()) - counts['E'])
+    return (city.money, city.population, city.economy.gdp, max(jobs, 0), max(-jobs, 0), max(goods, 0),
+            max(-goods, 0), max(power, 0), max(-power, 0))
+
+
+def exchange(rows: List[tuple], neighbours: List[Tuple[int, ...]], indexes) -> Dict[int, tuple]:
+    """The Economy.trade of each city in `indexes` from every city's published row.
+
+    A city offers its surplus of a resource in equal shares to its
+    neighbours. A city short of it buys everything offered, or the same
+    fraction of every offer when that is more than it needs. The result
+    only depends on the rows, never on which cities are asked about.
+    """
+    # Per resource: what each city offers every neighbour, and is offered in all
+    offers = []
+    for column in range(len(TRADE_RESOURCES)):
+        surplus = 3 + 2 * column
+        offer = [row[surplus] / len(near) if near else 0.0 for row, near in zip(rows, neighbours)]
+        offers.append((offer, [sum(offer[other] for other in near) for near in neighbours]))
+    trades = {}
+    for index in indexes:
+        totals = {}
+        for column, rules in enumerate(TRADE_RESOURCES.values()):
+            offer, offered = offers[column]
+            shortfall = 4 + 2 * column
+            bought = min(rows[index][shortfall], offered[index])
+            sold = 0.0
+            if offer[index]:
+                for other in neighbours[index]:
+                    wanted = rows[other][shortfall]
+                    if wanted:
+                        sold += offer[index] * min(1.0, wanted / offered[other])
+            for (sector, jobs, income), amount in zip(rules, (bought, sold)):
+                if amount:
+                    total = totals.setdefault(sector, [0.0, 0.0])
+                    total[0] += jobs * amount
+                    total[1] += income * amount
+        trades[index] = tuple((sector, *totals[sector]) for sector in SECTORS if sector in totals)
+    return trades
+
+
+def _init_worker(shared_name: str, count: int, width: int):
+    global _shared, _neighbours
+    _shared = SharedMemory(shared_name)
+    _neighbours = region_neighbours(count, width)
+
+
+def _rows(parity: int) -> List[tuple]:
+    count = len(_neighbours)
+    start = parity * count * ROW.size
+    return list(ROW.iter_unpack(_shared.buf[start:start + count * ROW.size]))
+
+
+def _publish(index: int, parity: int, city: City):
+    ROW.pack_into(_shared.buf, (parity * len(_neighbours) + index) * ROW.size, *published_row(city))
+
+
+def _load_cities(cities: List[Tuple[int, dict]], parity: int):
+    for index, data in cities:
+        city = _cities[index] = City.from_dict(data)
+        _publish(index, parity, city)
+
+
+def _tick(parity: int) -> int:
+    """Advance this worker's cities one turn, trading against the rows in `parity`; returns the events started."""
+    trades = exchange(_rows(parity), _neighbours, _cities)
+    started = 0
+    for index, city in _cities.items():
+        city.economy.trade = trades[index]
+        started += len(city.run(1)['events'])
+        _publish(index, 1 - parity, city)
+    return started
+
+
+def _dump() -> Dict[int, dict]:
+    return {index: city.to_dict() for index, city in _cities.items()}
+
+
+class Region:
+    """Cities on a grid `width` cities wide that trade jobs, goods and power with their neighbours."""
+
+    def __init__(self, cities: List[City], width: int, workers: int = None):
+        self.count = len(cities)
+        self.width = width
+        # Which half of the shared block holds the rows of the last turn; the
+        # next turn trades against them and publishes into the other half, so
+        # results don't depend on the number of workers or their order
+        self.parity = 0
+        self.turns = 0
+        self.shared = SharedMemory(create=True, size=max(2 * self.count * ROW.size, 1))
+        workers = max(1, min(workers or os.cpu_count() or 1, self.count))
+        self.workers = [ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                            initargs=(self.shared.name, self.count, width))
+                        for _ in range(workers)]
+        # A contiguous block of cities per worker
+        shards = [range(self.count * worker // workers, self.count * (worker + 1) // workers)
+                  for worker in range(workers)]
+        futures = [worker.submit(_load_cities, [(index, cities[index].to_dict()) for index in shard], self.parity)
+                   for worker, shard in zip(self.workers, shards)]
+        for future in futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown()
+        self.shared.close()
+        self.shared.unlink()
+
+    def run(self, turns: int, record_every: int = 0) -> dict:
+        """Advance every city `turns` turns; `record_every` > 0 adds region totals to the history."""
+        history = []
+        events = 0
+        for _ in range(turns):
+            futures = [worker.submit(_tick, self.parity) for worker in self.workers]
+            events += sum(future.result() for future in futures)
+            self.parity ^= 1
+            self.turns += 1
+            if record_every and self.turns % record_every == 0:
+                history.append(dict(self.totals(), turn=self.turns))
+        return {'turns': turns, 'events': events, 'history': history}
+
+    def rows(self) -> List[tuple]:
+        """Every city's latest published row, in city order."""
+        start = self.parity * self.count * ROW.size
+        return list(ROW.iter_unpack(self.shared.buf[start:start + self.count * ROW.size]))
+
+    def totals(self) -> Dict[str, float]:
+        rows = self.rows()
+        return {field: math.fsum(row[column] for row in rows) for column, field in enumerate(FIELDS)}
+
+    def digest(self) -> int:
+        """Checksum of the latest rows, equal for equal results."""
+        start = self.parity * self.count * ROW.size
+        return zlib.crc32(self.shared.buf[start:start + self.count * ROW.size])
+
+    def cities(self) -> List[City]:
+        """Copies of the cities as they are now, in city order."""
+        data = {}
+        for worker in self.workers:
+            data.update(worker.submit(_dump).result())
+        return [City.from_dict(data[index]) for index in range(self.count)]
+
+
+def random_region(count: int, size: int = 16, density: float = 0.3, seed: int = 0) -> List[City]:
+    """`count` cities with about `density` of their cells built on, each with its own mix of buildings."""
+    rng = random.Random(seed)
+    cities = []
+    for index in range(count):
+        # Squared weights make most cities lean towards a few building types
+        weights = [rng.random() ** 2 for _ in BUILDING_TYPES]
+        city = populate(size, density, rng.getrandbits(64), weights, money=10 ** 6)
+        city.name = f"City {index}"
+        cities.append(city)
+    return cities
+
+
+def benchmark_scaling(count: int = 1000, size: int = 16, turns: int = 20, worker_counts: Sequence[int] = None,
+                      seed: int = 0) -> dict:
+    """Time the same region with each number of workers and check that they all end up identical."""
+    if worker_counts is None:
+        cores = os.cpu_count() or 1
+        worker_counts = sorted({1, cores} | {2 ** power for power in range(1, cores.bit_length())})
+    cities = random_region(count, size, seed=seed)
+    width = max(1, math.isqrt(count))
+    results = []
+    for workers in worker_counts:
+        with Region(cities, width, workers) as region:
+            started = time.perf_counter()
+            region.run(turns)
+            elapsed = time.perf_counter() - started
+            results.append({
+                'workers': len(region.workers),
+                'seconds': elapsed,
+                'city_turns_per_sec': count * turns / elapsed,
+                'speedup': results[0]['seconds'] / elapsed if results else 1.0,
+                'digest': region.digest()
+            })
+    return {
+        'cities': count,
+        'grid_size': size,
+        'turns': turns,
+        'cpu_count': os.cpu_count(),
+        'identical': len({result['digest'] for result in results}) <= 1,
+        'results': results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a region of trading cities on 1 to N worker processes.")
+    parser.add_argument('--cities', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=16, help="map size of each city")
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help="worker counts to time (default: 1, 2, 4, ... up to the CPU count)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(benchmark_scaling(args.cities, args.size, args.turns, args.workers, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import secrets
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from ensemble import percentile
+from main import BUILDING_TYPES, City, CommandSession, forget_save_catalog
+
+# Sessions living in this worker process, by session id. Every session is
+# pinned to one worker, so its city is never copied between processes and
+# its commands run in order.
+_sessions: Dict[int, CommandSession] = {}
+
+
+def _open_session(session_id: int, name: str, size: int, save_directory: str) -> str:
+    old = _sessions.pop(session_id, None)
+    if old is not None:
+        old.close()
+    _sessions[session_id] = CommandSession(City(name, size), save_directory=save_directory)
+    return f"You are now the mayor of {name}\n"
+
+
+def _execute(session_id: int, line: str) -> Tuple[str, bool]:
+    """Run one command for a session; returns its output and whether the session ended."""
+    session = _sessions[session_id]
+    output = io.StringIO()
+    # Worker processes run one command at a time, so redirecting stdout is safe
+    with contextlib.redirect_stdout(output):
+        session.execute(line)
+        if session.finished:
+            _close_session(session_id)
+    return output.getvalue(), session.finished
+
+
+def _close_session(session_id: int):
+    session = _sessions.pop(session_id, None)
+    if session is not None:
+        session.close()
+        # The directory belongs to this connection alone, so nothing can load from it later
+        shutil.rmtree(session.save_directory, ignore_errors=True)
+        forget_save_catalog(session.save_directory)
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` commands per second in bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Take a token; returns how long to wait before the command may run."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class CityServer:
+    """Serves CommandSession commands to many clients over TCP or a Unix socket."""
+
+    def __init__(self, workers: int = None, rate: float = 20.0, burst: int = 40, max_pending: int = 1000,
+                 max_line: int = 4096, saves_root: str = os.path.join('saves', 'sessions'),
+                 max_size: int = 1000, max_turns: int = 10000, max_area: int = 10000):
+        self.workers = [ProcessPoolExecutor(max_workers=1) for _ in range(workers or os.cpu_count() or 1)]
+        self.rate = rate
+        self.burst = burst
+        self.max_pending = max_pending
+        self.max_line = max_line
+        self.saves_root = saves_root
+        # Largest map, run and bulk rectangle one request may ask for, so no
+        # client can tie up the worker its session shares with others
+        self.max_size = max_size
+        self.max_turns = max_turns
+        self.max_area = max_area
+        self.pending = None
+        self.session_ids = itertools.count(1)
+        self.active_sessions = 0
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765, unix_path: str = None):
+        self.pending = asyncio.Semaphore(self.max_pending)
+        # Start the worker processes before accepting anything, so they don't
+        # inherit client sockets and keep them open after the server closes them
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(worker, int) for worker in self.workers))
+        if unix_path is not None:
+            return await asyncio.start_unix_server(self.handle, unix_path, limit=self.max_line, backlog=4096)
+        return await asyncio.start_server(self.handle, host, port, limit=self.max_line, backlog=4096)
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown(cancel_futures=True)
+
+    def over_limit(self, words: List[str]) -> str:
+        """Why a command asks for more than one request may, or None."""
+        try:
+            if words[:1] == ['new'] and len(words) > 2 and int(words[2]) > self.max_size:
+                return f"Map size is limited to {self.max_size}"
+            if words[:1] in (['run'], ['profile']) and len(words) > 1 and int(words[1]) > self.max_turns:
+                return f"At most {self.max_turns} turns per request"
+            if words[:1] in (['line'], ['zone'], ['clear']) and len(words) > 4:
+                x1, y1, x2, y2 = (int(word) for word in words[1:5])
+                if (abs(x2 - x1) + 1) * (abs(y2 - y1) + 1) > self.max_area:
+                    return f"At most {self.max_area} cells per request"
+        except ValueError:
+            pass  # the session reports malformed numbers itself
+        return None
+
+    async def _call(self, worker: ProcessPoolExecutor, function, *args):
+        async with self.pending:
+            return await asyncio.get_running_loop().run_in_executor(worker, function, *args)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Each session is pinned to one worker, so a slow city only holds up
+        # the sessions sharing it
+        session_id = next(self.session_ids)
+        worker = self.workers[session_id % len(self.workers)]
+        limiter = RateLimiter(self.rate, self.burst)
+        # Unguessable, so mayors can't load or overwrite each other's saves;
+        # removed again when the connection closes
+        save_directory = os.path.join(self.saves_root, secrets.token_hex(16))
+        self.active_sessions += 1
+        try:
+            await self._call(worker, _open_session, session_id, f"City {session_id}", 10, save_directory)
+            # One command per line, and nothing more is read until its reply is sent
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(b"Line too long\n.\n")
+                    break
+                if not line:
+                    break
+                text = line.decode('utf-8', errors='replace').strip()
+                # A JSON request {"id": ..., "command": ...} gets a JSON line back
+                request_id, command, is_json = None, text, text.startswith('{')
+                if is_json:
+                    try:
+                        request = json.loads(text)
+                        request_id, command = request.get('id'), str(request.get('command', ''))
+                    except (ValueError, AttributeError):
+                        writer.write(json.dumps({'id': None, 'error': "Invalid JSON request"}).encode() + b'\n')
+                        await writer.drain()
+                        continue
+                delay = limiter.delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                words = command.split()
+                error = self.over_limit([word.lower() for word in words])
+                if error is not None:
+                    if is_json:
+                        writer.write(json.dumps({'id': request_id, 'error': error}).encode() + b'\n')
+                    else:
+                        writer.write(f"{error}\n.\n".encode())
+                    await writer.drain()
+                    continue
+                if words[:1] == ['new']:
+                    try:
+                        size = int(words[2]) if len(words) > 2 else 10
+                        if size < 1:
+                            raise ValueError
+                        output = await self._call(worker, _open_session, session_id,
+                                                  words[1] if len(words) > 1 else f"City {session_id}", size,
+                                                  save_directory)
+                    except ValueError:
+                        output = "Invalid map size\n"
+                    finished = False
+                else:
+                    output, finished = await self._call(worker, _execute, session_id, command)
+                if is_json:
+                    writer.write(json.dumps({'id': request_id, 'output': output, 'finished': finished}).encode()
+                                 + b'\n')
+                else:
+                    # Plain output ends with a line holding only '.'; lines starting with '.' get another
+                    lines = ['.' + line if line.startswith('.') else line for line in output.splitlines()]
+                    writer.write(("\n".join(lines + ['.']) + "\n").encode())
+                await writer.drain()
+                if finished:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            with contextlib.suppress(Exception):
+                await self._call(worker, _close_session, session_id)
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+            self.active_sessions -= 1
+
+
+async def _client_session(connect, commands: List[str], latencies: List[float]):
+    reader, writer = await connect()
+    try:
+        for request_id, command in enumerate(commands):
+            started = time.perf_counter()
+            writer.write(json.dumps({'id': request_id, 'command': command}).encode() + b'\n')
+            await writer.drain()
+            reply = json.loads(await reader.readline())
+            if reply.get('id') != request_id:
+                raise RuntimeError(f"Out of order reply {reply!r}")
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+        with contextlib.suppress(ConnectionError):
+            await writer.wait_closed()
+
+
+def _script(rng: random.Random, length: int) -> List[str]:
+    """A plausible mix of commands for one simulated mayor."""
+    commands = []
+    for _ in range(length):
+        roll = rng.random()
+        if roll < 0.5:
+            commands.append(f"build {rng.randrange(10)} {rng.randrange(10)} {rng.choice(BUILDING_TYPES).lower()}")
+        elif roll < 0.6:
+            commands.append(f"demolish {rng.randrange(10)} {rng.randrange(10)}")
+        elif roll < 0.7:
+            commands.append(f"tax {rng.randrange(21)}")
+        elif roll < 0.9:
+            commands.append(rng.choice(['stats', 'economy', 'audit']))
+        else:
+            commands.append(f"run {rng.randrange(1, 50)}")
+    return commands
+
+
+async def load_test(sessions: int, commands: int, host: str = '127.0.0.1', port: int = 8765,
+                    unix_path: str = None, seed: int = 0) -> dict:
+    """Drive `sessions` concurrent clients through `commands` commands each and report throughput and latency."""
+    if unix_path is not None:
+        connect = lambda: asyncio.open_unix_connection(unix_path)
+    else:
+        connect = lambda: asyncio.open_connection(host, port)
+    rng = random.Random(seed)
+    scripts = [_script(rng, commands) + ['exit'] for _ in range(sessions)]
+    latencies = []
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_client_session(connect, script, latencies) for script in scripts),
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    failures = [result for result in results if isinstance(result, BaseException)]
+    return {
+        'sessions': sessions,
+        'failed_sessions': len(failures),
+        'commands': len(latencies),
+        'seconds': elapsed,
+        'commands_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': {f"p{percent}": percentile(latencies, percent) * 1000 if latencies else None
+                       for percent in (50, 90, 99)},
+        'first_error': repr(failures[0]) if failures else None
+    }
+
+
+async def _serve(args):
+    server = CityServer(args.workers, args.rate, args.burst, args.max_pending, saves_root=args.saves,
+                        max_size=args.max_size, max_turns=args.max_turns, max_area=args.max_area)
+    listener = await server.start(args.host, args.port, args.unix)
+    print(f"Serving on {args.unix or f'{args.host}:{args.port}'} with {len(server.workers)} workers")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.shutdown()
+
+
+async def _load_test(args):
+    server = None
+    if args.local:
+        # Run a server in this process so the test needs no separate setup
+        server = CityServer(args.workers, args.rate, args.burst, args.max_pending, saves_root=args.saves,
+                            max_size=args.max_size, max_turns=args.max_turns, max_area=args.max_area)
+        listener = await server.start(args.host, args.port, args.unix)
+    try:
+        report = await load_test(args.sessions, args.commands, args.host, args.port, args.unix, args.seed)
+    finally:
+        if server is not None:
+            listener.close()
+            # Let the handlers finish closing their sessions first
+            while server.active_sessions:
+                await asyncio.sleep(0.01)
+            server.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host many city sessions over a socket.")
+    subcommands = parser.add_subparsers(dest='mode', required=True)
+    serve = subcommands.add_parser('serve', help="run the server")
+    test = subcommands.add_parser('load-test', help="drive many concurrent sessions against a server")
+    for subparser in (serve, test):
+        subparser.add_argument('--host', default='127.0.0.1')
+        subparser.add_argument('--port', type=int, default=8765)
+        subparser.add_argument('--unix', metavar='PATH', help="use a Unix socket instead of TCP")
+        subparser.add_argument('--workers', type=int, default=None)
+        subparser.add_argument('--rate', type=float, default=20.0, help="commands per second per session")
+        subparser.add_argument('--burst', type=int, default=40)
+        subparser.add_argument('--max-pending', type=int, default=1000,
+                               help="commands queued for the workers before connections wait")
+        subparser.add_argument('--saves', default=os.path.join('saves', 'sessions'),
+                               help="directory holding each connection's save directory")
+        subparser.add_argument('--max-size', type=int, default=1000, help="largest map a session may start")
+        subparser.add_argument('--max-turns', type=int, default=10000, help="most turns one run may ask for")
+        subparser.add_argument('--max-area', type=int, default=10000,
+                               help="most cells one line, zone or clear may cover")
+    test.add_argument('--sessions', type=int, default=1000)
+    test.add_argument('--commands', type=int, default=20, help="commands per session")
+    test.add_argument('--seed', type=int, default=0)
+    test.add_argument('--local', action='store_true', help="start a server in this process first")
+    args = parser.parse_args()
+    asyncio.run(_serve(args) if args.mode == 'serve' else _load_test(args))
+
+
+if __name__ == "__main__":
+    main()
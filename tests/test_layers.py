@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from main import GridLayer
+
+
+def _cells(layer):
+    return {(x, y): value for x, y, value in layer.nonzero()}
+
+
+def _expected_differences(saved, current):
+    """What differences() should report: the saved value of every cell that has changed since."""
+    return {cell: saved.get(cell, 0) for cell in set(saved) | set(current)
+            if saved.get(cell, 0) != current.get(cell, 0)}
+
+
+def check_snapshots(seed, trials, arrays=False):
+    """Random writes, snapshots and dropped snapshots, checking differences() against plain dict copies."""
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.choice([10, 70, 140])
+        layer = GridLayer(size, 7)
+        saved = {}
+        for _ in range(300):
+            roll = rng.random()
+            if roll < 0.6:
+                for _ in range(rng.randrange(1, 20)):
+                    layer.set(rng.randrange(size), rng.randrange(size), rng.choice([0, 0, 1, 3, 7]))
+            elif roll < 0.7 and arrays:
+                x0, y0 = rng.randrange(size), rng.randrange(size)
+                width, height = rng.randrange(1, size - x0 + 1), rng.randrange(1, size - y0 + 1)
+                values = layer.to_array().copy()
+                values[y0:y0 + height, x0:x0 + width] = rng.choice([0, 2])
+                layer.write_array(values)
+            elif roll < 0.85:
+                saved[layer.snapshot()] = _cells(layer)
+            elif saved and roll < 0.95:
+                del saved[rng.choice(list(saved))]
+            elif saved:
+                snapshot = rng.choice(list(saved))
+                differences = {(x, y): value for x, y, value in layer.differences(snapshot)}
+                assert differences == _expected_differences(saved[snapshot], _cells(layer)), trial
+        current = _cells(layer)
+        for snapshot, cells in saved.items():
+            differences = {(x, y): value for x, y, value in layer.differences(snapshot)}
+            assert differences == _expected_differences(cells, current), trial
+        # Against another layer, every cell the snapshot held differs
+        empty = GridLayer(size, 7)
+        for snapshot, cells in saved.items():
+            assert {(x, y): value for x, y, value in empty.differences(snapshot)} == cells, trial
+        # Once no snapshot is alive, the versions they kept are released
+        saved.clear()
+        snapshot = None
+        layer.snapshot()
+        assert len(layer.versions) <= 1, trial
+
+
+def test_snapshot_differences():
+    check_snapshots(5, 30)
+
+
+def test_snapshot_differences_with_array_writes():
+    pytest.importorskip('numpy')
+    check_snapshots(6, 30, arrays=True)
@@ -0,0 +1,65 @@
+import random
+
+from main import NetworkComponents
+
+
+def _neighbours(x, y):
+    return [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
+
+
+def _flood(tiles, starts):
+    """Every tile connected to one of `starts`."""
+    reached = set()
+    for start in starts:
+        if start in tiles and start not in reached:
+            reached.add(start)
+            stack = [start]
+            while stack:
+                tile = stack.pop()
+                for neighbour in _neighbours(*tile):
+                    if neighbour in tiles and neighbour not in reached:
+                        reached.add(neighbour)
+                        stack.append(neighbour)
+    return reached
+
+
+def test_components_match_flood_fill():
+    rng = random.Random(1)
+    for trial in range(150):
+        size = rng.choice([3, 6, 12])
+        network = NetworkComponents()
+        tiles, sources, live = set(), set(), set()
+        for step in range(400):
+            tile = (rng.randrange(size), rng.randrange(size))
+            roll = rng.random()
+            if tile not in tiles and roll < 0.55:
+                fed = rng.random() < 0.1
+                gained, lost = network.add(tile, fed), []
+                tiles.add(tile)
+                if fed:
+                    sources.add(tile)
+            elif tile in tiles and roll < 0.9:
+                gained, lost = [], network.remove(tile)
+                tiles.discard(tile)
+                sources.discard(tile)
+            elif tile in tiles:
+                fed = tile not in sources
+                gained, lost = network.set_fed(tile, fed)
+                if fed:
+                    sources.add(tile)
+                else:
+                    sources.discard(tile)
+            else:
+                continue
+            expected = _flood(tiles, sources)
+            assert sorted(gained) == sorted(expected - live), (trial, step)
+            assert sorted(lost) == sorted(live - expected), (trial, step)
+            live = expected
+            assert {tile for tile in tiles if network.is_live(tile)} == live, (trial, step)
+            for tile in tiles:
+                assert tile in network.members[network.find(tile)]
+                for neighbour in _neighbours(*tile):
+                    if neighbour in tiles:
+                        assert network.find(neighbour) == network.find(tile), (trial, step)
+            assert len(network.members) == len({frozenset(_flood(tiles, [tile])) for tile in tiles}), (trial, step)
+            assert sum(map(len, network.members.values())) == len(tiles) == len(network.nodes)
@@ -0,0 +1,78 @@
+import contextlib
+import io
+import random
+from collections import deque
+
+from main import BUILDING_CODES, INFRA_BITS, ROAD_CAPACITY, City, demolish
+
+
+def _neighbours(x, y):
+    return [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
+
+
+def solve_traffic(city):
+    """TrafficModel.refresh() recomputed from scratch: one flood from every destination, then loads by level."""
+    traffic = city.infrastructure.traffic
+    layer, grid, size = city.infrastructure.layer, city.grid_layer, city.grid_size
+    jobs = {BUILDING_CODES['C'], BUILDING_CODES['I']}
+    roads = {(x, y) for y in range(size) for x in range(size) if layer.get(x, y) & INFRA_BITS['ROAD']}
+    destinations = {(x, y) for x, y in roads
+                    if any(0 <= cx < size and 0 <= cy < size and grid.get(cx, cy) in jobs
+                           for cx, cy in [(x, y)] + _neighbours(x, y))}
+    origins = {}
+    for y in range(size):
+        for x in range(size):
+            if grid.get(x, y) == BUILDING_CODES['R']:
+                tile = traffic.frontage(x, y)
+                if tile:
+                    origins[tile] = origins.get(tile, 0) + 1
+    distance = dict.fromkeys(destinations, 0)
+    queue = deque(destinations)
+    while queue:
+        tile = queue.popleft()
+        for neighbour in _neighbours(*tile):
+            if neighbour in roads and neighbour not in distance:
+                distance[neighbour] = distance[tile] + 1
+                queue.append(neighbour)
+    commuters = free_flow = travel = congested = 0
+    for tile, homes in origins.items():
+        if tile in distance:
+            commuters += homes
+            free_flow += homes * (distance[tile] + 1)
+    # Commuters step to the lowest-index neighbour one closer, farthest tiles first
+    load = {}
+    for tile in sorted(distance, key=lambda tile: -distance[tile]):
+        load[tile] = load.get(tile, 0) + origins.get(tile, 0)
+        if distance[tile]:
+            step = min((neighbour for neighbour in _neighbours(*tile)
+                        if distance.get(neighbour) == distance[tile] - 1),
+                       key=lambda neighbour: neighbour[0] + neighbour[1] * traffic.stride)
+            load[step] = load.get(step, 0) + load[tile]
+    for tile_load in load.values():
+        travel += (1 + max(tile_load - 1, 0) // ROAD_CAPACITY) * tile_load
+        congested += tile_load > ROAD_CAPACITY
+    return commuters, travel, free_flow, congested
+
+
+def test_repair_matches_full_solve():
+    rng = random.Random(3)
+    for trial in range(40):
+        size = rng.choice([6, 12, 25])
+        city = City('traffic', size, seed=trial)
+        city.money = 10 ** 12
+        with contextlib.redirect_stdout(io.StringIO()):
+            for step in range(250):
+                x, y = rng.randrange(size), rng.randrange(size)
+                roll = rng.random()
+                if roll < 0.35:
+                    city.build(x, y, 'ROAD')
+                elif roll < 0.55:
+                    demolish(city, x, y)
+                elif roll < 0.6:
+                    city.infrastructure.remove_connection(x, y, 'ROAD')
+                else:
+                    city.build(x, y, rng.choice('RRRCIP'))
+                if rng.random() < 0.3:
+                    assert city.infrastructure.traffic.refresh() == solve_traffic(city), (trial, step)
+        assert city.infrastructure.traffic.refresh() == solve_traffic(city)
+        city.verify_stats()